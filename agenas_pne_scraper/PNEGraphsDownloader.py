@@ -1,24 +1,46 @@
-from fake_useragent import UserAgent
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
 import pandas as pd
 
 import requests
-from typing import Callable
+from typing import Any, Callable, Iterable, Optional
 from warnings import warn
 
-from .exceptions import ErrorStatusCodeException
-from .utils import BaseClass, retry
+from .exceptions import DeadlineExceeded, ErrorStatusCodeException
+from .metrics import (
+    count_deferred,
+    count_failure,
+    count_retry,
+    get_metrics,
+    instrument_request,
+)
+from .transport import PNESession, get_default_session
+from .utils import BaseClass, compact_df, retry
 
 
 class PNEGraphsDownloader(BaseClass):
-    def __init__(self, hospital_code: str, indicator_id: str | int | float) -> None:
+    # If True, result dfs get compact dtypes (see utils.compact_df): category for strings, smallest nullable ints, float32 where exact. Values are the same
+    compact_dtypes = False
+
+    def __init__(
+        self,
+        hospital_code: str,
+        indicator_id: str | int | float,
+        session: Optional[PNESession] = None,
+    ) -> None:
         assert isinstance(indicator_id, (str, int, float))
         self.hospital_code = hospital_code
+        self.session = session if session is not None else get_default_session()
+        # Errors of requests that kept failing, download returns an empty df for them
+        self.errors = []
         self.indicator_id = (
             indicator_id
             if isinstance(indicator_id, int)
-            else int(float(indicator_id))
-            if isinstance(indicator_id, str)
-            else int(indicator_id)
+            else (
+                int(float(indicator_id))
+                if isinstance(indicator_id, str)
+                else int(indicator_id)
+            )
         )
 
     def generate_querystring_dict(self, **kwargs) -> dict[str, str]:
@@ -35,11 +57,16 @@ class PNEGraphsDownloader(BaseClass):
         df['indicator_id'] = self.indicator_id
         return df
 
-    def _order_columns_in_result(self, df: pd.DataFrame) -> pd.DataFrame:
+    def _order_columns_in_result(
+        self, df: pd.DataFrame, compact: Optional[bool] = None
+    ) -> pd.DataFrame:
         """
         Try to order df columns according to self.results_columns. If a column of the list is not found in df, it's simply ignored.
+        If compact (default self.compact_dtypes) is True, dtypes are compacted with utils.compact_df.
         """
         ret_cols = [col for col in self.results_columns if col in df.columns]
+        if compact if compact is not None else self.compact_dtypes:
+            return compact_df(df[ret_cols])
         return df[ret_cols].copy()
 
     @staticmethod
@@ -55,6 +82,22 @@ class PNEGraphsDownloader(BaseClass):
         df = self._adapt_json_to_df(r.json())
         return df
 
+    @staticmethod
+    def _adapt_json_to_columns(json_data: list | dict) -> dict[str, list]:
+        """
+        Columnar counterpart of self._adapt_json_to_df: return a dict column name -> data list.
+        """
+        return {
+            str(json_element['name']).lower(): list(json_element['data'])
+            for json_element in json_data
+        }
+
+    def _convert_response_to_columns(self, r: requests.Response) -> dict[str, list]:
+        """
+        Columnar counterpart of self._convert_response_to_df, used by download_many. Lists may have different lengths, shorter ones are padded with None.
+        """
+        return self._adapt_json_to_columns(r.json())
+
     def _parse_response_df(self, df: pd.DataFrame) -> pd.DataFrame:
         # Handle errors here
         for c in self.table_columns:
@@ -67,53 +110,221 @@ class PNEGraphsDownloader(BaseClass):
         df = self._order_columns_in_result(df)
         return df
 
-    @retry(ErrorStatusCodeException, 10, 0.2)
+    @retry(
+        ErrorStatusCodeException,
+        10,
+        0.2,
+        backoff=2,
+        max_delay_seconds=10,
+        jitter=True,
+        on_retry=count_retry,
+    )
+    @instrument_request()
     def _request(self, **kwargs) -> requests.Response:
-        try:
-            r = requests.get(
-                self.BASE_URL + self.relative_url,
-                headers={'User-Agent': UserAgent()['chrome']},
-                params=self.generate_querystring_dict(**kwargs),
+        return self.session.get(
+            self.BASE_URL + self.relative_url,
+            params=self.generate_querystring_dict(**kwargs),
+        )
+
+    @retry(
+        ErrorStatusCodeException,
+        10,
+        0.2,
+        backoff=2,
+        max_delay_seconds=10,
+        jitter=True,
+        on_retry=count_retry,
+    )
+    @instrument_request()
+    async def _arequest(self, **kwargs) -> requests.Response:
+        return await self.session.aget(
+            self.BASE_URL + self.relative_url,
+            params=self.generate_querystring_dict(**kwargs),
+        )
+
+    def _report_error(self, e: ErrorStatusCodeException) -> None:
+        self.errors.append(e)
+        if isinstance(e, DeadlineExceeded):
+            count_deferred(self)
+            print(
+                f'hospital_id: {self.hospital_code}, indicator_id: {self.indicator_id} --> deferred.'
             )
-        except ConnectionError as e:
-            raise ErrorStatusCodeException()
-        if r.status_code != 200:
-            raise ErrorStatusCodeException(r)
-        return r
+            return
+        count_failure(self)
+        status_code = e.r.status_code if e.r is not None else None
+        print(
+            f'hospital_id: {self.hospital_code}, indicator_id: {self.indicator_id} --> r.status_code: {status_code}.'
+        )
 
-    def download(self, **kwargs) -> pd.DataFrame:
+    def _fetch(self, **kwargs) -> Optional[tuple[requests.Response, ...]]:
         """
-        Make the request, get the response and send it to self._parse_request_response.
+        Make the request(s) needed to build the graph df and return the responses as a tuple. If a request keeps failing, the error is reported and None is returned.
         """
         try:
-            r = self._request(**kwargs)
-            df = self._convert_response_to_df(r)
-            df = self._parse_response_df(df)
-            return df
+            return (self._request(**kwargs),)
         except ErrorStatusCodeException as e:
-            status_code = e.r.status_code if e.r is not None else None
-            print(
-                f'hospital_id: {self.hospital_code}, indicator_id: {self.indicator_id} --> r.status_code: {status_code}.'
-            )
+            self._report_error(e)
+
+    async def _afetch(self, **kwargs) -> Optional[tuple[requests.Response, ...]]:
+        """
+        Awaitable version of self._fetch.
+        """
+        try:
+            return (await self._arequest(**kwargs),)
+        except ErrorStatusCodeException as e:
+            self._report_error(e)
+
+    def _parse(
+        self, responses: Optional[tuple[requests.Response, ...]]
+    ) -> pd.DataFrame:
+        """
+        Turn what self._fetch returned into the results df. An empty df is returned if the request failed.
+        """
+        if responses is None:
             return pd.DataFrame([], columns=self.table_columns)
+        metrics = get_metrics()
+        with metrics.timer(self, 'json'):
+            df = self._convert_response_to_df(*responses)
+        with metrics.timer(self, 'postprocess'):
+            df = self._parse_response_df(df)
+        return df
+
+    def _result_key(self, **kwargs) -> tuple:
+        """
+        Return the key the df of self.download(**kwargs) is shared on: url, querystring and everything else the parsed df depends on.
+        """
+        return (
+            type(self),
+            self.BASE_URL + self.relative_url,
+            tuple(sorted(self.generate_querystring_dict(**kwargs).items())),
+            self.compact_dtypes,
+        )
+
+    def download(self, **kwargs) -> pd.DataFrame:
+        """
+        Make the request, get the response and send it to self._parse_request_response. Identical downloads share requests and parsed df (see PNESession single_flight).
+        """
+        return self._shared_download(
+            self._result_key(**kwargs), lambda: self._parse(self._fetch(**kwargs))
+        )
+
+    async def adownload(self, **kwargs) -> pd.DataFrame:
+        """
+        Awaitable version of self.download: the request is awaited, parsing is the same.
+        """
+
+        async def adownload() -> pd.DataFrame:
+            return self._parse(await self._afetch(**kwargs))
+
+        return await self._ashared_download(self._result_key(**kwargs), adownload)
 
     @classmethod
     def mapper(
-        cls, hospital_code: str, indicator_id: str | int | float, **kwargs
+        cls,
+        hospital_code: str,
+        indicator_id: str | int | float,
+        session: Optional[PNESession] = None,
+        **kwargs,
     ) -> pd.DataFrame:
         assert isinstance(indicator_id, (str, int, float))
-        return cls(hospital_code=hospital_code, indicator_id=indicator_id).download(
-            **kwargs
-        )
+        return cls(
+            hospital_code=hospital_code, indicator_id=indicator_id, session=session
+        ).download(**kwargs)
+
+    @classmethod
+    def download_many(
+        cls,
+        pairs: Iterable[tuple[str, Any]] | pd.DataFrame,
+        workers: int = 16,
+        session: Optional[PNESession] = None,
+        **kwargs,
+    ) -> pd.DataFrame:
+        """
+        Download the graphs of many (hospital_code, indicator_id) pairs and return them in a single df, equal to the concatenation (with ignore_index=True) of what mapper returns for every pair.
+        Requests are made concurrently by workers threads. The JSON data of every graph is accumulated into per-column buffers and the df is built and processed once, instead of once per pair.
+        Keyword args:
+            - pairs [Iterable[tuple[str, str | int | float]] | pd.DataFrame], (hospital_code, indicator_id) pairs, or a df with hospital_code and indicator_id columns.
+            - workers [int], _default=16_, number of concurrent downloads.
+            - session [PNESession | None], _default=None_, session to use, if None the default one.
+        """
+        if isinstance(pairs, pd.DataFrame):
+            pairs = pairs[['hospital_code', 'indicator_id']].itertuples(index=False)
+        downloaders = [
+            cls(hospital_code=hospital_code, indicator_id=indicator_id, session=session)
+            for hospital_code, indicator_id in pairs
+        ]
+
+        metrics = get_metrics()
+        buffers = {}
+        hospital_codes = []
+        indicator_ids = []
+        n_rows = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Requests run in the context of the caller, e.g. within its deadline_scope
+            futures = [
+                executor.submit(copy_context().run, downloader._fetch, **kwargs)
+                for downloader in downloaders
+            ]
+            for downloader, future in zip(downloaders, futures):
+                responses = future.result()
+                if responses is None:
+                    continue
+                with metrics.timer(cls, 'json'):
+                    columns = downloader._convert_response_to_columns(*responses)
+                for c in downloader.table_columns:
+                    if c not in columns:
+                        raise AssertionError(f"Column '{c}' not in df.columns")
+                n = max(map(len, columns.values()), default=0)
+                for name in columns.keys() - buffers.keys():
+                    buffers[name] = [None] * n_rows
+                for name, buffer in buffers.items():
+                    values = columns.get(name, [])
+                    buffer.extend(values)
+                    buffer.extend([None] * (n - len(values)))
+                hospital_codes.extend([downloader.hospital_code] * n)
+                indicator_ids.extend([downloader.indicator_id] * n)
+                n_rows += n
+
+        if not n_rows:
+            return pd.DataFrame([], columns=cls.results_columns)
+        with metrics.timer(cls, 'postprocess'):
+            df = pd.DataFrame(buffers)
+            data_columns = list(df.columns)
+            df['hospital_code'] = hospital_codes
+            df['indicator_id'] = indicator_ids
+            df = df.dropna(axis=0, how='all', subset=data_columns)
+            # process_results_df and _order_columns_in_result don't depend on the instance
+            downloader = downloaders[0]
+            df = downloader.process_results_df(df)
+            df = downloader._order_columns_in_result(df)
+        return df.reset_index(drop=True)
+
+    @classmethod
+    async def amapper(
+        cls,
+        hospital_code: str,
+        indicator_id: str | int | float,
+        session: Optional[PNESession] = None,
+        **kwargs,
+    ) -> pd.DataFrame:
+        assert isinstance(indicator_id, (str, int, float))
+        return await cls(
+            hospital_code=hospital_code, indicator_id=indicator_id, session=session
+        ).adownload(**kwargs)
 
     @classmethod
-    def generate_pandas_mapper(cls, **kwargs) -> Callable:
+    def generate_pandas_mapper(
+        cls, session: Optional[PNESession] = None, **kwargs
+    ) -> Callable:
         def fn(row: pd.Series) -> pd.DataFrame:
             assert isinstance(row, pd.Series)
             hospital_code = row.hospital_code
             indicator_id = row.indicator_id
             return cls.mapper(
-                hospital_code=hospital_code, indicator_id=indicator_id, **kwargs
+                hospital_code=hospital_code,
+                indicator_id=indicator_id,
+                session=session,
+                **kwargs,
             )
 
         return fn
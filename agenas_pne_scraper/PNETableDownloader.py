@@ -1,20 +1,42 @@
-from bs4 import BeautifulSoup, Tag
-from fake_useragent import UserAgent
+from bs4 import Tag
 import pandas as pd
 
 import requests
-from typing import Callable
+from typing import Callable, Optional
 from warnings import warn
 
-from .exceptions import ErrorStatusCodeException
-from .utils import BaseClass, display, retry
+from .exceptions import DeadlineExceeded, ErrorStatusCodeException
+from .metrics import (
+    count_deferred,
+    count_failure,
+    count_retry,
+    get_metrics,
+    instrument_request,
+)
+from .parsers import LxmlTag, convert_columns, get_table_parser
+from .transport import PNESession, get_default_session
+from .utils import BaseClass, compact_df, display, retry
 
 
 class PNETableDownloader(BaseClass):
-    def __init__(self, year: int, hospital_code: str) -> None:
+    # Backend used to walk the table, one of parsers.TABLE_PARSERS: "bs4" (BeautifulSoup) or "lxml" (faster, same results)
+    table_parser = 'bs4'
+
+    # How cells are converted: "cell" calls self.transform_td on every td, "column" collects the raw strings of every column and converts them at once according to self.table_columns_spec (see parsers.convert_columns)
+    coercion = 'cell'
+
+    # If True, result dfs get compact dtypes (see utils.compact_df): category for strings, smallest nullable ints, float32 where exact. Values are the same
+    compact_dtypes = False
+
+    def __init__(
+        self, year: int, hospital_code: str, session: Optional[PNESession] = None
+    ) -> None:
         assert isinstance(year, int)
         self.year = year
         self.hospital_code = hospital_code
+        self.session = session if session is not None else get_default_session()
+        # Errors of requests that kept failing, download returns an empty df for them
+        self.errors = []
 
     def generate_querystring_dict(self, **kwargs) -> dict[str, str]:
         """
@@ -28,67 +50,179 @@ class PNETableDownloader(BaseClass):
         df['year'] = self.year
         return df
 
-    def _process_row(self, tr: Tag) -> list[str | int | None]:
-        tds = tr.find_all('td')
-        if tds is None:
-            return
-        return map(self.transform_td, list(tds), range(len(tds)))
+    def _process_row(self, tds: list[Tag | LxmlTag]) -> list[str | int | None]:
+        return map(self.transform_td, tds, range(len(tds)))
 
-    def _order_columns_in_result(self, df: pd.DataFrame) -> pd.DataFrame:
+    def _order_columns_in_result(
+        self, df: pd.DataFrame, compact: Optional[bool] = None
+    ) -> pd.DataFrame:
         """
         Try to order df columns according to self.results_columns. If a column of the list is not found in df, it's simply ignored.
+        If compact (default self.compact_dtypes) is True, dtypes are compacted with utils.compact_df.
         """
         ret_cols = [col for col in self.results_columns if col in df.columns]
+        if compact if compact is not None else self.compact_dtypes:
+            return compact_df(df[ret_cols])
         return df[ret_cols].copy()
 
-    def _parse_request_response(self, r) -> pd.DataFrame:
-        bs = BeautifulSoup(r.content, 'lxml')
-        data = list(map(self._process_row, bs.find('table').find_all('tr')))
-        df = pd.DataFrame(
-            data,
-            columns=self.table_columns,
-        )
-        df = df.dropna(axis=0, how='all')
-        df = self._add_hospital_id_and_year(df)
-        df = self.process_results_df(df)
-        df = self._order_columns_in_result(df)
+    def _parse_request_response(
+        self, r, compact: Optional[bool] = None
+    ) -> pd.DataFrame:
+        iter_table_rows = get_table_parser(self.table_parser)
+        metrics = get_metrics()
+        with metrics.timer(self, 'table'):
+            if self.coercion == 'column':
+                df = convert_columns(
+                    iter_table_rows(r.content), self.table_columns_spec
+                )
+            else:
+                data = list(map(self._process_row, iter_table_rows(r.content)))
+                df = pd.DataFrame(
+                    data,
+                    columns=self.table_columns,
+                )
+        with metrics.timer(self, 'postprocess'):
+            df = df.dropna(axis=0, how='all')
+            df = self._add_hospital_id_and_year(df)
+            df = self.process_results_df(df)
+            df = self._order_columns_in_result(df, compact=compact)
         return df
 
-    @retry(ErrorStatusCodeException, 10, 1)
+    @retry(
+        ErrorStatusCodeException,
+        10,
+        1,
+        backoff=2,
+        max_delay_seconds=30,
+        jitter=True,
+        on_retry=count_retry,
+    )
+    @instrument_request()
     def _request(self, **kwargs) -> requests.Response:
+        return self.session.get(
+            self.BASE_URL + self.relative_url,
+            params=self.generate_querystring_dict(**kwargs),
+        )
+
+    @retry(
+        ErrorStatusCodeException,
+        10,
+        1,
+        backoff=2,
+        max_delay_seconds=30,
+        jitter=True,
+        on_retry=count_retry,
+    )
+    @instrument_request()
+    async def _arequest(self, **kwargs) -> requests.Response:
+        return await self.session.aget(
+            self.BASE_URL + self.relative_url,
+            params=self.generate_querystring_dict(**kwargs),
+        )
+
+    def _report_error(self, e: ErrorStatusCodeException) -> None:
+        self.errors.append(e)
+        if isinstance(e, DeadlineExceeded):
+            count_deferred(self)
+            print(f'hospital_id: {self.hospital_code}, year: {self.year} --> deferred.')
+            return
+        count_failure(self)
+        status_code = e.r.status_code if e.r is not None else None
+        print(
+            f'hospital_id: {self.hospital_code}, year: {self.year} --> r.status_code: {status_code}.'
+        )
+
+    def _fetch(self, **kwargs) -> Optional[requests.Response]:
+        """
+        Make the request and return the response. If the request keeps failing, the error is reported and None is returned.
+        """
         try:
-            r = requests.get(
-                self.BASE_URL + self.relative_url,
-                headers={'User-Agent': UserAgent()['chrome']},
-                params=self.generate_querystring_dict(**kwargs),
-            )
-        except ConnectionError as e:
-            raise ErrorStatusCodeException()
-        if r.status_code != 200:
-            raise ErrorStatusCodeException(r)
-        return r
+            return self._request(**kwargs)
+        except ErrorStatusCodeException as e:
+            self._report_error(e)
 
-    def download(self, **kwargs) -> pd.DataFrame:
+    async def _afetch(self, **kwargs) -> Optional[requests.Response]:
         """
-        Make the request, get the response and send it to self._parse_request_response.
+        Awaitable version of self._fetch.
         """
         try:
-            r = self._request(**kwargs)
+            return await self._arequest(**kwargs)
         except ErrorStatusCodeException as e:
-            status_code = e.r.status_code if e.r is not None else None
-            print(
-                f'hospital_id: {self.hospital_code}, year: {self.year} --> r.status_code: {status_code}.'
-            )
+            self._report_error(e)
+
+    def _parse(
+        self, r: Optional[requests.Response], compact: Optional[bool] = None
+    ) -> pd.DataFrame:
+        """
+        Turn what self._fetch returned into the results df. An empty df is returned if the request failed. compact overrides self.compact_dtypes.
+        """
+        if r is None:
             return pd.DataFrame([], columns=self.table_columns)
-        return self._parse_request_response(r)
+        return self._parse_request_response(r, compact=compact)
+
+    def _result_key(self, **kwargs) -> tuple:
+        """
+        Return the key the df of self.download(**kwargs) is shared on: url, querystring and everything else the parsed df depends on.
+        """
+        return (
+            type(self),
+            self.BASE_URL + self.relative_url,
+            tuple(sorted(self.generate_querystring_dict(**kwargs).items())),
+            self.year,
+            self.table_parser,
+            self.coercion,
+            self.compact_dtypes,
+        )
+
+    def download(self, **kwargs) -> pd.DataFrame:
+        """
+        Make the request, get the response and send it to self._parse_request_response. Identical downloads share requests and parsed df (see PNESession single_flight).
+        """
+        return self._shared_download(
+            self._result_key(**kwargs), lambda: self._parse(self._fetch(**kwargs))
+        )
+
+    async def adownload(self, **kwargs) -> pd.DataFrame:
+        """
+        Awaitable version of self.download: the request is awaited, parsing is the same.
+        """
+
+        async def adownload() -> pd.DataFrame:
+            return self._parse(await self._afetch(**kwargs))
+
+        return await self._ashared_download(self._result_key(**kwargs), adownload)
 
     @classmethod
-    def mapper(cls, year: int, hospital_code: str, **kwargs) -> pd.DataFrame:
-        return cls(year=year, hospital_code=hospital_code).download(**kwargs)
+    def mapper(
+        cls,
+        year: int,
+        hospital_code: str,
+        session: Optional[PNESession] = None,
+        **kwargs,
+    ) -> pd.DataFrame:
+        return cls(year=year, hospital_code=hospital_code, session=session).download(
+            **kwargs
+        )
+
+    @classmethod
+    async def amapper(
+        cls,
+        year: int,
+        hospital_code: str,
+        session: Optional[PNESession] = None,
+        **kwargs,
+    ) -> pd.DataFrame:
+        return await cls(
+            year=year, hospital_code=hospital_code, session=session
+        ).adownload(**kwargs)
 
     @classmethod
-    def generate_pandas_mapper(cls, year: int, **kwargs) -> Callable:
+    def generate_pandas_mapper(
+        cls, year: int, session: Optional[PNESession] = None, **kwargs
+    ) -> Callable:
         def fn(hospital_code: str) -> pd.DataFrame:
-            return cls.mapper(year=year, hospital_code=hospital_code, **kwargs)
+            return cls.mapper(
+                year=year, hospital_code=hospital_code, session=session, **kwargs
+            )
 
         return fn
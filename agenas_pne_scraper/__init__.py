@@ -1,15 +1,94 @@
-from .hospitals import get_hospitals_df, get_hospital_id_hospital_name_hospitals_df
-from .PNEVolumeIndicatorsDownloader import (
-    PNEVolumeGraphsDownloader,
-    PNEVolumeIndicatorsDownloader,
-)
-from .PNEOutcomeIndicatorsDownloader import (
-    PNEOutcomeGraphsDownloader,
-    PNEOutcomeIndicatorsDownloader,
-)
-from .PNEWaitingTimeIndicatorsDownloader import (
-    PNEWaitingTimeGraphsDownloader,
-    PNEWaitingTimeIndicatorsDownloader,
-)
+from importlib import import_module
+from typing import TYPE_CHECKING, Any
+
+# Public names are imported from their module on first access, so that importing the package doesn't load pandas, bs4, requests and the hospitals registry
+_lazy_attributes = {
+    'HospitalRegistry': 'hospitals',
+    'get_hospital_id_hospital_name_hospitals_df': 'hospitals',
+    'get_hospital_registry': 'hospitals',
+    'get_hospitals_df': 'hospitals',
+    'PNEVolumeGraphsDownloader': 'volume_indicators',
+    'PNEVolumeIndicatorsDownloader': 'volume_indicators',
+    'PNEOutcomeGraphsDownloader': 'outcome_indicators',
+    'PNEOutcomeIndicatorsDownloader': 'outcome_indicators',
+    'PNEWaitingTimeGraphsDownloader': 'waiting_time_indicators',
+    'PNEWaitingTimeIndicatorsDownloader': 'waiting_time_indicators',
+    'ResponseArchive': 'archive',
+    'ResponseCache': 'cache',
+    'async_crawl': 'crawling',
+    'crawl': 'crawling',
+    'reparse': 'crawling',
+    'deadline_scope': 'deadline',
+    'RateGovernor': 'governor',
+    'CrawlJournal': 'journal',
+    'Metrics': 'metrics',
+    'get_metrics': 'metrics',
+    'Pipeline': 'pipeline',
+    'SingleFlight': 'singleflight',
+    'ParquetSink': 'sinks',
+    'ResultsSink': 'sinks',
+    'ResultsStore': 'sinks',
+    'SkipList': 'skiplist',
+    'PNESession': 'transport',
+    'get_default_session': 'transport',
+    'set_default_session': 'transport',
+    'get_user_agent': 'transport',
+    'WorkQueue': 'workqueue',
+    'WorkUnit': 'workqueue',
+    'run_worker': 'workqueue',
+}
+
+__all__ = list(_lazy_attributes)
 
 __version__ = '0.1.0'
+
+if TYPE_CHECKING:
+    from .hospitals import (
+        HospitalRegistry,
+        get_hospital_id_hospital_name_hospitals_df,
+        get_hospital_registry,
+        get_hospitals_df,
+    )
+    from .volume_indicators import (
+        PNEVolumeGraphsDownloader,
+        PNEVolumeIndicatorsDownloader,
+    )
+    from .outcome_indicators import (
+        PNEOutcomeGraphsDownloader,
+        PNEOutcomeIndicatorsDownloader,
+    )
+    from .waiting_time_indicators import (
+        PNEWaitingTimeGraphsDownloader,
+        PNEWaitingTimeIndicatorsDownloader,
+    )
+    from .archive import ResponseArchive
+    from .cache import ResponseCache
+    from .crawling import async_crawl, crawl, reparse
+    from .deadline import deadline_scope
+    from .governor import RateGovernor
+    from .journal import CrawlJournal
+    from .metrics import Metrics, get_metrics
+    from .pipeline import Pipeline
+    from .singleflight import SingleFlight
+    from .sinks import ParquetSink, ResultsSink, ResultsStore
+    from .skiplist import SkipList
+    from .transport import (
+        PNESession,
+        get_default_session,
+        get_user_agent,
+        set_default_session,
+    )
+    from .workqueue import WorkQueue, WorkUnit, run_worker
+
+
+def __getattr__(name: str) -> Any:
+    module = _lazy_attributes.get(name)
+    if module is None:
+        raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+    value = getattr(import_module(f'.{module}', __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> list[str]:
+    return sorted(set(globals()) | set(_lazy_attributes))
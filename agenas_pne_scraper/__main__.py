@@ -0,0 +1,385 @@
+import argparse
+import os
+import pandas as pd
+import sys
+from time import monotonic
+from typing import Optional, TextIO
+
+from .crawling import KINDS, crawl
+from .governor import RateGovernor
+from .hospitals import get_hospital_id_hospital_name_hospitals_df
+from .journal import CrawlJournal
+from .metrics import get_metrics
+from .sinks import ParquetSink, ResultsSink, ResultsStore, dataset_name
+from .transport import PNESession
+from .workqueue import WorkQueue, run_worker
+
+
+def _total(name: str) -> float:
+    # Sum of counter name over every downloader and label
+    counters = get_metrics().to_dict().get(name, {})
+    return sum(sum(labels.values()) for labels in counters.values())
+
+
+class _Progress:
+    """
+    Print progress and throughput of a crawl to stream: on a terminal a single line is rewritten, otherwise (e.g. under cron or systemd) a line is printed every interval seconds and when a stage ends.
+    """
+
+    def __init__(self, stream: TextIO = sys.stderr, interval: float = 10) -> None:
+        self.stream = stream
+        self.interval = interval
+        self.tty = stream.isatty()
+        self.start = monotonic()
+        # (stage, kind) -> start time, tables and graphs of a crawl run at the same time
+        self._stage_starts = {}
+        self._last_print = 0.0
+
+    def __call__(self, stage: str, kind: str, done: int, total: int) -> None:
+        now = monotonic()
+        if done == 0 or (stage, kind) not in self._stage_starts:
+            self._stage_starts[stage, kind] = now
+        finished = done == total
+        if not finished and now - self._last_print < (
+            0.2 if self.tty else self.interval
+        ):
+            return
+        self._last_print = now
+        elapsed = max(now - self._stage_starts[stage, kind], 1e-9)
+        requests = _total('pne_requests_total')
+        line = (
+            f'[{kind} {stage}s] {done}/{total} ({done / max(total, 1):.0%}), '
+            f'{done / elapsed:.1f} units/s, '
+            f'{requests / max(now - self.start, 1e-9):.1f} requests/s, '
+            f'{_total("pne_retries_total"):.0f} retries, '
+            f'{_total("pne_failures_total"):.0f} failures, '
+            f'{_total("pne_deferred_total"):.0f} deferred'
+        )
+        if self.tty:
+            self.stream.write('\r\033[K' + line + ('\n' if finished else ''))
+        else:
+            self.stream.write(line + '\n')
+        self.stream.flush()
+
+
+def _parse_years(value: str) -> list[int]:
+    return [int(year) for year in value.split(',') if year.strip()]
+
+
+def _parse_kinds(value: str) -> list[str]:
+    kinds = [kind.strip() for kind in value.split(',') if kind.strip()]
+    for kind in kinds:
+        if kind not in KINDS:
+            raise argparse.ArgumentTypeError(
+                f"kind must be one of {list(KINDS)}, not '{kind}'"
+            )
+    return kinds
+
+
+def _session(args: argparse.Namespace) -> PNESession:
+    governor_kwargs = dict(max_in_flight=args.max_in_flight or args.workers)
+    if args.max_rate is not None:
+        governor_kwargs['max_rate'] = args.max_rate
+    return PNESession(
+        pool_maxsize=args.workers,
+        governor=RateGovernor(**governor_kwargs),
+        timeout=(args.connect_timeout, args.read_timeout),
+    )
+
+
+def _write_csvs(results: dict[str, pd.DataFrame], out: str) -> None:
+    # One CSV per dataset, named like ParquetSink datasets
+    for key, df in results.items():
+        kind, _, graphs = key.partition('_')
+        table_cls, graph_cls = KINDS[kind]
+        name = dataset_name(graph_cls if graphs else table_cls)
+        df.to_csv(os.path.join(out, f'{name}.csv'), index=False)
+
+
+def _sink(args: argparse.Namespace) -> Optional[ResultsSink]:
+    if args.format == 'parquet':
+        return ParquetSink(args.out)
+    if args.format == 'sqlite':
+        return ResultsStore(os.path.join(args.out, 'pne.sqlite'))
+    return None
+
+
+def _hospital_codes(limit: Optional[int]) -> list[str]:
+    hospital_codes = list(get_hospital_id_hospital_name_hospitals_df().hospital_id)
+    return hospital_codes[:limit] if limit is not None else hospital_codes
+
+
+def _enqueue(args: argparse.Namespace) -> int:
+    queue = WorkQueue(args.job, path=args.queue, journal_mode=args.journal_mode)
+    n = queue.enqueue_tables(_hospital_codes(args.limit), args.years, args.kinds)
+    print(f'{n} table units enqueued, {queue.counts()}', file=sys.stderr)
+    return 0
+
+
+def _work(args: argparse.Namespace) -> int:
+    queue = WorkQueue(
+        args.job,
+        path=args.queue,
+        lease_timeout=args.lease_timeout,
+        journal_mode=args.journal_mode,
+    )
+    session = _session(args)
+    try:
+        stats = run_worker(
+            queue, workers=args.workers, graphs=args.graphs, session=session
+        )
+    finally:
+        session.close()
+    print(f'{stats}, queue: {queue.counts()}', file=sys.stderr)
+    return 0
+
+
+def _merge(args: argparse.Namespace) -> int:
+    queue = WorkQueue(args.job, path=args.queue, journal_mode=args.journal_mode)
+    counts = queue.counts()
+    os.makedirs(args.out, exist_ok=True)
+    sink = _sink(args)
+    if sink is not None:
+        with sink:
+            queue.merge(args.kinds, sink=sink)
+    else:
+        _write_csvs(queue.merge(args.kinds), args.out)
+    print(f'Merged {counts["done"]} units, queue: {counts}', file=sys.stderr)
+    # Units left pending, leased or failed are missing from the output
+    return 0 if counts['done'] == sum(counts.values()) else 1
+
+
+def _crawl(args: argparse.Namespace) -> int:
+    os.makedirs(args.out, exist_ok=True)
+    progress = None if args.quiet else _Progress(interval=args.progress_interval)
+
+    # Built before any download, so that a bad configuration (e.g. --format parquet without pyarrow) fails fast
+    sink = _sink(args)
+    journal = CrawlJournal(args.journal) if args.journal else None
+    session = _session(args)
+    try:
+        hospitals_df = get_hospital_id_hospital_name_hospitals_df()
+        hospitals_df.to_csv(os.path.join(args.out, 'hospitals.csv'), index=False)
+        hospital_codes = _hospital_codes(args.limit)
+        if not args.quiet:
+            print(
+                f'Crawling {len(hospital_codes)} hospitals for {args.year} '
+                f'({", ".join(args.kinds)}{", graphs" if args.graphs else ""}) '
+                f'with {args.workers} workers into {args.out}',
+                file=sys.stderr,
+            )
+        results = crawl(
+            hospital_codes,
+            args.year,
+            kinds=args.kinds,
+            graphs=args.graphs,
+            workers=args.workers,
+            session=session,
+            journal=journal,
+            sink=sink,
+            skiplist=not args.no_skiplist,
+            progress=progress,
+            parse_workers=args.parse_workers,
+            unit_timeout=args.unit_timeout,
+            deadline=args.deadline,
+        )
+    finally:
+        if sink is not None:
+            sink.close()
+        session.close()
+    _write_csvs(results, args.out)
+
+    if args.metrics:
+        with open(args.metrics, 'w') as f:
+            f.write(get_metrics().to_prometheus())
+    failures = _total('pne_failures_total')
+    deferred = _total('pne_deferred_total')
+    if not args.quiet:
+        elapsed = monotonic() - progress.start
+        requests = _total('pne_requests_total')
+        print(
+            f'Done in {elapsed:.0f}s: {requests:.0f} requests '
+            f'({requests / max(elapsed, 1e-9):.1f}/s), {failures:.0f} failures, '
+            f'{deferred:.0f} deferred',
+            file=sys.stderr,
+        )
+    # Failed and deferred units are not journaled, a rerun with the same --journal downloads only them
+    return 1 if failures or deferred else 0
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog='python -m agenas_pne_scraper',
+        description='Download data from pne.agenas.it.',
+    )
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    def add_timeout_arguments(subparser: argparse.ArgumentParser) -> None:
+        subparser.add_argument(
+            '--connect-timeout',
+            type=float,
+            default=10,
+            help='seconds to wait for a connection, default: 10',
+        )
+        subparser.add_argument(
+            '--read-timeout',
+            type=float,
+            default=60,
+            help='seconds to wait for data from the server, default: 60',
+        )
+
+    crawl_parser = subparsers.add_parser(
+        'crawl',
+        help='download tables (and optionally graphs) of every hospital',
+        description='Download tables (and optionally graphs) of every hospital in the ministry registry. Exits with 1 if some downloads failed or were deferred.',
+    )
+    crawl_parser.add_argument('--year', type=int, required=True)
+    crawl_parser.add_argument(
+        '--kinds',
+        type=_parse_kinds,
+        default=list(KINDS),
+        help=f'comma separated, default: {",".join(KINDS)}',
+    )
+    crawl_parser.add_argument(
+        '--graphs', action='store_true', help='download historical graphs too'
+    )
+    crawl_parser.add_argument('--workers', type=int, default=16)
+    crawl_parser.add_argument(
+        '--parse-workers',
+        type=int,
+        default=None,
+        help='parse table pages in this many processes, default: in the worker threads',
+    )
+    crawl_parser.add_argument(
+        '--max-in-flight',
+        type=int,
+        default=None,
+        help='maximum concurrent requests, default: --workers',
+    )
+    crawl_parser.add_argument(
+        '--max-rate', type=float, default=None, help='maximum requests/s'
+    )
+    add_timeout_arguments(crawl_parser)
+    crawl_parser.add_argument(
+        '--unit-timeout',
+        type=float,
+        default=None,
+        help='seconds a table or graph download can take, retries included; slower ones are deferred',
+    )
+    crawl_parser.add_argument(
+        '--deadline',
+        type=float,
+        default=None,
+        help='seconds the whole crawl can take; units left when it passes are deferred',
+    )
+    crawl_parser.add_argument('--out', required=True, help='output directory')
+    crawl_parser.add_argument(
+        '--format',
+        choices=['parquet', 'sqlite', 'csv'],
+        default='parquet',
+        help='parquet streams results to hive-partitioned datasets (requires pyarrow), sqlite upserts them into pne.sqlite (see ResultsStore), csv writes one file per dataset at the end',
+    )
+    crawl_parser.add_argument(
+        '--journal',
+        metavar='JOB_ID',
+        help='journal completed units, a rerun with the same JOB_ID resumes',
+    )
+    crawl_parser.add_argument('--no-skiplist', action='store_true')
+    crawl_parser.add_argument(
+        '--limit', type=int, default=None, help='crawl only the first N hospitals'
+    )
+    crawl_parser.add_argument(
+        '--metrics', help='write metrics in Prometheus text format to this file'
+    )
+    crawl_parser.add_argument(
+        '--progress-interval',
+        type=float,
+        default=10,
+        help='seconds between progress lines when stderr is not a terminal',
+    )
+    crawl_parser.add_argument('--quiet', action='store_true')
+
+    # Distributed crawls: units are enqueued once, then every node runs work on the same queue, finally results are merged
+    def add_queue_arguments(subparser: argparse.ArgumentParser) -> None:
+        subparser.add_argument(
+            '--queue',
+            required=True,
+            help='SQLite file of the work queue, on a filesystem shared by every node',
+        )
+        subparser.add_argument(
+            '--journal-mode',
+            choices=['delete', 'wal'],
+            default='delete',
+            help='SQLite journal mode of the queue; wal is faster but works only if every process runs on the same host, default: delete',
+        )
+        subparser.add_argument('--job', required=True, help='job id')
+
+    enqueue_parser = subparsers.add_parser(
+        'enqueue', help='add table units of a distributed crawl to a work queue'
+    )
+    add_queue_arguments(enqueue_parser)
+    enqueue_parser.add_argument(
+        '--years', type=_parse_years, required=True, help='comma separated'
+    )
+    enqueue_parser.add_argument(
+        '--kinds',
+        type=_parse_kinds,
+        default=list(KINDS),
+        help=f'comma separated, default: {",".join(KINDS)}',
+    )
+    enqueue_parser.add_argument(
+        '--limit', type=int, default=None, help='enqueue only the first N hospitals'
+    )
+
+    work_parser = subparsers.add_parser(
+        'work',
+        help='download units of a work queue until none is left',
+        description='Lease and download units of a work queue until none is pending or leased. Run it on every node.',
+    )
+    add_queue_arguments(work_parser)
+    work_parser.add_argument(
+        '--graphs',
+        action='store_true',
+        help='enqueue the graphs of completed tables, every node should use the same value',
+    )
+    work_parser.add_argument('--workers', type=int, default=16)
+    work_parser.add_argument('--max-in-flight', type=int, default=None)
+    work_parser.add_argument('--max-rate', type=float, default=None)
+    add_timeout_arguments(work_parser)
+    work_parser.add_argument(
+        '--lease-timeout',
+        type=float,
+        default=600,
+        help='seconds after which units of a crashed worker are leased again',
+    )
+
+    merge_parser = subparsers.add_parser(
+        'merge',
+        help='write the results of a work queue',
+        description='Write the results of the completed units of a work queue. Exits with 1 if some units are not completed.',
+    )
+    add_queue_arguments(merge_parser)
+    merge_parser.add_argument('--out', required=True, help='output directory')
+    merge_parser.add_argument(
+        '--format', choices=['parquet', 'sqlite', 'csv'], default='parquet'
+    )
+    merge_parser.add_argument(
+        '--kinds',
+        type=_parse_kinds,
+        default=list(KINDS),
+        help=f'comma separated, default: {",".join(KINDS)}',
+    )
+
+    args = parser.parse_args(argv)
+    if args.command == 'crawl':
+        return _crawl(args)
+    if args.command == 'enqueue':
+        return _enqueue(args)
+    if args.command == 'work':
+        return _work(args)
+    if args.command == 'merge':
+        return _merge(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,196 @@
+import json
+import os
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from threading import Lock
+from time import time
+from typing import Any, BinaryIO, Iterator, NamedTuple, Optional
+import zlib
+
+from .cache import ResponseCache
+
+# zstandard is optional, records are compressed with zlib without it
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Headers that describe the transfer, not the (already decoded) content that is archived
+_dropped_headers = set(['content-encoding', 'content-length', 'transfer-encoding'])
+
+
+class ArchiveRecord(NamedTuple):
+    url: str
+    params: dict[str, Any]
+    status_code: int
+    headers: dict[str, str]
+    stored_at: float
+    # Position of the compressed body in the data file
+    offset: int
+    length: int
+    codec: str
+
+    @property
+    def key(self) -> str:
+        return ResponseCache.make_key(self.url, self.params)
+
+
+class ResponseArchive:
+    """
+    Append-only archive of raw responses, so results can be parsed again (see crawling.reparse) without requests when parsers change or the site changes its HTML. Every body is compressed on its own (zstd if zstandard is installed, zlib otherwise) and appended to the data file <path>; url, querystring dict, status code, headers, time and position of every record are appended as a JSON line to the index <path>.idx, so records can be listed without decompressing anything and read with a single seek.
+    Pass it to PNESession(archive=...) to record every response the downloaders receive. A data file must be written by one process at a time: give every process of a distributed crawl its own path.
+    Keyword args:
+        - path [str], data file of the archive, the index is written next to it.
+        - level [int], _default=3_, compression level.
+    """
+
+    def __init__(self, path: str, level: int = 3) -> None:
+        self.path = path
+        self.level = level
+        self._setup()
+
+    def _setup(self) -> None:
+        self._lock = Lock()
+        self._files = None
+        self._reader = None
+        self._pid = None
+        self._compressor = None
+        self._decompressor = None
+
+    @property
+    def index_path(self) -> str:
+        return self.path + '.idx'
+
+    @property
+    def codec(self) -> str:
+        return 'zlib' if zstandard is None else 'zstd'
+
+    def _check_pid(self) -> None:
+        # Files must not be shared with forked processes, so they are opened again in every process
+        if self._pid != os.getpid():
+            self._files = None
+            self._reader = None
+            self._pid = os.getpid()
+
+    def _get_files(self) -> tuple[BinaryIO, BinaryIO]:
+        self._check_pid()
+        if self._files is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._files = (open(self.path, 'ab'), open(self.index_path, 'ab'))
+        return self._files
+
+    def _get_reader(self) -> BinaryIO:
+        self._check_pid()
+        if self._reader is None:
+            self._reader = open(self.path, 'rb')
+        return self._reader
+
+    def _compress(self, content: bytes) -> bytes:
+        if zstandard is None:
+            return zlib.compress(content, self.level)
+        if self._compressor is None:
+            self._compressor = zstandard.ZstdCompressor(level=self.level)
+        return self._compressor.compress(content)
+
+    def _decompress(self, data: bytes, codec: str) -> bytes:
+        if codec == 'zlib':
+            return zlib.decompress(data)
+        if zstandard is None:
+            raise ImportError(
+                'Records of this archive are compressed with zstd, which requires zstandard: pip install zstandard'
+            )
+        if self._decompressor is None:
+            self._decompressor = zstandard.ZstdDecompressor()
+        return self._decompressor.decompress(data)
+
+    def record(
+        self, url: str, params: Optional[dict[str, Any]], r: requests.Response
+    ) -> None:
+        """
+        Append response r of a GET request of url with querystring dict params.
+        """
+        headers = {
+            k: v for k, v in r.headers.items() if k.lower() not in _dropped_headers
+        }
+        with self._lock:
+            # zstandard (de)compressors must not be used by several threads at once
+            data = self._compress(r.content)
+            data_file, index_file = self._get_files()
+            offset = data_file.seek(0, os.SEEK_END)
+            data_file.write(data)
+            data_file.flush()
+            # The index line is written after its data, a crash can only lose the last record
+            line = dict(
+                url=url,
+                params=dict(params or {}),
+                status_code=r.status_code,
+                headers=headers,
+                stored_at=time(),
+                offset=offset,
+                length=len(data),
+                codec=self.codec,
+            )
+            index_file.write(json.dumps(line).encode() + b'\n')
+            index_file.flush()
+
+    def records(self) -> Iterator[ArchiveRecord]:
+        """
+        Iterate over the records in the order they were appended.
+        """
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, 'rb') as f:
+            for line in f:
+                try:
+                    yield ArchiveRecord(**json.loads(line))
+                except ValueError:
+                    # Last line of an archive whose writer was killed
+                    continue
+
+    def latest(self, status_code: Optional[int] = 200) -> dict[str, ArchiveRecord]:
+        """
+        Return the last record of every request (keyed like ResponseCache.make_key), considering only records with the given status_code (every record if None).
+        """
+        return {
+            record.key: record
+            for record in self.records()
+            if status_code is None or record.status_code == status_code
+        }
+
+    def read(self, record: ArchiveRecord) -> bytes:
+        """
+        Return the decompressed body of record.
+        """
+        with self._lock:
+            reader = self._get_reader()
+            reader.seek(record.offset)
+            return self._decompress(reader.read(record.length), record.codec)
+
+    def to_response(self, record: ArchiveRecord) -> requests.Response:
+        """
+        Build a requests.Response equivalent to the one that was recorded.
+        """
+        r = requests.Response()
+        r.status_code = record.status_code
+        r.url = record.url
+        r.headers = CaseInsensitiveDict(record.headers)
+        r.encoding = get_encoding_from_headers(r.headers)
+        r._content = self.read(record)
+        return r
+
+    def close(self) -> None:
+        with self._lock:
+            if self._pid == os.getpid():
+                for f in (self._files or ()) + (self._reader,):
+                    if f is not None:
+                        f.close()
+            self._files = None
+            self._reader = None
+
+    def __getstate__(self) -> dict[str, Any]:
+        return dict(path=self.path, level=self.level)
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._setup()
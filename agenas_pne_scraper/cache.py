@@ -0,0 +1,268 @@
+from datetime import timedelta
+from hashlib import sha256
+import json
+import os
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+import sqlite3
+from threading import Lock
+from time import time
+from typing import Any, Callable, NamedTuple, Optional
+from urllib.parse import urlencode
+
+from .utils import get_cache_dir
+
+# Headers that describe the transfer, not the (already decoded) content that is cached
+_dropped_headers = set(['content-encoding', 'content-length', 'transfer-encoding'])
+
+
+class CachedResponse(NamedTuple):
+    key: str
+    url: str
+    headers: dict[str, str]
+    content: bytes
+    etag: Optional[str]
+    last_modified: Optional[str]
+    stored_at: float
+
+    def to_response(self) -> requests.Response:
+        """
+        Build a requests.Response equivalent to the one that was stored.
+        """
+        r = requests.Response()
+        r.status_code = 200
+        r.url = self.url
+        r.headers = CaseInsensitiveDict(self.headers)
+        r.encoding = get_encoding_from_headers(r.headers)
+        r._content = self.content
+        return r
+
+    def revalidation_headers(self) -> dict[str, str]:
+        """
+        Return the headers needed for a conditional request, empty if the server gave no validator.
+        """
+        headers = {}
+        if self.etag is not None:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified is not None:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class ResponseCache:
+    """
+    Persistent, size-bounded cache of successful responses stored in a SQLite file. Entries are keyed on url and querystring dict. Fresh entries (younger than ttl) are served without any request; stale entries are revalidated with ETag/Last-Modified if the server gave them, otherwise they are downloaded again. When the cache grows over max_size_bytes, the least recently used entries are evicted.
+    Keyword args:
+        - path [str | None], _default=None_, SQLite file to use. If None, responses.sqlite in the package cache dir (see utils.get_cache_dir) is used.
+        - ttl [float | timedelta | None], _default=30 days_, time (in seconds if float) after which an entry is stale. If None, entries never expire.
+        - max_size_bytes [int], _default=1 GiB_, maximum total size of the cached bodies.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        ttl: float | timedelta | None = timedelta(days=30),
+        max_size_bytes: int = 1 << 30,
+    ) -> None:
+        if path is None:
+            path = os.path.join(get_cache_dir(), 'responses.sqlite')
+        self.path = path
+        self.ttl = ttl.total_seconds() if isinstance(ttl, timedelta) else ttl
+        self.max_size_bytes = max_size_bytes
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.stores = 0
+        self.evictions = 0
+        self._setup()
+
+    def _setup(self) -> None:
+        self._lock = Lock()
+        self._connection = None
+        self._pid = None
+
+    def _get_connection(self) -> sqlite3.Connection:
+        # A connection must not be shared with forked processes, so a new one is opened in every process
+        if self._connection is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'key TEXT PRIMARY KEY, url TEXT, headers TEXT, content BLOB, '
+                'etag TEXT, last_modified TEXT, stored_at REAL, accessed_at REAL, '
+                'size INTEGER)'
+            )
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS responses_accessed_at '
+                'ON responses (accessed_at)'
+            )
+            connection.commit()
+            self._connection = connection
+            self._pid = os.getpid()
+        return self._connection
+
+    @staticmethod
+    def make_key(url: str, params: Optional[dict[str, Any]] = None) -> str:
+        """
+        Return the cache key of a request: the hash of url and of its sorted querystring.
+        """
+        querystring = urlencode(sorted((params or {}).items()), doseq=True)
+        return sha256(f'{url}?{querystring}'.encode()).hexdigest()
+
+    def is_fresh(self, entry: CachedResponse) -> bool:
+        return self.ttl is None or time() - entry.stored_at < self.ttl
+
+    def lookup(
+        self, url: str, params: Optional[dict[str, Any]] = None
+    ) -> Optional[CachedResponse]:
+        """
+        Return the cached entry of the request, fresh or stale, or None if it's not cached.
+        """
+        key = self.make_key(url, params)
+        with self._lock:
+            connection = self._get_connection()
+            row = connection.execute(
+                'SELECT key, url, headers, content, etag, last_modified, stored_at '
+                'FROM responses WHERE key = ?',
+                (key,),
+            ).fetchone()
+            if row is None:
+                return
+            connection.execute(
+                'UPDATE responses SET accessed_at = ? WHERE key = ?', (time(), key)
+            )
+            connection.commit()
+        key, url, headers, content, etag, last_modified, stored_at = row
+        return CachedResponse(
+            key, url, json.loads(headers), content, etag, last_modified, stored_at
+        )
+
+    def store(
+        self, url: str, params: Optional[dict[str, Any]], r: requests.Response
+    ) -> None:
+        """
+        Store a successful response, then evict least recently used entries if the cache is too big.
+        """
+        key = self.make_key(url, params)
+        headers = {
+            k: v for k, v in r.headers.items() if k.lower() not in _dropped_headers
+        }
+        content = r.content
+        now = time()
+        self._count('stores')
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (
+                    key,
+                    r.url,
+                    json.dumps(headers),
+                    content,
+                    r.headers.get('ETag'),
+                    r.headers.get('Last-Modified'),
+                    now,
+                    now,
+                    len(content),
+                ),
+            )
+            self._evict(connection)
+            connection.commit()
+
+    def refresh(self, entry: CachedResponse) -> None:
+        """
+        Mark an entry as fresh again, after the server confirmed it's not modified.
+        """
+        now = time()
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute(
+                'UPDATE responses SET stored_at = ?, accessed_at = ? WHERE key = ?',
+                (now, now, entry.key),
+            )
+            connection.commit()
+
+    def _count(self, counter: str) -> None:
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def fetch(
+        self,
+        url: str,
+        params: Optional[dict[str, Any]],
+        send: Callable[..., requests.Response],
+    ) -> requests.Response:
+        """
+        Serve the request from the cache if possible, otherwise call send (optionally with conditional headers as headers keyword argument) and store its response if successful.
+        """
+        entry = self.lookup(url, params)
+        if entry is not None and self.is_fresh(entry):
+            self._count('hits')
+            return entry.to_response()
+        headers = entry.revalidation_headers() if entry is not None else {}
+        r = send(headers=headers) if headers else send()
+        if r.status_code == 304 and entry is not None:
+            self.refresh(entry)
+            self._count('revalidated')
+            return entry.to_response()
+        self._count('misses')
+        if r.status_code == 200:
+            self.store(url, params, r)
+        return r
+
+    def _evict(self, connection: sqlite3.Connection) -> None:
+        (total,) = connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM responses'
+        ).fetchone()
+        if total <= self.max_size_bytes:
+            return
+        for key, size in connection.execute(
+            'SELECT key, size FROM responses ORDER BY accessed_at'
+        ).fetchall():
+            connection.execute('DELETE FROM responses WHERE key = ?', (key,))
+            self.evictions += 1
+            total -= size
+            if total <= self.max_size_bytes:
+                break
+
+    def clear(self) -> None:
+        """
+        Remove every cached entry.
+        """
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute('DELETE FROM responses')
+            connection.commit()
+
+    @property
+    def stats(self) -> dict[str, int]:
+        """
+        Return hit/miss counters of this process together with the number of entries and the total size of the cache.
+        """
+        with self._lock:
+            entries, size = (
+                self._get_connection()
+                .execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses')
+                .fetchone()
+            )
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            revalidated=self.revalidated,
+            stores=self.stores,
+            evictions=self.evictions,
+            entries=entries,
+            size_bytes=size,
+        )
+
+    def __getstate__(self) -> dict[str, Any]:
+        state = self.__dict__.copy()
+        for k in ('_lock', '_connection', '_pid'):
+            state.pop(k)
+        return state
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._setup()
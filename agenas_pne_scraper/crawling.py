@@ -0,0 +1,645 @@
+import asyncio
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import partial
+import multiprocessing
+import os
+import pandas as pd
+from queue import Queue
+import requests
+from threading import Thread
+from time import monotonic
+from typing import Any, Callable, Iterable, Iterator, Optional
+from warnings import warn
+
+from .archive import ResponseArchive
+from .cache import ResponseCache
+from .deadline import deadline_scope
+from .exceptions import ResponseNotArchivedException
+from .governor import RateGovernor
+from .journal import CrawlJournal
+from .pipeline import PARSE_SETTINGS, Pipeline, _init_kwargs
+from .sinks import ResultsSink
+from .skiplist import SkipList
+from .transport import PNESession
+from .utils import compact_df
+from .PNEGraphsDownloader import PNEGraphsDownloader
+from .PNETableDownloader import PNETableDownloader
+from .outcome_indicators import (
+    PNEOutcomeGraphsDownloader,
+    PNEOutcomeIndicatorsDownloader,
+)
+from .volume_indicators import (
+    PNEVolumeGraphsDownloader,
+    PNEVolumeIndicatorsDownloader,
+)
+from .waiting_time_indicators import (
+    PNEWaitingTimeGraphsDownloader,
+    PNEWaitingTimeIndicatorsDownloader,
+)
+
+# kind -> (table downloader class, graph downloader class)
+KINDS = {
+    'volume': (PNEVolumeIndicatorsDownloader, PNEVolumeGraphsDownloader),
+    'outcome': (PNEOutcomeIndicatorsDownloader, PNEOutcomeGraphsDownloader),
+    'wt': (PNEWaitingTimeIndicatorsDownloader, PNEWaitingTimeGraphsDownloader),
+}
+
+
+def _check_kinds(kinds: Iterable[str]) -> list[str]:
+    kinds = list(kinds)
+    for kind in kinds:
+        if kind not in KINDS:
+            raise ValueError(f"kind must be one of {list(KINDS)}, not '{kind}'")
+    return kinds
+
+
+def _concat(
+    frames: list[pd.DataFrame], cls: type[PNETableDownloader | PNEGraphsDownloader]
+) -> pd.DataFrame:
+    frames = [df for df in frames if df is not None and len(df)]
+    if not frames:
+        return pd.DataFrame([], columns=cls.results_columns)
+    df = pd.concat(frames, axis=0, ignore_index=True)
+    if cls.compact_dtypes:
+        # Categories that differ between frames are concatenated as object, compact again
+        df = compact_df(df)
+    return df
+
+
+def _get_skiplist(skiplist: SkipList | bool) -> Optional[SkipList]:
+    if skiplist is True:
+        return SkipList()
+    if skiplist is False:
+        return
+    return skiplist
+
+
+def _filter_codes(
+    skiplist: Optional[SkipList], kind: str, hospital_codes: list[str]
+) -> list[str]:
+    if skiplist is None:
+        return hospital_codes
+    return skiplist.filter(kind, hospital_codes)
+
+
+def graph_pairs(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Return the unique (hospital_code, indicator_id) pairs of a table results df, i.e. the graphs that can be downloaded for it.
+    """
+    return df[['hospital_code', 'indicator_id']].drop_duplicates().dropna(how='any')
+
+
+def _download_table(
+    cls: type[PNETableDownloader],
+    year: int,
+    session: PNESession,
+    hospital_code: str,
+    indicator_id: None = None,
+) -> tuple[pd.DataFrame, Optional[bool]]:
+    downloader = cls(year=year, hospital_code=hospital_code, session=session)
+    df = downloader.download()
+    return df, None if downloader.deferred else not downloader.errors
+
+
+def _download_graph(
+    cls: type[PNEGraphsDownloader],
+    session: PNESession,
+    hospital_code: str,
+    indicator_id: int,
+) -> tuple[pd.DataFrame, Optional[bool]]:
+    downloader = cls(
+        hospital_code=hospital_code, indicator_id=indicator_id, session=session
+    )
+    df = downloader.download()
+    return df, None if downloader.deferred else not downloader.errors
+
+
+def _with_deadline(
+    seconds: Optional[float], at: Optional[float], fn: Callable[..., Any], *args
+) -> Any:
+    with deadline_scope(seconds, at=at):
+        return fn(*args)
+
+
+def _warn_deferred(deferred: int, journal: Optional[CrawlJournal] = None) -> None:
+    if deferred:
+        warn(
+            f'{deferred} units were deferred because their deadline passed'
+            + (', a rerun with the same journal downloads them' if journal else '')
+        )
+
+
+def _done_future(
+    result: Any = None, exception: Optional[BaseException] = None
+) -> Future:
+    future = Future()
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
+    return future
+
+
+class _Scheduler:
+    """
+    Streaming scheduler of a crawl: table units of every kind are submitted at once and, as soon as a table completes, its (hospital_code, indicator_id) pairs are submitted as graph units to the same pool, so graphs are downloaded during the long tail of the tables instead of after all of them. Completions are consumed in the calling thread (see _Scheduler.run), where journal, skiplist, sink and progress are updated.
+    Every submitted unit puts (stage, kind, unit, future) on the events queue when it completes: future.result() is (df, ok, journaled), where ok is None for deferred units and journaled is True for units taken from the journal. Units are downloaded in a deadline_scope of unit_timeout seconds ending at deadline_at at the latest, deferred ones are collected in self.deferred as (stage, kind, unit).
+    """
+
+    def __init__(
+        self,
+        year: int,
+        session: PNESession,
+        executor: Executor,
+        pipeline: Optional[Pipeline],
+        journal: Optional[CrawlJournal],
+        skiplist: Optional[SkipList],
+        graphs: bool,
+        progress: Optional[Callable[[str, str, int, int], None]],
+        unit_timeout: Optional[float] = None,
+        deadline_at: Optional[float] = None,
+    ) -> None:
+        self.year = year
+        self.session = session
+        self.executor = executor
+        self.pipeline = pipeline
+        self.journal = journal
+        self.skiplist = skiplist
+        self.graphs = graphs
+        self.progress = progress
+        self.unit_timeout = unit_timeout
+        self.deadline_at = deadline_at
+        self.deferred = []
+        self._events = Queue()
+        self._pending = 0
+        # (stage, kind) -> units completed in journal, submitted units, completed units
+        self._completed = {}
+        self._total = {}
+        self._done = {}
+        # kind -> graph units already submitted
+        self._graph_units = {}
+
+    def _journaled(self, stage: str, kind: str) -> dict:
+        key = (stage, kind)
+        if key not in self._completed:
+            self._completed[key] = (
+                self.journal.completed(stage, kind, self.year)
+                if self.journal is not None
+                else {}
+            )
+        return self._completed[key]
+
+    def _put(self, stage: str, kind: str, unit: tuple, future: Future) -> None:
+        self._events.put((stage, kind, unit, future))
+
+    def _submit(
+        self, stage: str, kind: str, units: list[tuple[str, Optional[int]]]
+    ) -> None:
+        key = (stage, kind)
+        self._total[key] = self._total.get(key, 0) + len(units)
+        self._done.setdefault(key, 0)
+        self._pending += len(units)
+        completed = self._journaled(stage, kind)
+        table_cls, graph_cls = KINDS[kind]
+        to_download = []
+        for unit in units:
+            if unit in completed:
+                self._put(
+                    stage, kind, unit, _done_future((completed[unit], True, True))
+                )
+            else:
+                to_download.append(unit)
+        if stage == 'table' and self.pipeline is not None:
+            Thread(
+                target=self._feed,
+                args=(kind, table_cls, to_download),
+                name=f'pne-feed-{kind}',
+                daemon=True,
+            ).start()
+            return
+        for unit in to_download:
+            if stage == 'table':
+                args = (_download_table, table_cls, self.year, self.session, unit[0])
+            else:
+                args = (_download_graph, graph_cls, self.session, *unit)
+            future = self.executor.submit(
+                _with_deadline, self.unit_timeout, self.deadline_at, *args
+            )
+            future.add_done_callback(partial(self._on_download, stage, kind, unit))
+
+    def _on_download(self, stage: str, kind: str, unit: tuple, future: Future) -> None:
+        if future.exception() is not None:
+            self._put(stage, kind, unit, future)
+        else:
+            df, ok = future.result()
+            self._put(stage, kind, unit, _done_future((df, ok, False)))
+
+    def _feed(
+        self,
+        kind: str,
+        cls: type[PNETableDownloader],
+        units: list[tuple[str, Optional[int]]],
+    ) -> None:
+        # Pipeline.run is a generator, it's consumed here and its results are moved to the events queue
+        try:
+            for unit, df, ok in self.pipeline.run(
+                cls,
+                units,
+                year=self.year,
+                unit_timeout=self.unit_timeout,
+                deadline_at=self.deadline_at,
+            ):
+                self._put('table', kind, unit, _done_future((df, ok, False)))
+        except BaseException as e:
+            self._put('table', kind, None, _done_future(exception=e))
+
+    def _report(self, stage: str, kind: str) -> None:
+        if self.progress is None:
+            return
+        done, total = self._done[(stage, kind)], self._total[(stage, kind)]
+        # The graph units of a kind are known only when all its tables completed
+        if (
+            stage == 'graph'
+            and done == total
+            and self._done[('table', kind)] < self._total[('table', kind)]
+        ):
+            return
+        self.progress(stage, kind, done, total)
+
+    def run(
+        self, kind_units: dict[str, list[tuple[str, Optional[int]]]]
+    ) -> Iterator[tuple[str, str, tuple[str, Optional[int]], pd.DataFrame]]:
+        """
+        Submit the table units of every kind and yield (stage, kind, unit, df) as soon as each table or graph unit completes, until none is left.
+        """
+        for kind, units in kind_units.items():
+            self._submit('table', kind, units)
+            if self.graphs:
+                self._graph_units[kind] = set()
+                self._submit('graph', kind, [])
+        for key in self._total:
+            self._report(*key)
+        while self._pending:
+            stage, kind, unit, future = self._events.get()
+            self._pending -= 1
+            df, ok, journaled = future.result()
+            if ok is None:
+                # Not learned in skiplist nor journaled as completed, the unit is downloaded again by next crawls
+                self.deferred.append((stage, kind, unit))
+                if self.journal is not None:
+                    self.journal.defer(
+                        stage, kind, self.year, unit[0], indicator_id=unit[1]
+                    )
+            elif not journaled:
+                if stage == 'table' and self.skiplist is not None:
+                    self.skiplist.update(kind, unit[0], len(df), ok)
+                if self.journal is not None and ok:
+                    self.journal.record(
+                        stage, kind, self.year, unit[0], df, indicator_id=unit[1]
+                    )
+            if stage == 'table' and self.graphs and len(df):
+                submitted = self._graph_units[kind]
+                graph_units = []
+                for code, indicator_id in graph_pairs(df).itertuples(index=False):
+                    graph_unit = (code, int(indicator_id))
+                    if graph_unit not in submitted:
+                        submitted.add(graph_unit)
+                        graph_units.append(graph_unit)
+                self._submit('graph', kind, graph_units)
+            yield stage, kind, unit, df
+            self._done[(stage, kind)] += 1
+            self._report(stage, kind)
+            if (
+                stage == 'table'
+                and self.graphs
+                and self._done[(stage, kind)] == self._total[(stage, kind)]
+            ):
+                self._report('graph', kind)
+
+
+def crawl(
+    hospital_codes: Iterable[str],
+    year: int,
+    kinds: Iterable[str] = ('volume', 'outcome', 'wt'),
+    graphs: bool = False,
+    workers: int = 16,
+    session: Optional[PNESession] = None,
+    journal: Optional[CrawlJournal] = None,
+    sink: Optional[ResultsSink] = None,
+    skiplist: SkipList | bool = True,
+    progress: Optional[Callable[[str, str, int, int], None]] = None,
+    parse_workers: Optional[int] = None,
+    unit_timeout: Optional[float] = None,
+    deadline: Optional[float] = None,
+) -> dict[str, pd.DataFrame]:
+    """
+    Download PNE tables (and optionally graphs) for every hospital with a pool of worker threads. Graphs of a table are submitted to the same pool as soon as the table completes, so they are downloaded together with the remaining tables.
+    Keyword args:
+        - hospital_codes [Iterable[str]], hospital codes to download, e.g. the hospital_id column returned by get_hospital_id_hospital_name_hospitals_df.
+        - year [int], year the tables refer to.
+        - kinds [Iterable[str]], _default=('volume', 'outcome', 'wt')_, which indicators to download.
+        - graphs [bool], _default=False_, if True, historical graphs are downloaded for every (hospital_code, indicator_id) pair found in tables.
+        - workers [int], _default=16_, number of worker threads.
+        - session [PNESession | None], _default=None_, session to use. If None, a new session (with a RateGovernor) sized on workers is created and closed at the end.
+        - journal [CrawlJournal | None], _default=None_, if given, completed work units are journaled and, when the crawl is restarted with the same job_id, they are not downloaded again.
+        - sink [ResultsSink | None], _default=None_, if given (e.g. a ParquetSink), every df is written to it as soon as its unit completes instead of being kept in memory. The sink is not closed.
+        - skiplist [SkipList | bool], _default=True_, hospital codes that never returned data for a kind are learned in skiplist and skipped on later crawls (see SkipList). If True, a SkipList with default settings is used; if False, every hospital code is downloaded and nothing is learned.
+        - unit_timeout [float | None], _default=None_, seconds every work unit can take, retries and their delays included.
+        - deadline [float | None], _default=None_, seconds the whole crawl can take. Once it passes, running units give up and the remaining ones make no request, so the crawl ends shortly after.
+    Units that ran out of unit_timeout or deadline are deferred: their df is empty, they are neither journaled as completed nor learned in skiplist (so a rerun with the same journal downloads them), are recorded with CrawlJournal.defer and counted in pne_deferred_total, and a warning is issued.
+    Returns a dict with a df for every kind (e.g. "volume") and, if graphs is True, for every kind's graphs (e.g. "volume_graphs"). If sink is given, the dict is empty.
+    """
+    deadline_at = monotonic() + deadline if deadline is not None else None
+    kinds = _check_kinds(kinds)
+    hospital_codes = list(dict.fromkeys(hospital_codes))
+    skiplist = _get_skiplist(skiplist)
+    own_session = session is None
+    if own_session:
+        session = PNESession(
+            pool_maxsize=workers,
+            governor=RateGovernor(max_in_flight=workers),
+        )
+    results = {}
+    executor = ThreadPoolExecutor(max_workers=workers)
+    pipeline = (
+        Pipeline(io_workers=workers, parse_workers=parse_workers, session=session)
+        if parse_workers
+        else None
+    )
+    # kind -> table units left after skiplist
+    kind_units = {
+        kind: [(code, None) for code in _filter_codes(skiplist, kind, hospital_codes)]
+        for kind in kinds
+    }
+    # (stage, kind) -> unit -> df and kind -> unit -> graph_pairs of its table, kept only if there's no sink
+    frames = {}
+    pairs = {kind: {} for kind in kinds}
+    try:
+        with executor, pipeline or nullcontext():
+            scheduler = _Scheduler(
+                year,
+                session,
+                executor,
+                pipeline,
+                journal,
+                skiplist,
+                graphs,
+                progress,
+                unit_timeout=unit_timeout,
+                deadline_at=deadline_at,
+            )
+            for stage, kind, unit, df in scheduler.run(kind_units):
+                cls = KINDS[kind][stage == 'graph']
+                if sink is not None:
+                    sink.write(df, cls)
+                    continue
+                frames.setdefault((stage, kind), {})[unit] = df
+                if stage == 'table' and graphs:
+                    pairs[kind][unit] = graph_pairs(df) if len(df) else None
+        _warn_deferred(len(scheduler.deferred), journal)
+        if sink is not None:
+            return results
+        # Units complete in any order, results are concatenated in the order of hospital_codes (and of the pairs in tables)
+        for kind in kinds:
+            table_frames = frames.get(('table', kind), {})
+            results[kind] = _concat(
+                [table_frames[unit] for unit in kind_units[kind]], KINDS[kind][0]
+            )
+        if graphs:
+            for kind in kinds:
+                table_cls, graph_cls = KINDS[kind]
+                kind_pairs = [pairs[kind][unit] for unit in kind_units[kind]]
+                graph_units = [
+                    (code, int(indicator_id))
+                    for code, indicator_id in _concat(kind_pairs, table_cls)
+                    .pipe(graph_pairs)
+                    .itertuples(index=False)
+                ]
+                graph_frames = frames.get(('graph', kind), {})
+                results[f'{kind}_graphs'] = _concat(
+                    [graph_frames[unit] for unit in graph_units], graph_cls
+                )
+        return results
+    finally:
+        if own_session:
+            session.close()
+
+
+async def async_crawl(
+    hospital_codes: Iterable[str],
+    year: int,
+    kinds: Iterable[str] = ('volume', 'outcome', 'wt'),
+    graphs: bool = False,
+    concurrency: int = 200,
+    session: Optional[PNESession] = None,
+    skiplist: SkipList | bool = True,
+    unit_timeout: Optional[float] = None,
+    deadline: Optional[float] = None,
+) -> dict[str, pd.DataFrame]:
+    """
+    Download PNE tables (and optionally graphs) for every hospital from a single event loop.
+    Keyword args:
+        - hospital_codes [Iterable[str]], hospital codes to download, e.g. the hospital_id column returned by get_hospital_id_hospital_name_hospitals_df.
+        - year [int], year the tables refer to.
+        - kinds [Iterable[str]], _default=('volume', 'outcome', 'wt')_, which indicators to download.
+        - graphs [bool], _default=False_, if True, historical graphs are downloaded for every (hospital_code, indicator_id) pair found in tables.
+        - concurrency [int], _default=200_, maximum number of downloads in flight at once.
+        - session [PNESession | None], _default=None_, session to use. If None, a new session (with a RateGovernor) sized on concurrency is created and closed at the end.
+        - skiplist [SkipList | bool], _default=True_, as in crawl: hospital codes that never returned data for a kind are learned and skipped on later crawls.
+        - unit_timeout [float | None], _default=None_, as in crawl: seconds every download can take, retries included.
+        - deadline [float | None], _default=None_, as in crawl: seconds the whole crawl can take. Deferred downloads give an empty df and a warning.
+    Returns a dict with a df for every kind (e.g. "volume") and, if graphs is True, for every kind's graphs (e.g. "volume_graphs").
+    """
+    deadline_at = monotonic() + deadline if deadline is not None else None
+    kinds = _check_kinds(kinds)
+    hospital_codes = list(hospital_codes)
+    skiplist = _get_skiplist(skiplist)
+    own_session = session is None
+    if own_session:
+        session = PNESession(
+            pool_maxsize=concurrency,
+            async_workers=concurrency,
+            governor=RateGovernor(max_in_flight=concurrency),
+        )
+    semaphore = asyncio.Semaphore(concurrency)
+    deferred = 0
+
+    async def download(
+        downloader: PNETableDownloader | PNEGraphsDownloader,
+    ) -> pd.DataFrame:
+        nonlocal deferred
+        # Every download runs in its own task, so the scope is not shared with the others
+        async with semaphore:
+            with deadline_scope(unit_timeout, at=deadline_at):
+                df = await downloader.adownload()
+        deferred += downloader.deferred
+        return df
+
+    async def download_table(
+        cls: type[PNETableDownloader], kind: str, hospital_code: str
+    ) -> pd.DataFrame:
+        downloader = cls(year=year, hospital_code=hospital_code, session=session)
+        df = await download(downloader)
+        if skiplist is not None and not downloader.deferred:
+            await asyncio.to_thread(
+                skiplist.update, kind, hospital_code, len(df), not downloader.errors
+            )
+        return df
+
+    async def download_graph(
+        cls: type[PNEGraphsDownloader], hospital_code: str, indicator_id: int
+    ) -> pd.DataFrame:
+        return await download(
+            cls(hospital_code=hospital_code, indicator_id=indicator_id, session=session)
+        )
+
+    async def crawl_kind(kind: str) -> dict[str, pd.DataFrame]:
+        table_cls, graph_cls = KINDS[kind]
+        df = _concat(
+            await asyncio.gather(
+                *(
+                    download_table(table_cls, kind, code)
+                    for code in _filter_codes(skiplist, kind, hospital_codes)
+                )
+            ),
+            table_cls,
+        )
+        results = {kind: df}
+        if graphs:
+            pairs = graph_pairs(df)
+            results[f'{kind}_graphs'] = _concat(
+                await asyncio.gather(
+                    *(
+                        download_graph(graph_cls, code, indicator_id)
+                        for code, indicator_id in pairs.itertuples(index=False)
+                    )
+                ),
+                graph_cls,
+            )
+        return results
+
+    try:
+        results = {}
+        for kind_results in await asyncio.gather(*map(crawl_kind, kinds)):
+            results.update(kind_results)
+        _warn_deferred(deferred)
+        return results
+    finally:
+        if own_session:
+            session.close()
+
+
+class _ArchiveSession(PNESession):
+    """
+    Session that serves the last successful response of every request from a ResponseArchive and never reaches the network. ResponseNotArchivedException is raised for requests that are not in the archive.
+    """
+
+    def __init__(self, archive: ResponseArchive) -> None:
+        # A fixed User-Agent avoids picking a random one, the session makes no requests
+        super().__init__(user_agent='agenas_pne_scraper', single_flight=False)
+        # Not self.archive, which would record the replayed responses again
+        self._replayed = archive
+        self._records = archive.latest()
+
+    def _send(
+        self, url: str, params: Optional[dict[str, Any]] = None, **kwargs
+    ) -> requests.Response:
+        record = self._records.get(ResponseCache.make_key(url, params))
+        if record is None:
+            raise ResponseNotArchivedException(url, params)
+        return self._replayed.to_response(record)
+
+
+# Archive sessions of a reparse process, by archive path
+_archive_sessions: dict[str, _ArchiveSession] = {}
+
+
+def _reparse_in_process(
+    cls: type[PNETableDownloader | PNEGraphsDownloader],
+    settings: dict[str, Any],
+    archive: ResponseArchive,
+    year: Optional[int],
+    units: list[tuple[str, Optional[int]]],
+) -> list[Optional[pd.DataFrame]]:
+    session = _archive_sessions.get(archive.path)
+    if session is None:
+        session = _archive_sessions[archive.path] = _ArchiveSession(archive)
+    for name, value in settings.items():
+        setattr(cls, name, value)
+    dfs = []
+    for unit in units:
+        downloader = cls(**_init_kwargs(cls, unit, year), session=session)
+        try:
+            fetched = downloader._fetch()
+        except ResponseNotArchivedException:
+            dfs.append(None)
+            continue
+        dfs.append(downloader._parse(fetched))
+    return dfs
+
+
+def archived_units(
+    archive: ResponseArchive, cls: type[PNETableDownloader | PNEGraphsDownloader]
+) -> list[tuple[str, Optional[int]]]:
+    """
+    Return the (hospital_code, indicator_id) units whose cls responses were archived successfully, in the order they were first recorded. indicator_id is None for table downloaders.
+    """
+    url = cls.BASE_URL + cls.relative_url
+    is_graph = issubclass(cls, PNEGraphsDownloader)
+    units = {}
+    for record in archive.records():
+        if record.url == url and record.status_code == 200:
+            indicator_id = int(record.params['ind']) if is_graph else None
+            units[(record.params['cod_struttura'], indicator_id)] = None
+    return list(units)
+
+
+def reparse(
+    archive: ResponseArchive | str,
+    cls: type[PNETableDownloader | PNEGraphsDownloader],
+    year: Optional[int] = None,
+    units: Optional[Iterable[tuple[str, Optional[int]]]] = None,
+    workers: Optional[int] = None,
+    mp_context: Optional[multiprocessing.context.BaseContext] = None,
+) -> pd.DataFrame:
+    """
+    Parse again the responses of a ResponseArchive with the current parsers of cls, without any request: every unit is downloaded by a cls instance whose session serves the last successful archived response of every request. Units are split among a pool of processes; class-level switches (PARSE_SETTINGS, e.g. table_parser) and BASE_URL of cls are copied into them. Units whose responses are not all archived are skipped with a warning.
+    Keyword args:
+        - archive [ResponseArchive | str], archive (or its path) recorded by a PNESession.
+        - cls [type], downloader class to parse responses with, e.g. PNEOutcomeGraphsDownloader.
+        - year [int | None], _default=None_, year the tables refer to, it's required by table downloaders because table pages don't contain it. Ignored by graph downloaders.
+        - units [Iterable[tuple[str, int | None]] | None], _default=None_, (hospital_code, indicator_id) units to parse. If None, every unit of cls in the archive is parsed (see archived_units).
+        - workers [int | None], _default=None_, number of processes. If None, os.cpu_count() is used.
+        - mp_context [multiprocessing.context.BaseContext | None], _default=None_, context of the processes. If None, the "spawn" context is used.
+    Returns the concatenated df, like crawl.
+    """
+    if isinstance(archive, str):
+        archive = ResponseArchive(archive)
+    if issubclass(cls, PNETableDownloader) and year is None:
+        raise ValueError('year is required to reparse tables')
+    units = list(units) if units is not None else archived_units(archive, cls)
+    workers = workers or os.cpu_count() or 1
+    settings = {
+        name: getattr(cls, name)
+        for name in PARSE_SETTINGS + ('BASE_URL',)
+        if hasattr(cls, name)
+    }
+    # A few chunks per process balance the load without sending every unit on its own
+    size = max(1, -(-len(units) // (4 * workers)))
+    chunks = [units[i : i + size] for i in range(0, len(units), size)]
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=mp_context or multiprocessing.get_context('spawn'),
+    ) as executor:
+        dfs = [
+            df
+            for chunk_dfs in executor.map(
+                partial(_reparse_in_process, cls, settings, archive, year), chunks
+            )
+            for df in chunk_dfs
+        ]
+    skipped = sum(df is None for df in dfs)
+    if skipped:
+        warn(f'{skipped} units were skipped, their responses are not in the archive')
+    return _concat(dfs, cls)
@@ -0,0 +1,60 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import monotonic
+from typing import Iterator, Optional
+
+from .exceptions import DeadlineExceeded
+
+# monotonic() time by which the work of the current thread (or task) must be done, None if there's none
+_deadline = ContextVar('pne_deadline', default=None)
+
+
+def get_deadline() -> Optional[float]:
+    """
+    Return the monotonic() time set by the innermost deadline_scope of the current context, or None.
+    """
+    return _deadline.get()
+
+
+def remaining() -> Optional[float]:
+    """
+    Return the seconds left before the deadline of the current context (negative if it passed), or None if there's no deadline.
+    """
+    deadline = _deadline.get()
+    return deadline - monotonic() if deadline is not None else None
+
+
+def check_deadline() -> None:
+    """
+    Raise DeadlineExceeded if the deadline of the current context passed.
+    """
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded()
+
+
+@contextmanager
+def deadline_scope(
+    seconds: Optional[float] = None, at: Optional[float] = None
+) -> Iterator[Optional[float]]:
+    """
+    Context manager that bounds the time of the requests made inside it, retries and their delays included: once the deadline passes, utils.retry and PNESession raise DeadlineExceeded instead of trying again, and request timeouts are shortened to the time left. Downloaders report it like a failed request, their download is deferred (see BaseClass.deferred).
+    The deadline lives in a context variable: it applies to the current thread or asyncio task, and to requests made through PNESession.aget and utils.run_concurrently. Nested scopes can only shorten it. Yields the deadline as a monotonic() time.
+    Keyword args:
+        - seconds [float | None], _default=None_, time budget from now.
+        - at [float | None], _default=None_, deadline as a monotonic() time, e.g. shared by all the units of a crawl.
+    """
+    deadlines = [
+        deadline
+        for deadline in (
+            _deadline.get(),
+            monotonic() + seconds if seconds is not None else None,
+            at,
+        )
+        if deadline is not None
+    ]
+    token = _deadline.set(min(deadlines) if deadlines else None)
+    try:
+        yield _deadline.get()
+    finally:
+        _deadline.reset(token)
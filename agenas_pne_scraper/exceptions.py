@@ -1,5 +1,7 @@
-from typing import Optional
-import requests
+from typing import TYPE_CHECKING, Optional
+
+if TYPE_CHECKING:
+    import requests
 
 
 class EmptyException(Exception):
@@ -7,6 +9,15 @@ class EmptyException(Exception):
 
 
 class ErrorStatusCodeException(Exception):
-    def __init__(self, r: Optional[requests.Response] = None, *args: object) -> None:
+    def __init__(self, r: Optional['requests.Response'] = None, *args: object) -> None:
         self.r = r
         super().__init__(*args)
+
+
+class ResponseNotArchivedException(Exception):
+    pass
+
+
+# The time budget of a deadline_scope ran out before a request (or its retries) could complete
+class DeadlineExceeded(ErrorStatusCodeException):
+    pass
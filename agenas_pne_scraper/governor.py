@@ -0,0 +1,182 @@
+import os
+from threading import Condition
+from time import monotonic, sleep
+from typing import Any, Optional
+
+from .exceptions import DeadlineExceeded
+
+
+class RateGovernor:
+    """
+    Concurrency governor shared by every request made through a PNESession. It limits both the number of requests in flight and the request rate, and adapts the two limits with AIMD: until the first congestion signal the limits grow by increase for every successful response (slow start, so they roughly double every round), then every successful, fast response increases them additively, while a 429, a 5xx, a connection error or a response slower than latency_target decreases them multiplicatively (at most once per cooldown, so a burst of failures counts as a single congestion signal). A Retry-After from the server pauses every request until the given time.
+    Keyword args:
+        - initial_rate [float], _default=20_, initial number of requests per second, at most max_rate.
+        - min_rate [float], _default=0.5_, lower bound of the request rate.
+        - max_rate [float], _default=500_, upper bound of the request rate.
+        - initial_in_flight [int], _default=16_, initial number of requests allowed in flight at once, at most max_in_flight.
+        - min_in_flight [int], _default=1_, lower bound of the in-flight limit.
+        - max_in_flight [int], _default=256_, upper bound of the in-flight limit.
+        - increase [float], _default=1_, additive increase: both limits grow by about this amount per round of successful requests.
+        - decrease_factor [float], _default=0.5_, multiplicative decrease applied to both limits on congestion.
+        - latency_target [float | None], _default=10_, responses slower than this (in seconds) count as congestion. If None, latency is ignored.
+        - cooldown [float], _default=1_, minimum time (in seconds) between two decreases.
+    """
+
+    def __init__(
+        self,
+        initial_rate: float = 20,
+        min_rate: float = 0.5,
+        max_rate: float = 500,
+        initial_in_flight: int = 16,
+        min_in_flight: int = 1,
+        max_in_flight: int = 256,
+        increase: float = 1,
+        decrease_factor: float = 0.5,
+        latency_target: Optional[float] = 10,
+        cooldown: float = 1,
+    ) -> None:
+        # Defaults larger than a given upper bound (e.g. max_in_flight=8) start at the bound
+        initial_rate = min(initial_rate, max_rate)
+        initial_in_flight = min(initial_in_flight, max_in_flight)
+        assert 0 < min_rate <= initial_rate <= max_rate
+        assert 0 < min_in_flight <= initial_in_flight <= max_in_flight
+        assert 0 < decrease_factor < 1
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.min_in_flight = min_in_flight
+        self.max_in_flight = max_in_flight
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.latency_target = latency_target
+        self.cooldown = cooldown
+        self.rate = float(initial_rate)
+        self.in_flight_limit = float(initial_in_flight)
+        self.in_flight = 0
+        self.requests = 0
+        self.congestions = 0
+        self.decreases = 0
+        self.slow_start = True
+        self._setup()
+
+    def _setup(self) -> None:
+        self._condition = Condition()
+        self._next_slot = 0.0
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._pid = os.getpid()
+
+    def _check_pid(self) -> None:
+        # Requests in flight when the process was forked are never released in the child, which keeps the limits but not the slots
+        if self._pid != os.getpid():
+            self._setup()
+            self.in_flight = 0
+
+    def acquire(self, deadline: Optional[float] = None) -> float:
+        """
+        Wait until a request can be made and return its start time, to be passed to self.release once the request is done (or to self.cancel if it's not made).
+        If deadline (a monotonic() time, e.g. deadline.get_deadline()) is given, DeadlineExceeded is raised as soon as it's clear that the request could not start before it: waiting for a free in-flight slot, for the rate slot or for the end of a Retry-After pause never goes past it.
+        """
+        self._check_pid()
+        with self._condition:
+            while self.in_flight >= int(self.in_flight_limit):
+                timeout = deadline - monotonic() if deadline is not None else None
+                if timeout is not None and timeout <= 0:
+                    raise DeadlineExceeded()
+                self._condition.wait(timeout)
+            now = monotonic()
+            slot = max(now, self._next_slot, self._paused_until)
+            if deadline is not None and slot >= deadline:
+                # The slot is not taken, the requests that can make it are not delayed
+                raise DeadlineExceeded()
+            self.in_flight += 1
+            self._next_slot = slot + 1 / self.rate
+        if slot > now:
+            sleep(slot - now)
+        return monotonic()
+
+    def cancel(self) -> None:
+        """
+        Give back the in-flight slot of an acquired request that was not made, without adapting the limits.
+        """
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def release(
+        self,
+        start: float,
+        status_code: Optional[int],
+        retry_after: Optional[float] = None,
+    ) -> None:
+        """
+        Signal that the request started at start is done and adapt the limits. status_code is None if the request could not be completed.
+        """
+        now = monotonic()
+        latency = now - start
+        congested = (
+            status_code is None
+            or status_code == 429
+            or status_code >= 500
+            or (self.latency_target is not None and latency > self.latency_target)
+        )
+        with self._condition:
+            self.in_flight -= 1
+            self.requests += 1
+            if retry_after is not None:
+                self._paused_until = max(self._paused_until, now + retry_after)
+            if congested:
+                self.congestions += 1
+                if now - self._last_decrease >= self.cooldown:
+                    self._last_decrease = now
+                    self.slow_start = False
+                    self.decreases += 1
+                    self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+                    self.in_flight_limit = max(
+                        self.min_in_flight, self.in_flight_limit * self.decrease_factor
+                    )
+            elif self.slow_start:
+                self.rate = min(self.max_rate, self.rate + self.increase)
+                self.in_flight_limit = min(
+                    self.max_in_flight, self.in_flight_limit + self.increase
+                )
+            else:
+                # Additive increase: about +increase for every limit-worth of successful requests
+                self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+                self.in_flight_limit = min(
+                    self.max_in_flight,
+                    self.in_flight_limit + self.increase / self.in_flight_limit,
+                )
+            self._condition.notify_all()
+
+    @property
+    def stats(self) -> dict[str, float]:
+        """
+        Return current limits and counters.
+        """
+        with self._condition:
+            return dict(
+                rate=self.rate,
+                in_flight_limit=int(self.in_flight_limit),
+                in_flight=self.in_flight,
+                requests=self.requests,
+                congestions=self.congestions,
+                decreases=self.decreases,
+                slow_start=self.slow_start,
+            )
+
+    def __getstate__(self) -> dict[str, Any]:
+        state = self.__dict__.copy()
+        for k in (
+            '_condition',
+            '_next_slot',
+            '_paused_until',
+            '_last_decrease',
+            '_pid',
+        ):
+            state.pop(k)
+        state['in_flight'] = 0
+        return state
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._setup()
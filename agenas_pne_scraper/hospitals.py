@@ -2,9 +2,17 @@ from collections import namedtuple
 import numpy as np
 import os
 import pandas as pd
+from threading import Lock
 from typing import Optional
 from warnings import warn
 
+from .utils import get_cache_dir
+
+try:
+    import pyarrow
+except ImportError:  # pyarrow is optional, without it the hospitals cache is pickled
+    pyarrow = None
+
 
 HospitalURL = namedtuple("HospitalURL", ["mm_yyyy", "url"])
 
@@ -125,6 +133,7 @@ def load_hospital_sources_df() -> pd.DataFrame:
 
 
 def _load_cached_df(hospital_sources_df: pd.DataFrame) -> Optional[pd.DataFrame]:
+    # Legacy CSV cache, written next to the package by previous versions
     if "hospitals_cached.csv" in os.listdir(_current_path):
         df = pd.read_csv(
             os.path.join(_current_path, "hospitals_cached.csv"),
@@ -140,33 +149,16 @@ def _load_cached_df(hospital_sources_df: pd.DataFrame) -> Optional[pd.DataFrame]
                 pass
 
 
-def _download_hospitals_df(
-    hospital_sources_df: pd.DataFrame, save_cache: bool = True
-) -> pd.DataFrame:
+def _download_hospitals_df(hospital_sources_df: pd.DataFrame) -> pd.DataFrame:
     url = hospital_sources_df.url.iloc[0]
     df = pd.read_excel(url, skiprows=[0], dtype=excel_columns_dtypes)
     df = df.rename(columns=hospital_source_excel_columns_mapper)
     df["codice_regione"] = df.codice_regione.str[0:2].astype(int)
     df["data_up_to"] = hospital_sources_df.data_up_to.iloc[0]
-    if save_cache:
-        df.to_csv(os.path.join(_current_path, "hospitals_cached.csv"), index=False)
     return df
 
 
-def get_hospitals_df() -> pd.DataFrame:
-    hospital_sources_df = load_hospital_sources_df()
-    try:
-        hospitals_df = _load_cached_df(hospital_sources_df=hospital_sources_df)
-    except Exception as e:
-        warn(f'Error while trying to load cached hospitals_df: "{e}"')
-        hospitals_df = None
-    if hospitals_df is None:
-        hospitals_df = _download_hospitals_df(hospital_sources_df=hospital_sources_df)
-    return hospitals_df
-
-
-def get_hospital_id_hospital_name_hospitals_df() -> pd.DataFrame:
-    hospitals_df = get_hospitals_df()
+def _to_hospital_id_hospital_name_df(hospitals_df: pd.DataFrame) -> pd.DataFrame:
     df = pd.concat(
         [
             hospitals_df.codice_struttura.str.cat(
@@ -183,3 +175,161 @@ def get_hospital_id_hospital_name_hospitals_df() -> pd.DataFrame:
             "There are duplicated values in hospitals_df, correct df before proceeding!"
         )
     return df
+
+
+class HospitalRegistry:
+    """
+    In-process registry of the hospitals published by the Ministry of Health. hospitals_df is loaded once and memoized, from the fastest source available: a binary cache in cache_dir (Parquet if pyarrow is installed, pickle otherwise), the legacy CSV cache or, as a last resort, the ministry xlsx. Binary cache is (re)written whenever the df is loaded from a slower source; if cache_dir is not writable a warning is issued and the registry keeps working from memory.
+    Keyword args:
+        - cache_dir [str | None], _default=None_, directory of the binary cache. If None, the package cache dir (see utils.get_cache_dir) is used.
+    """
+
+    def __init__(self, cache_dir: Optional[str] = None) -> None:
+        self.cache_dir = cache_dir if cache_dir is not None else get_cache_dir()
+        self._lock = Lock()
+        self._hospitals_df = None
+        self._hospital_id_hospital_name_df = None
+        # hospital_id -> position in hospitals_df and hospital_id -> hospital_name
+        self._index = None
+        self._names = None
+
+    def _cache_path(self, hospital_sources_df: pd.DataFrame) -> str:
+        data_up_to = hospital_sources_df.data_up_to.iloc[0].strftime("%m_%Y")
+        extension = "parquet" if pyarrow is not None else "pkl"
+        return os.path.join(self.cache_dir, f"hospitals_{data_up_to}.{extension}")
+
+    @staticmethod
+    def _read_binary_cache(path: str) -> Optional[pd.DataFrame]:
+        if not os.path.exists(path):
+            return
+        if path.endswith(".parquet"):
+            df = pd.read_parquet(path)
+        else:
+            df = pd.read_pickle(path)
+        df[hospitals_df_columns]
+        return df
+
+    @staticmethod
+    def _write_binary_cache(df: pd.DataFrame, path: str) -> None:
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if path.endswith(".parquet"):
+                df.to_parquet(tmp_path, index=False)
+            else:
+                df.to_pickle(tmp_path)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            # The cache is best effort: serialization errors (e.g. pyarrow's on mixed-type columns) are reported like filesystem ones
+            warn(f'Could not write hospitals cache "{path}": "{e}"')
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def _load(self) -> pd.DataFrame:
+        hospital_sources_df = load_hospital_sources_df()
+        path = self._cache_path(hospital_sources_df)
+        try:
+            df = self._read_binary_cache(path)
+        except Exception as e:
+            warn(f'Error while trying to load cached hospitals_df: "{e}"')
+            df = None
+        if df is not None:
+            return df
+        try:
+            df = _load_cached_df(hospital_sources_df=hospital_sources_df)
+        except Exception as e:
+            warn(f'Error while trying to load cached hospitals_df: "{e}"')
+            df = None
+        if df is None:
+            df = _download_hospitals_df(hospital_sources_df=hospital_sources_df)
+        self._write_binary_cache(df, path)
+        return df
+
+    @property
+    def hospitals_df(self) -> pd.DataFrame:
+        """
+        Memoized hospitals df. Don't modify it in place, get_hospitals_df returns a copy.
+        """
+        if self._hospitals_df is None:
+            with self._lock:
+                if self._hospitals_df is None:
+                    self._hospitals_df = self._load()
+        return self._hospitals_df
+
+    @property
+    def hospital_id_hospital_name_df(self) -> pd.DataFrame:
+        """
+        Memoized df with hospital_id and hospital_name columns. Don't modify it in place, get_hospital_id_hospital_name_hospitals_df returns a copy.
+        """
+        self._ensure_loaded()
+        return self._hospital_id_hospital_name_df
+
+    def _ensure_loaded(self) -> None:
+        # Load hospitals_df and build hospital_id_hospital_name_df and the lookup dicts, if not done yet
+        if self._hospital_id_hospital_name_df is None:
+            df = _to_hospital_id_hospital_name_df(self.hospitals_df)
+            with self._lock:
+                self._index = dict(zip(df.hospital_id, range(len(df))))
+                self._names = dict(zip(df.hospital_id, df.hospital_name))
+                self._hospital_id_hospital_name_df = df
+
+    def _position(self, hospital_id: str) -> Optional[int]:
+        self._ensure_loaded()
+        return self._index.get(hospital_id)
+
+    def get(self, hospital_id: str) -> Optional[pd.Series]:
+        """
+        Return the hospitals_df row of hospital_id, or None if it's unknown.
+        """
+        position = self._position(hospital_id)
+        if position is not None:
+            return self.hospitals_df.iloc[position]
+
+    def hospital_name(self, hospital_id: str) -> Optional[str]:
+        """
+        Return the name of hospital_id, or None if it's unknown.
+        """
+        self._ensure_loaded()
+        return self._names.get(hospital_id)
+
+    def __contains__(self, hospital_id: str) -> bool:
+        return self._position(hospital_id) is not None
+
+    def __len__(self) -> int:
+        return len(self.hospital_id_hospital_name_df)
+
+    def refresh(self) -> None:
+        """
+        Forget the memoized dfs, they'll be loaded again on next access.
+        """
+        with self._lock:
+            self._hospitals_df = None
+            self._hospital_id_hospital_name_df = None
+            self._index = None
+            self._names = None
+
+
+_default_registry = None
+_default_registry_lock = Lock()
+
+
+def get_hospital_registry() -> HospitalRegistry:
+    """
+    Return the process-wide HospitalRegistry, created on first use.
+    """
+    global _default_registry
+    if _default_registry is None:
+        with _default_registry_lock:
+            if _default_registry is None:
+                _default_registry = HospitalRegistry()
+    return _default_registry
+
+
+def get_hospitals_df() -> pd.DataFrame:
+    return get_hospital_registry().hospitals_df.copy()
+
+
+def get_hospital_id_hospital_name_hospitals_df() -> pd.DataFrame:
+    return get_hospital_registry().hospital_id_hospital_name_df.copy()
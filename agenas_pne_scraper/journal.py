@@ -0,0 +1,210 @@
+import os
+import pandas as pd
+import pickle
+import sqlite3
+from threading import Lock
+from time import time
+from typing import Any, Optional
+
+from .utils import get_cache_dir
+
+
+class CrawlJournal:
+    """
+    Append-only journal of the work units completed by a crawl, stored in a SQLite file together with their parsed df. A crawl restarted with the same job_id loads completed units from the journal and downloads only the rest.
+    Units whose deadline passed (see crawl unit_timeout and deadline) are recorded as deferred until they complete.
+    A work unit is identified by stage ("table" or "graph"), kind ("volume", "outcome" or "wt"), year of the crawl, hospital_code and, for graphs, indicator_id: a job_id reused for another year doesn't serve the units of the previous one.
+    Keyword args:
+        - job_id [str], identifier of the crawl, e.g. "pne-2021".
+        - path [str | None], _default=None_, SQLite file to use. If None, journal.sqlite in the package cache dir (see utils.get_cache_dir) is used.
+    """
+
+    def __init__(self, job_id: str, path: Optional[str] = None) -> None:
+        if path is None:
+            path = os.path.join(get_cache_dir(), 'journal.sqlite')
+        self.job_id = job_id
+        self.path = path
+        self._setup()
+
+    def _setup(self) -> None:
+        self._lock = Lock()
+        self._connection = None
+        self._pid = None
+
+    def _get_connection(self) -> sqlite3.Connection:
+        if self._connection is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            # Units of journals written before year was part of the key stay in the units table, which is not read anymore
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS crawl_units ('
+                'job_id TEXT, stage TEXT, kind TEXT, year INTEGER, hospital_code TEXT, '
+                "indicator_id TEXT DEFAULT '', completed_at REAL, frame BLOB, "
+                'PRIMARY KEY (job_id, stage, kind, year, hospital_code, indicator_id))'
+            )
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS deferred_crawl_units ('
+                'job_id TEXT, stage TEXT, kind TEXT, year INTEGER, hospital_code TEXT, '
+                "indicator_id TEXT DEFAULT '', deferred_at REAL, "
+                'PRIMARY KEY (job_id, stage, kind, year, hospital_code, indicator_id))'
+            )
+            connection.commit()
+            self._connection = connection
+            self._pid = os.getpid()
+        return self._connection
+
+    @staticmethod
+    def _indicator_key(indicator_id: Any) -> str:
+        return '' if indicator_id is None else str(int(indicator_id))
+
+    def record(
+        self,
+        stage: str,
+        kind: str,
+        year: int,
+        hospital_code: str,
+        df: pd.DataFrame,
+        indicator_id: Any = None,
+    ) -> None:
+        """
+        Record a completed work unit and its parsed df.
+        """
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute(
+                'INSERT OR IGNORE INTO crawl_units VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (
+                    self.job_id,
+                    stage,
+                    kind,
+                    year,
+                    hospital_code,
+                    self._indicator_key(indicator_id),
+                    time(),
+                    pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL),
+                ),
+            )
+            connection.execute(
+                'DELETE FROM deferred_crawl_units WHERE job_id = ? AND stage = ? AND kind = ? '
+                'AND year = ? AND hospital_code = ? AND indicator_id = ?',
+                (
+                    self.job_id,
+                    stage,
+                    kind,
+                    year,
+                    hospital_code,
+                    self._indicator_key(indicator_id),
+                ),
+            )
+            connection.commit()
+
+    def defer(
+        self,
+        stage: str,
+        kind: str,
+        year: int,
+        hospital_code: str,
+        indicator_id: Any = None,
+    ) -> None:
+        """
+        Record a work unit that was deferred because its deadline passed. It stays deferred until it's recorded as completed.
+        """
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute(
+                'INSERT OR REPLACE INTO deferred_crawl_units VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (
+                    self.job_id,
+                    stage,
+                    kind,
+                    year,
+                    hospital_code,
+                    self._indicator_key(indicator_id),
+                    time(),
+                ),
+            )
+            connection.commit()
+
+    def deferred(
+        self, stage: Optional[str] = None
+    ) -> list[tuple[str, str, int, str, Optional[int]]]:
+        """
+        Return the deferred work units, optionally only of a stage, as (stage, kind, year, hospital_code, indicator_id) tuples.
+        """
+        query = (
+            'SELECT stage, kind, year, hospital_code, indicator_id '
+            'FROM deferred_crawl_units WHERE job_id = ?'
+        )
+        params = [self.job_id]
+        if stage is not None:
+            query += ' AND stage = ?'
+            params.append(stage)
+        with self._lock:
+            rows = self._get_connection().execute(query, params).fetchall()
+        return [
+            (
+                stage,
+                kind,
+                year,
+                hospital_code,
+                int(indicator_id) if indicator_id else None,
+            )
+            for stage, kind, year, hospital_code, indicator_id in rows
+        ]
+
+    def completed(
+        self, stage: str, kind: str, year: int
+    ) -> dict[tuple[str, Optional[int]], pd.DataFrame]:
+        """
+        Return the dfs of the completed work units of a stage, kind and year, keyed by (hospital_code, indicator_id). indicator_id is None for tables.
+        """
+        with self._lock:
+            rows = (
+                self._get_connection()
+                .execute(
+                    'SELECT hospital_code, indicator_id, frame FROM crawl_units '
+                    'WHERE job_id = ? AND stage = ? AND kind = ? AND year = ?',
+                    (self.job_id, stage, kind, year),
+                )
+                .fetchall()
+            )
+        return {
+            (hospital_code, int(indicator_id) if indicator_id else None): pickle.loads(
+                frame
+            )
+            for hospital_code, indicator_id, frame in rows
+        }
+
+    def n_completed(self, stage: Optional[str] = None) -> int:
+        """
+        Return the number of completed work units, optionally only of a stage.
+        """
+        query = 'SELECT COUNT(*) FROM crawl_units WHERE job_id = ?'
+        params = [self.job_id]
+        if stage is not None:
+            query += ' AND stage = ?'
+            params.append(stage)
+        with self._lock:
+            return self._get_connection().execute(query, params).fetchone()[0]
+
+    def reset(self) -> None:
+        """
+        Forget every completed and deferred work unit of the job.
+        """
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute(
+                'DELETE FROM crawl_units WHERE job_id = ?', (self.job_id,)
+            )
+            connection.execute(
+                'DELETE FROM deferred_crawl_units WHERE job_id = ?', (self.job_id,)
+            )
+            connection.commit()
+
+    def __getstate__(self) -> dict[str, Any]:
+        return dict(job_id=self.job_id, path=self.path)
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._setup()
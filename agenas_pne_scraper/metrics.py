@@ -0,0 +1,262 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from inspect import iscoroutinefunction
+from threading import Lock
+from time import perf_counter
+from typing import Any, Callable, Iterator, Optional
+
+# Upper bounds (in seconds) of the buckets of phase timings
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_descriptions = {
+    'pne_requests_total': 'Requests sent to the server (every retry counts), by status code. Status is "error" if no response was received.',
+    'pne_served_total': 'Requests answered without reaching the server, by source: cache (ResponseCache) or coalesced (response of an identical request, see SingleFlight).',
+    'pne_response_bytes_total': 'Bytes of the response bodies received from the server.',
+    'pne_retries_total': 'Requests retried by utils.retry.',
+    'pne_failures_total': 'Downloads given up after every retry failed.',
+    'pne_deferred_total': 'Downloads deferred because their deadline passed (see deadline.deadline_scope).',
+    'pne_phase_seconds': 'Time spent in every phase: request (whole request sent to the server, including rate limiting), server (connect, send and wait until response headers), transfer (request minus server: body download and queueing), table (walking the table of a page), json (decoding graph JSON), postprocess (pandas processing of the parsed df).',
+}
+
+
+class Metrics:
+    """
+    Thread-safe registry of the counters and timings recorded by downloaders, aggregated by downloader class. Aggregates can be pulled as a dict (Metrics.to_dict) or in Prometheus text exposition format (Metrics.to_prometheus).
+    Every observation is also passed to the hooks added with Metrics.add_hook, as hook(name, labels, value).
+    """
+
+    def __init__(self) -> None:
+        self.enabled = True
+        self._lock = Lock()
+        self._hooks = []
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Forget every recorded value.
+        """
+        with self._lock:
+            # name -> labels (sorted tuple of (key, value)) -> value
+            self._counters: dict[str, dict[tuple, float]] = {}
+            # labels -> [count, sum, max, bucket counts]
+            self._timings: dict[tuple, list] = {}
+
+    def add_hook(self, hook: Callable[[str, dict[str, str], float], None]) -> None:
+        self._hooks.append(hook)
+
+    def remove_hook(self, hook: Callable[[str, dict[str, str], float], None]) -> None:
+        self._hooks.remove(hook)
+
+    def _call_hooks(self, name: str, labels: dict[str, str], value: float) -> None:
+        for hook in self._hooks:
+            hook(name, labels, value)
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        """
+        Increase counter name with labels by value.
+        """
+        if not self.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counter = self._counters.setdefault(name, {})
+            counter[key] = counter.get(key, 0) + value
+        self._call_hooks(name, labels, value)
+
+    def observe(self, seconds: float, **labels: str) -> None:
+        """
+        Record a timing of pne_phase_seconds with labels (downloader and phase).
+        """
+        if not self.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            timing = self._timings.get(key)
+            if timing is None:
+                timing = self._timings[key] = [0, 0.0, 0.0, [0] * len(BUCKETS)]
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+            i = bisect_left(BUCKETS, seconds)
+            if i < len(BUCKETS):
+                timing[3][i] += 1
+        self._call_hooks('pne_phase_seconds', labels, seconds)
+
+    @contextmanager
+    def timer(self, downloader: Any, phase: str) -> Iterator[None]:
+        """
+        Context manager that records the time spent in its block as phase of downloader (an instance or a class).
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(
+                perf_counter() - start, downloader=_class_name(downloader), phase=phase
+            )
+
+    def to_dict(self) -> dict[str, Any]:
+        """
+        Return the aggregates: counters as {name: {downloader: {label: value}}} and timings as {"pne_phase_seconds": {downloader: {phase: {count, sum, mean, max}}}}.
+        """
+        ret = {}
+        with self._lock:
+            for name, counter in self._counters.items():
+                for key, value in counter.items():
+                    labels = dict(key)
+                    downloader = labels.pop('downloader', '')
+                    d = ret.setdefault(name, {}).setdefault(downloader, {})
+                    label = '/'.join(labels.values()) or 'total'
+                    d[label] = d.get(label, 0) + value
+            for key, (count, total, maximum, _) in self._timings.items():
+                labels = dict(key)
+                ret.setdefault('pne_phase_seconds', {}).setdefault(
+                    labels['downloader'], {}
+                )[labels['phase']] = dict(
+                    count=count, sum=total, mean=total / count, max=maximum
+                )
+        return ret
+
+    def to_prometheus(self) -> str:
+        """
+        Return the aggregates in Prometheus text exposition format.
+        """
+
+        def format_labels(key: tuple, extra: tuple = ()) -> str:
+            labels = ','.join(f'{k}="{_escape(v)}"' for k, v in key + extra)
+            return '{' + labels + '}' if labels else ''
+
+        lines = []
+        with self._lock:
+            for name, counter in sorted(self._counters.items()):
+                lines.append(f'# HELP {name} {_descriptions.get(name, name)}')
+                lines.append(f'# TYPE {name} counter')
+                for key, value in sorted(counter.items()):
+                    lines.append(f'{name}{format_labels(key)} {value:g}')
+            if self._timings:
+                name = 'pne_phase_seconds'
+                lines.append(f'# HELP {name} {_descriptions[name]}')
+                lines.append(f'# TYPE {name} histogram')
+                for key, (count, total, _, buckets) in sorted(self._timings.items()):
+                    cumulative = 0
+                    for upper, n in zip(BUCKETS, buckets):
+                        cumulative += n
+                        labels = format_labels(key, (('le', f'{upper:g}'),))
+                        lines.append(f'{name}_bucket{labels} {cumulative}')
+                    labels = format_labels(key, (('le', '+Inf'),))
+                    lines.append(f'{name}_bucket{labels} {count}')
+                    lines.append(f'{name}_sum{format_labels(key)} {total:g}')
+                    lines.append(f'{name}_count{format_labels(key)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _class_name(downloader: Any) -> str:
+    return (downloader if isinstance(downloader, type) else type(downloader)).__name__
+
+
+def _labels(downloader: Any, url_attr: str) -> tuple[str, str]:
+    return _class_name(downloader), getattr(downloader, url_attr).rpartition('/')[2]
+
+
+_metrics = Metrics()
+
+# (downloader class name, endpoint) of the instrument_request method running in the current context, None outside of them
+_request_labels = ContextVar('pne_request_labels', default=None)
+
+
+def get_metrics() -> Metrics:
+    """
+    Return the process-wide Metrics every downloader records to.
+    """
+    return _metrics
+
+
+def observe_send(start: float, r: Optional[Any]) -> None:
+    """
+    Record a request that reached the server, started at start (a perf_counter() time, before rate limiting) and answered by r (None if no response was received): status code, bytes and phase timings, labelled like the instrument_request method running in the current context. Requests made outside of those methods are not recorded.
+    """
+    labels = _request_labels.get()
+    metrics = get_metrics()
+    if labels is None or not metrics.enabled:
+        return
+    elapsed = perf_counter() - start
+    name, endpoint = labels
+    status = str(r.status_code) if r is not None else 'error'
+    metrics.inc('pne_requests_total', downloader=name, endpoint=endpoint, status=status)
+    metrics.observe(elapsed, downloader=name, phase='request')
+    if r is not None:
+        metrics.inc(
+            'pne_response_bytes_total',
+            len(r.content or b''),
+            downloader=name,
+            endpoint=endpoint,
+        )
+        server = r.elapsed.total_seconds()
+        metrics.observe(server, downloader=name, phase='server')
+        metrics.observe(max(0.0, elapsed - server), downloader=name, phase='transfer')
+
+
+def count_served(source: str) -> None:
+    """
+    Count a request answered without reaching the server in pne_served_total, labelled like the instrument_request method running in the current context. source is "cache" (served by ResponseCache) or "coalesced" (response of an identical request, see SingleFlight).
+    """
+    labels = _request_labels.get()
+    if labels is not None:
+        name, endpoint = labels
+        get_metrics().inc(
+            'pne_served_total', downloader=name, endpoint=endpoint, source=source
+        )
+
+
+def instrument_request(url_attr: str = 'relative_url') -> Callable:
+    """
+    Decorator of the downloader methods making a single request (e.g. _request and _arequest), to be applied below utils.retry so that every try is recorded. The requests they make through PNESession are labelled with the downloader class and the endpoint in self.<url_attr>: those that reach the server are recorded by observe_send, those served by the cache or coalesced with an identical request by count_served. Coroutine functions are supported too.
+    """
+
+    def decorator(func: Callable) -> Callable:
+        @wraps(func)
+        def wrapper(self, *args, **kwargs) -> Any:
+            token = _request_labels.set(_labels(self, url_attr))
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                _request_labels.reset(token)
+
+        @wraps(func)
+        async def async_wrapper(self, *args, **kwargs) -> Any:
+            token = _request_labels.set(_labels(self, url_attr))
+            try:
+                return await func(self, *args, **kwargs)
+            finally:
+                _request_labels.reset(token)
+
+        return async_wrapper if iscoroutinefunction(func) else wrapper
+
+    return decorator
+
+
+def count_retry(e: Exception, downloader: Any, *args, **kwargs) -> None:
+    """
+    on_retry callback of utils.retry for downloader methods: count the retry in pne_retries_total.
+    """
+    get_metrics().inc('pne_retries_total', downloader=_class_name(downloader))
+
+
+def count_failure(downloader: Any) -> None:
+    """
+    Count a download that was given up in pne_failures_total.
+    """
+    get_metrics().inc('pne_failures_total', downloader=_class_name(downloader))
+
+
+def count_deferred(downloader: Any) -> None:
+    """
+    Count a download that was deferred in pne_deferred_total.
+    """
+    get_metrics().inc('pne_deferred_total', downloader=_class_name(downloader))
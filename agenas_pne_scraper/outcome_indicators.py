@@ -0,0 +1,562 @@
+from bs4 import Tag
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from functools import partial
+import numpy as np
+import pandas as pd
+import requests
+from typing import Any, Callable, Iterable, Iterator, Optional
+
+from .exceptions import ErrorStatusCodeException
+from .metrics import count_retry, get_metrics, instrument_request
+from .parsers import LxmlTag, convert_columns, get_table_parser
+from .transport import PNESession
+from .utils import (
+    display,
+    gather_or_raise,
+    get_indicator_id,
+    retry,
+    run_concurrently,
+)
+from .PNEGraphsDownloader import PNEGraphsDownloader
+from .PNETableDownloader import PNETableDownloader
+
+
+class PNEOutcomeGraphsDownloader(PNEGraphsDownloader):
+    relative_url = 'strutture/grafico1Str1_HC_json.php'
+    relative_url_ci = 'strutture/grafico1Str1_IC_HC_json.php'
+
+    table_columns = [
+        'anno',
+        'dati',
+        'ci95_lower',
+        'ci95_lower',
+    ]
+
+    results_columns = [
+        'hospital_code',
+        'indicator_id',
+        'indicator_type',
+        'year',
+        'value',
+        'ci95_lower',
+        'ci95_upper',
+    ]
+
+    def generate_querystring_dict(self, **kwargs) -> dict[str, str]:
+        return dict(cod_struttura=self.hospital_code, ind=self.indicator_id, **kwargs)
+
+    def process_results_df(self, df: pd.DataFrame) -> pd.DataFrame:
+        df = df.rename(columns={'anno': 'year', 'dati': 'value'})
+        df['indicator_type'] = 'outcome'
+        return df
+
+    @retry(
+        ErrorStatusCodeException,
+        10,
+        1,
+        backoff=2,
+        max_delay_seconds=30,
+        jitter=True,
+        on_retry=count_retry,
+    )
+    @instrument_request('relative_url_ci')
+    def _request_ci(self, **kwargs) -> requests.Response:
+        return self.session.get(
+            self.BASE_URL + self.relative_url_ci,
+            params=self.generate_querystring_dict(**kwargs),
+        )
+
+    @retry(
+        ErrorStatusCodeException,
+        10,
+        1,
+        backoff=2,
+        max_delay_seconds=30,
+        jitter=True,
+        on_retry=count_retry,
+    )
+    @instrument_request('relative_url_ci')
+    async def _arequest_ci(self, **kwargs) -> requests.Response:
+        return await self.session.aget(
+            self.BASE_URL + self.relative_url_ci,
+            params=self.generate_querystring_dict(**kwargs),
+        )
+
+    def _convert_response_to_df(
+        self, r: requests.Response, r_ci: requests.Response
+    ) -> pd.DataFrame:
+        df = self._adapt_json_to_df(r.json())
+        df[['ci95_upper', 'ci95_lower']] = pd.DataFrame(r_ci.json())
+        return df
+
+    def _convert_response_to_columns(
+        self, r: requests.Response, r_ci: requests.Response
+    ) -> dict[str, list]:
+        columns = self._adapt_json_to_columns(r.json())
+        # Like the df assignment in _convert_response_to_df, CI rows are aligned to graph rows
+        n = max(map(len, columns.values()), default=0)
+        ci_rows = [
+            list(row.values()) if isinstance(row, dict) else list(row)
+            for row in r_ci.json()[:n]
+        ]
+        ci_rows += [[None, None]] * (n - len(ci_rows))
+        columns['ci95_upper'] = [row[0] for row in ci_rows]
+        columns['ci95_lower'] = [row[1] for row in ci_rows]
+        return columns
+
+    def _result_key(self, **kwargs) -> tuple:
+        return super()._result_key(**kwargs) + (self.BASE_URL + self.relative_url_ci,)
+
+    def _fetch(self, **kwargs) -> Optional[tuple[requests.Response, ...]]:
+        try:
+            # Value and CI requests are independent, so they are made concurrently
+            r, r_ci = run_concurrently(
+                partial(self._request, **kwargs), partial(self._request_ci, **kwargs)
+            )
+            return r, r_ci
+        except ErrorStatusCodeException as e:
+            self._report_error(e)
+
+    async def _afetch(self, **kwargs) -> Optional[tuple[requests.Response, ...]]:
+        try:
+            r, r_ci = await gather_or_raise(
+                self._arequest(**kwargs), self._arequest_ci(**kwargs)
+            )
+            return r, r_ci
+        except ErrorStatusCodeException as e:
+            self._report_error(e)
+
+
+_reg_columns_renamer = {
+    'hospital_code': 'hospital_code',
+    'year': 'year',
+    'indicator_id': 'indicator_id',
+    'description': 'description',
+    'population': 'population',
+    'pct_value': 'pct_value',
+    'adj_pct_value': 'adj_pct_value',
+    'adj_RR': 'reg_adj_RR',
+    'p_value': 'reg_p_value',
+}
+
+_prec_columns_renamer = {
+    'hospital_code': 'hospital_code',
+    'year': 'year',
+    'indicator_id': 'indicator_id',
+    'description': 'description',
+    'population': 'population',
+    'pct_value': 'prec_pct_value',
+    'adj_pct_value': 'prec_adj_pct_value',
+    'adj_RR': 'prec_adj_RR',
+    'p_value': 'prec_p_value',
+}
+
+_results_columns = [
+    'hospital_code',
+    'year',
+    'indicator_id',
+    'indicator_type',
+    'description',
+    'population',
+    'cases',
+    'pct_value',
+    'adj_pct_value',
+    'adj_RR',
+    'p_value',
+    'reg_adj_RR',
+    'reg_p_value',
+    'prec_adj_RR',
+    'prec_p_value',
+]
+
+
+# indicator_id -> description of indicators whose description is equal to the one of another indicator
+_problematic_descriptions = {
+    555: "Proporzione di interventi per tumore maligno della mammella eseguiti in reparti con volume di attivita' superiore a 135 interventi annui (v1)",
+    556: "Proporzione di interventi per tumore maligno della mammella eseguiti in reparti con volume di attivita' superiore a 135 interventi annui (v2)",
+    998: "Proporzione di colecistectomie eseguite in reparti con volume di attivita' superiore a 90 interventi annui (v1)",
+    999: "Proporzione di colecistectomie eseguite in reparti con volume di attivita' superiore a 90 interventi annui (v2)",
+}
+
+
+class PNEOutcomeIndicatorsDownloader(PNETableDownloader):
+    reg_columns_renamer = _reg_columns_renamer
+
+    prec_columns_renamer = _prec_columns_renamer
+
+    results_columns = _results_columns
+
+    table_columns = [
+        'description',
+        'population',
+        'pct_value',
+        'adj_pct_value',
+        'adj_RR',
+        'p_value',
+        'indicator_id',
+        'operator',
+    ]
+
+    table_columns_spec = {
+        'description': 'str',
+        'population': 'int',
+        'pct_value': 'float',
+        'adj_pct_value': 'float',
+        'adj_RR': 'float',
+        'p_value': 'float',
+        'indicator_id': 'indicator_id',
+        'operator': None,
+    }
+
+    relative_url = 'strutture/stru_indicatori.php'
+
+    def generate_querystring_dict(self, compare: str) -> dict[str, str]:
+        # compare must be "reg" for comparison with regional benchmark or prec for comparison with previous year
+        assert compare in set(['reg', 'prec'])
+        return dict(cod_struttura=self.hospital_code, conf=compare)
+
+    def transform_td(self, td: Tag, index: int) -> Any:
+        if index == 0:
+            return td.text.strip() or None
+        elif index == 1:
+            try:
+                return int(td.text.strip())
+            except ValueError:
+                pass
+        elif index in set([2, 3, 4, 5]):
+            try:
+                return np.float64(td.text.strip())
+            except ValueError:
+                pass
+        elif index == 6:
+            a = td.find('a')
+            if a is not None and 'href' in a.attrs:
+                return get_indicator_id(a.attrs['href'])
+
+    def process_ultimate_results_df(self, df: pd.DataFrame) -> pd.DataFrame:
+        df['cases'] = (df.pct_value / 100 * df.population).round(0)
+        df['indicator_type'] = 'outcome'
+        return df
+
+    def process_results_df(self, df: pd.DataFrame) -> pd.DataFrame:
+        df = df.drop(['operator'], axis=1)
+        try:
+            df.population = df.population.astype(int)
+            # At this point df is not compare-oriented, columns are equals in both compare settings
+            return df.copy()
+        except Exception:
+            display(df)
+            print('error while processing volume df')
+            return
+
+    @staticmethod
+    def rename_problematic_indicators(df: pd.DataFrame) -> pd.DataFrame:
+        # Indicators 555 and 556 (998 and 999) have the same description, so they get a (v1) and (v2) suffix, see _problematic_descriptions
+        descriptions = df.indicator_id.map(_problematic_descriptions)
+        problematic = descriptions.notna()
+        if problematic.any():
+            df.loc[problematic, 'description'] = descriptions[problematic]
+        return df
+
+    def _fetch(
+        self, compare: str = 'both', **kwargs
+    ) -> dict[str, Optional[requests.Response]]:
+        """
+        Make one request for every compare setting needed and return the responses in a dict keyed by compare ("reg" and/or "prec").
+        """
+        assert compare in set(['both', 'reg', 'prec'])
+        compares = ['reg', 'prec'] if compare == 'both' else [compare]
+        # With compare="both" the reg and prec pages are requested concurrently
+        fetched = run_concurrently(
+            *(partial(PNETableDownloader._fetch, self, compare=c) for c in compares)
+        )
+        return dict(zip(compares, fetched))
+
+    async def _afetch(
+        self, compare: str = 'both', **kwargs
+    ) -> dict[str, Optional[requests.Response]]:
+        """
+        Awaitable version of self._fetch.
+        """
+        assert compare in set(['both', 'reg', 'prec'])
+        compares = ['reg', 'prec'] if compare == 'both' else [compare]
+        fetched = await gather_or_raise(
+            *(PNETableDownloader._afetch(self, compare=c) for c in compares)
+        )
+        return dict(zip(compares, fetched))
+
+    def _parse(self, responses: dict[str, Optional[requests.Response]]) -> pd.DataFrame:
+        if any(r is None for r in responses.values()):
+            # A request kept failing or was deferred (its error was reported by _fetch): an empty df, like other downloaders, instead of merging a partial page
+            return pd.DataFrame([], columns=self.results_columns)
+        compare = 'both' if len(responses) == 2 else next(iter(responses))
+        if compare == 'both' or compare == 'reg':
+            # Intermediate dfs keep default dtypes, the merged df is compacted at the end
+            reg_df = super()._parse(responses['reg'], compact=False)
+            # returned cols: 'description', 'value', 'pct_value', 'adj_pct_value', 'adj_RR', 'p_value', 'indicator_id', 'year', 'hospital_code'
+            reg_df = reg_df.rename(columns=self.reg_columns_renamer)
+            # changed columns names
+            reg_df = self.rename_problematic_indicators(reg_df)
+
+        if compare == 'both' or compare == 'prec':
+            prec_df = super()._parse(
+                responses['prec'], compact=False
+            )  # remember that this calls also self.process_results_df
+            # returned cols: 'description', 'value', 'pct_value', 'adj_pct_value', 'adj_RR', 'p_value', 'indicator_id', 'year', 'hospital_code'
+            prec_df = prec_df.rename(columns=self.prec_columns_renamer)
+            # changed columns names
+            prec_df = self.rename_problematic_indicators(prec_df)
+
+        metrics = get_metrics()
+        with metrics.timer(self, 'postprocess'):
+            if compare == 'both':
+                if prec_df is None:
+                    prec_df = pd.DataFrame([], columns=self.reg_columns_renamer)
+                prec_df = prec_df.rename(columns={'indicator_id': 'indicator_id_prec'})
+                prec_df = prec_df.drop(
+                    ['population', 'prec_pct_value', 'prec_adj_pct_value'], axis=1
+                )
+
+                df = pd.merge(
+                    reg_df,
+                    prec_df,
+                    how='outer',
+                    left_on=['year', 'hospital_code', 'description'],
+                    right_on=['year', 'hospital_code', 'description'],
+                )
+                df.indicator_id = df.indicator_id.fillna(df.indicator_id_prec)
+                df = df.drop(['indicator_id_prec'], axis=1)
+            elif compare == 'reg':
+                df = reg_df.copy()
+                # rename not needed as value, pct_value and adj_pct_value have no prefix like in prec_df
+            else:
+                df = prec_df.copy()
+                df = df.rename(
+                    columns={
+                        'population': 'population',
+                        'prec_pct_value': 'pct_value',
+                        'prec_adj_pct_value': 'adj_pct_value',
+                    },
+                )
+            df = self.process_ultimate_results_df(df)
+            df = self._order_columns_in_result(df)
+        return df
+
+    def _result_key(self, compare: str = 'both', **kwargs) -> tuple:
+        compares = ['reg', 'prec'] if compare == 'both' else [compare]
+        return tuple(
+            PNETableDownloader._result_key(self, compare=c, **kwargs) for c in compares
+        )
+
+    def download(self, compare: str = 'both', **kwargs) -> pd.DataFrame:
+        return self._shared_download(
+            self._result_key(compare=compare, **kwargs),
+            lambda: self._parse(self._fetch(compare=compare, **kwargs)),
+        )
+
+    async def adownload(self, compare: str = 'both', **kwargs) -> pd.DataFrame:
+        async def adownload() -> pd.DataFrame:
+            return self._parse(await self._afetch(compare=compare, **kwargs))
+
+        return await self._ashared_download(
+            self._result_key(compare=compare, **kwargs), adownload
+        )
+
+    @classmethod
+    def mapper(
+        cls,
+        year: int,
+        hospital_code: str,
+        compare: str = 'both',
+        session: Optional[PNESession] = None,
+        **kwargs,
+    ) -> pd.DataFrame:
+        assert compare in set(['both', 'reg', 'prec'])
+
+        return cls(year=year, hospital_code=hospital_code, session=session).download(
+            compare=compare, **kwargs
+        )
+
+    def _parse_tables_many(
+        self, responses: list[tuple[int, requests.Response]], units: pd.DataFrame
+    ) -> pd.DataFrame:
+        """
+        Bulk counterpart of self._parse_request_response(r, compact=False) for (position, response) pairs: rows of every table are converted into a single df, hospital_code and year are taken from the row of units at position, which is kept in the _unit column.
+        """
+        iter_table_rows = get_table_parser(self.table_parser)
+        positions = []
+
+        def iter_rows() -> Iterator[list[Tag | LxmlTag]]:
+            for position, r in responses:
+                for tds in iter_table_rows(r.content):
+                    positions.append(position)
+                    yield tds
+
+        metrics = get_metrics()
+        with metrics.timer(self, 'table'):
+            if self.coercion == 'column':
+                df = convert_columns(iter_rows(), self.table_columns_spec)
+            else:
+                data = list(map(self._process_row, iter_rows()))
+                df = pd.DataFrame(data, columns=self.table_columns)
+        with metrics.timer(self, 'postprocess'):
+            data_columns = list(df.columns)
+            df['_unit'] = positions
+            df = df.dropna(axis=0, how='all', subset=data_columns)
+            df['hospital_code'] = units.hospital_code.take(df._unit).to_numpy()
+            df['year'] = units.year.take(df._unit).to_numpy()
+            df = self.process_results_df(df)
+        return df
+
+    @classmethod
+    def _parse_many(
+        cls,
+        downloaders: list['PNEOutcomeIndicatorsDownloader'],
+        fetched: list[dict[str, Optional[requests.Response]]],
+    ) -> pd.DataFrame:
+        """
+        Bulk counterpart of self._parse: turn what _fetch returned for every downloader into a single df, equal to the concatenation of what _parse returns for each of them. Downloaders with a failed request are skipped.
+        """
+        if not downloaders:
+            return pd.DataFrame([], columns=cls.results_columns)
+        # Post-processing doesn't depend on the instance
+        downloader = downloaders[0]
+        compares = list(fetched[0])
+        units = pd.DataFrame(
+            dict(
+                hospital_code=[d.hospital_code for d in downloaders],
+                year=[d.year for d in downloaders],
+            )
+        )
+        # Downloaders whose requests failed are skipped, their errors were reported by _fetch
+        fetched = [
+            (i, responses)
+            for i, responses in enumerate(fetched)
+            if all(r is not None for r in responses.values())
+        ]
+        dfs = {
+            compare: downloader._parse_tables_many(
+                [(i, responses[compare]) for i, responses in fetched], units
+            )
+            for compare in compares
+        }
+        if 'reg' in dfs:
+            reg_df = dfs['reg'].rename(columns=downloader.reg_columns_renamer)
+            reg_df = downloader.rename_problematic_indicators(reg_df)
+        if 'prec' in dfs:
+            prec_df = dfs['prec'].rename(columns=downloader.prec_columns_renamer)
+            prec_df = downloader.rename_problematic_indicators(prec_df)
+
+        metrics = get_metrics()
+        with metrics.timer(cls, 'postprocess'):
+            if len(compares) == 2:
+                prec_df = prec_df.rename(columns={'indicator_id': 'indicator_id_prec'})
+                prec_df = prec_df.drop(
+                    ['population', 'prec_pct_value', 'prec_adj_pct_value'], axis=1
+                )
+                # year and hospital_code depend on _unit only and descriptions are factorized in sorted order, so merging on integer keys gives the rows (and order) of per-hospital merges on ['year', 'hospital_code', 'description']
+                descriptions = pd.concat(
+                    [reg_df.description, prec_df.description], ignore_index=True
+                )
+                codes, _ = pd.factorize(descriptions, sort=True, use_na_sentinel=False)
+                reg_df['_description'] = codes[: len(reg_df)]
+                prec_df['_description'] = codes[len(reg_df) :]
+                string_keys = ['year', 'hospital_code', 'description']
+                df = pd.merge(
+                    reg_df.drop(string_keys, axis=1),
+                    prec_df.drop(string_keys, axis=1),
+                    how='outer',
+                    on=['_unit', '_description'],
+                )
+                df['hospital_code'] = units.hospital_code.take(df._unit).to_numpy()
+                df['year'] = units.year.take(df._unit).to_numpy()
+                # Descriptions are taken from the first row with each code, so missing ones keep their value (None or NaN) like in the string merge
+                _, first = np.unique(codes, return_index=True)
+                df['description'] = descriptions.take(first[df._description]).set_axis(
+                    df.index
+                )
+                df.indicator_id = df.indicator_id.fillna(df.indicator_id_prec)
+                df = df.drop(['indicator_id_prec', '_description'], axis=1)
+            elif compares == ['reg']:
+                df = reg_df
+            else:
+                df = prec_df.rename(
+                    columns={
+                        'prec_pct_value': 'pct_value',
+                        'prec_adj_pct_value': 'adj_pct_value',
+                    },
+                )
+            df = downloader.process_ultimate_results_df(df)
+            df = downloader._order_columns_in_result(df)
+        return df.reset_index(drop=True)
+
+    @classmethod
+    def download_many(
+        cls,
+        year: int,
+        hospital_codes: Iterable[str],
+        compare: str = 'both',
+        workers: int = 16,
+        session: Optional[PNESession] = None,
+    ) -> pd.DataFrame:
+        """
+        Download the tables of many hospitals and return them in a single df, equal to the concatenation (with ignore_index=True, skipping empty dfs) of what mapper returns for every hospital code.
+        Requests are made concurrently by workers threads, hospitals whose requests keep failing are skipped (errors are reported like in mapper). Rows of every page are collected and post-processed once for all hospitals: a single df is built for every compare setting, renamed and fixed by rename_problematic_indicators once, and reg and prec rows are joined by a single outer merge on integer keys instead of a merge on string keys per hospital.
+        With coercion = 'cell', a column that is empty in every row of a hospital is object in its mapper df and float here, values are the same.
+        Keyword args:
+            - year [int], year the tables refer to.
+            - hospital_codes [Iterable[str]], hospital codes to download.
+            - compare [str], _default="both"_, as in mapper.
+            - workers [int], _default=16_, number of concurrent downloads.
+            - session [PNESession | None], _default=None_, session to use, if None the default one.
+        """
+        assert compare in set(['both', 'reg', 'prec'])
+        downloaders = [
+            cls(year=year, hospital_code=hospital_code, session=session)
+            for hospital_code in hospital_codes
+        ]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Requests run in the context of the caller, e.g. within its deadline_scope
+            futures = [
+                executor.submit(copy_context().run, downloader._fetch, compare=compare)
+                for downloader in downloaders
+            ]
+            fetched = [future.result() for future in futures]
+        return cls._parse_many(downloaders, fetched)
+
+    @classmethod
+    async def amapper(
+        cls,
+        year: int,
+        hospital_code: str,
+        compare: str = 'both',
+        session: Optional[PNESession] = None,
+        **kwargs,
+    ) -> pd.DataFrame:
+        assert compare in set(['both', 'reg', 'prec'])
+
+        return await cls(
+            year=year, hospital_code=hospital_code, session=session
+        ).adownload(compare=compare, **kwargs)
+
+    @classmethod
+    def generate_pandas_mapper(
+        cls,
+        year: int,
+        compare: str = 'both',
+        session: Optional[PNESession] = None,
+        **kwargs,
+    ) -> Callable:
+        assert compare in set(['both', 'reg', 'prec'])
+
+        def fn(hospital_code: str) -> pd.DataFrame:
+            return cls.mapper(
+                year=year,
+                hospital_code=hospital_code,
+                compare=compare,
+                session=session,
+                **kwargs,
+            )
+
+        return fn
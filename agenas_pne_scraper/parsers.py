@@ -0,0 +1,140 @@
+from bs4 import BeautifulSoup, Tag
+from bs4.dammit import EncodingDetector
+from lxml import etree, html
+import numpy as np
+import pandas as pd
+from typing import Any, Callable, Iterable, Iterator, Optional
+
+
+class LxmlTag:
+    """
+    Minimal wrapper of an lxml element exposing the bs4.Tag interface used by transform_td methods: text, attrs and find.
+    """
+
+    __slots__ = ('element',)
+
+    def __init__(self, element: html.HtmlElement) -> None:
+        self.element = element
+
+    @property
+    def text(self) -> str:
+        return self.element.text_content()
+
+    @property
+    def attrs(self) -> dict[str, str]:
+        return dict(self.element.attrib)
+
+    def find(self, name: str) -> Optional['LxmlTag']:
+        element = next(self.element.iterdescendants(name), None)
+        return LxmlTag(element) if element is not None else None
+
+
+def iter_table_rows_bs4(content: bytes) -> Iterator[list[Tag]]:
+    """
+    Yield the td tags of every tr of the first table in content, parsed with BeautifulSoup.
+    """
+    bs = BeautifulSoup(content, 'lxml')
+    for tr in bs.find('table').find_all('tr'):
+        yield tr.find_all('td')
+
+
+def _parse_html(content: bytes) -> html.HtmlElement:
+    # Same encoding candidates, in the same order, BeautifulSoup tries with its lxml tree builder
+    last_error = None
+    for encoding in EncodingDetector(content, is_html=True).encodings:
+        try:
+            return html.document_fromstring(
+                content, parser=html.HTMLParser(encoding=encoding)
+            )
+        except (UnicodeDecodeError, LookupError, etree.ParserError) as e:
+            last_error = e
+    raise last_error
+
+
+def iter_table_rows_lxml(content: bytes) -> Iterator[list[LxmlTag]]:
+    """
+    Yield the td elements (wrapped in LxmlTag) of every tr of the first table in content, walking the lxml tree in a single pass.
+    """
+    table = _parse_html(content).find('.//table')
+    for tr in table.iter('tr'):
+        yield [LxmlTag(td) for td in tr.iterdescendants('td')]
+
+
+TABLE_PARSERS: dict[str, Callable[[bytes], Iterator[list[Any]]]] = {
+    'bs4': iter_table_rows_bs4,
+    'lxml': iter_table_rows_lxml,
+}
+
+
+def get_table_parser(name: str) -> Callable[[bytes], Iterator[list[Any]]]:
+    try:
+        return TABLE_PARSERS[name]
+    except KeyError:
+        raise ValueError(
+            f"table_parser must be one of {list(TABLE_PARSERS)}, not '{name}'"
+        )
+
+
+def raw_cell_value(td: Tag | LxmlTag, spec: Optional[str]) -> Optional[str]:
+    """
+    Return the raw string a column spec needs from a td: the href of its first link for "indicator_id" columns, its text otherwise. None is returned for columns without spec.
+    """
+    if spec is None:
+        return
+    if spec == 'indicator_id':
+        a = td.find('a')
+        return a.attrs.get('href') if a is not None else None
+    return td.text
+
+
+def _integers(s: pd.Series) -> pd.Series:
+    # Same strings accepted by int(): optional sign and digits, surrounding whitespace is already stripped
+    s = s.astype('string')
+    s = s.where(s.str.fullmatch(r'[+-]?\d+', na=False))
+    return pd.to_numeric(s, errors='coerce').astype('Int64')
+
+
+def _convert_str(s: pd.Series) -> pd.Series:
+    s = s.str.strip()
+    return s.where(s != '', None)
+
+
+def _convert_int(s: pd.Series) -> pd.Series:
+    return _integers(s.str.strip())
+
+
+def _convert_float(s: pd.Series) -> pd.Series:
+    return pd.to_numeric(s.astype('string').str.strip(), errors='coerce').astype(
+        np.float64
+    )
+
+
+def _convert_indicator_id(s: pd.Series) -> pd.Series:
+    querystring = s.astype('string').str.rpartition('?')[2]
+    return _integers(querystring.str.extract(r'(?:^|&)ind=([^&]+)', expand=False))
+
+
+COLUMN_CONVERTERS: dict[str, Callable[[pd.Series], pd.Series]] = {
+    'str': _convert_str,
+    'int': _convert_int,
+    'float': _convert_float,
+    'indicator_id': _convert_indicator_id,
+}
+
+
+def convert_columns(
+    rows: Iterable[list[Tag | LxmlTag]], columns_spec: dict[str, Optional[str]]
+) -> pd.DataFrame:
+    """
+    Collect the raw strings of every row into per-column arrays and convert each column at once according to columns_spec, a dict column name -> spec. Spec is one of COLUMN_CONVERTERS keys ("str", "int" to nullable Int64, "float", "indicator_id" to nullable Int64) or None for columns that are not parsed. Values that can't be converted become missing values.
+    """
+    specs = list(columns_spec.values())
+    columns = [[] for _ in specs]
+    for tds in rows:
+        for i, spec in enumerate(specs):
+            columns[i].append(raw_cell_value(tds[i], spec) if i < len(tds) else None)
+    data = {}
+    for (name, spec), values in zip(columns_spec.items(), columns):
+        s = pd.Series(values, dtype=object)
+        data[name] = COLUMN_CONVERTERS[spec](s) if spec else s
+    return pd.DataFrame(data, columns=list(columns_spec))
@@ -0,0 +1,156 @@
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+import os
+import pandas as pd
+from queue import Queue
+from threading import BoundedSemaphore, Event
+from typing import Any, Iterable, Iterator, Optional
+
+from .deadline import deadline_scope
+from .transport import PNESession, get_default_session
+from .utils import BaseClass
+from .PNEGraphsDownloader import PNEGraphsDownloader
+
+# Class-level switches of downloader classes that change how responses are parsed, they are copied into parse processes
+PARSE_SETTINGS = ('table_parser', 'coercion', 'compact_dtypes')
+
+# Session of the downloaders built in parse processes, it's never used to make requests
+_parse_session = None
+
+
+def _init_kwargs(
+    cls: type[BaseClass], unit: tuple[str, Optional[int]], year: Optional[int]
+) -> dict[str, Any]:
+    hospital_code, indicator_id = unit
+    if issubclass(cls, PNEGraphsDownloader):
+        return dict(hospital_code=hospital_code, indicator_id=indicator_id)
+    return dict(year=year, hospital_code=hospital_code)
+
+
+def _parse_in_process(
+    cls: type[BaseClass],
+    settings: dict[str, Any],
+    init_kwargs: dict[str, Any],
+    fetched: Any,
+) -> pd.DataFrame:
+    global _parse_session
+    if _parse_session is None:
+        # A fixed User-Agent avoids picking a random one, the session makes no requests
+        _parse_session = PNESession(user_agent='agenas_pne_scraper')
+    for name, value in settings.items():
+        setattr(cls, name, value)
+    return cls(**init_kwargs, session=_parse_session)._parse(fetched)
+
+
+class Pipeline:
+    """
+    Two-stage download engine: a pool of I/O threads only fetches responses (downloader._fetch), a pool of processes parses them (downloader._parse, i.e. the class' transform_td and process_results_df), so network waits and CPU-bound parsing never block each other and throughput is bound by whichever of the two is saturated.
+    The stages are connected by a bounded queue: at most max_pending units can be fetched and not yet consumed by the caller, I/O threads wait when it's full, so memory stays bounded even if parsing (or the consumer) is slower than the network.
+    Parse processes are started with the "spawn" method by default, so they don't inherit the locks of the I/O threads. Class-level switches (PARSE_SETTINGS, e.g. table_parser) are sent with every unit; table, json and postprocess timings of the metrics are recorded in the parse processes and not in get_metrics() of the caller.
+    Keyword args:
+        - io_workers [int], _default=16_, number of I/O threads.
+        - parse_workers [int | None], _default=None_, number of parse processes. If None, os.cpu_count() is used.
+        - max_pending [int | None], _default=None_, maximum number of fetched units waiting to be parsed or consumed. If None, 4 * parse_workers is used.
+        - session [PNESession | None], _default=None_, session used by I/O threads. If None, the default session is used.
+        - mp_context [multiprocessing.context.BaseContext | None], _default=None_, context of the parse processes. If None, the "spawn" context is used.
+    """
+
+    def __init__(
+        self,
+        io_workers: int = 16,
+        parse_workers: Optional[int] = None,
+        max_pending: Optional[int] = None,
+        session: Optional[PNESession] = None,
+        mp_context: Optional[multiprocessing.context.BaseContext] = None,
+    ) -> None:
+        self.io_workers = io_workers
+        self.parse_workers = parse_workers or os.cpu_count() or 1
+        self.max_pending = max_pending or 4 * self.parse_workers
+        self.session = session if session is not None else get_default_session()
+        self._io_executor = ThreadPoolExecutor(
+            max_workers=io_workers, thread_name_prefix='pne-io'
+        )
+        self._parse_executor = ProcessPoolExecutor(
+            max_workers=self.parse_workers,
+            mp_context=mp_context or multiprocessing.get_context('spawn'),
+        )
+
+    def run(
+        self,
+        cls: type[BaseClass],
+        units: Iterable[tuple[str, Optional[int]]],
+        year: Optional[int] = None,
+        unit_timeout: Optional[float] = None,
+        deadline_at: Optional[float] = None,
+    ) -> Iterator[tuple[tuple[str, Optional[int]], pd.DataFrame, Optional[bool]]]:
+        """
+        Download every (hospital_code, indicator_id) unit with cls and yield (unit, df, ok) as soon as each unit is parsed, where ok is False if some request kept failing and None if the unit was deferred. indicator_id is ignored (and should be None) for table downloaders, which are built with year.
+        The requests of every unit, retries included, run in a deadline_scope of unit_timeout seconds that ends at deadline_at (a monotonic() time) at the latest; units whose deadline passed are deferred.
+        """
+        settings = {
+            name: getattr(cls, name) for name in PARSE_SETTINGS if hasattr(cls, name)
+        }
+        pending = BoundedSemaphore(self.max_pending)
+        stop = Event()
+        # (unit, df or done Future of the parse process, ok), in completion order
+        results = Queue()
+
+        def acquire() -> bool:
+            # Wait for a free slot, give up if the caller stopped consuming
+            while not pending.acquire(timeout=0.1):
+                if stop.is_set():
+                    return False
+            return True
+
+        def fetch(unit: tuple[str, Optional[int]]) -> None:
+            if stop.is_set():
+                return
+            acquired = False
+            try:
+                init_kwargs = _init_kwargs(cls, unit, year)
+                downloader = cls(**init_kwargs, session=self.session)
+                with deadline_scope(unit_timeout, at=deadline_at):
+                    fetched = downloader._fetch()
+                ok = None if downloader.deferred else not downloader.errors
+                acquired = acquire()
+                if not acquired:
+                    return
+                if fetched is None:
+                    # Nothing to parse, the empty df is built here
+                    results.put((unit, downloader._parse(fetched), ok))
+                    return
+                future = self._parse_executor.submit(
+                    _parse_in_process, cls, settings, init_kwargs, fetched
+                )
+                future.add_done_callback(lambda f: results.put((unit, f, ok)))
+            except BaseException as e:
+                if acquired or acquire():
+                    failed = Future()
+                    failed.set_exception(e)
+                    results.put((unit, failed, False))
+
+        units = list(units)
+        for unit in units:
+            self._io_executor.submit(fetch, unit)
+        try:
+            for _ in units:
+                unit, df, ok = results.get()
+                try:
+                    if isinstance(df, Future):
+                        df = df.result()
+                finally:
+                    pending.release()
+                yield unit, df, ok
+        finally:
+            # If the caller stopped early, fetches that did not start are skipped
+            stop.set()
+
+    def close(self) -> None:
+        self._io_executor.shutdown(wait=True, cancel_futures=True)
+        self._parse_executor.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self) -> 'Pipeline':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
@@ -0,0 +1,141 @@
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import Future
+import os
+from threading import Lock
+from typing import Any, Awaitable, Callable, Hashable
+
+
+def _always(result: Any) -> bool:
+    return True
+
+
+class SingleFlight:
+    """
+    In-memory coalescing of identical work: while a call for a key is in flight, every other call for the same key waits for it and gets the same result (or exception) instead of doing the work again; completed results are also kept, up to max_entries (least recently used are dropped), so repeated calls are served from memory. Exceptions are never kept.
+    PNESession uses it to share responses of identical requests (keyed on url and querystring) and downloaders to share parsed dfs.
+    Keyword args:
+        - max_entries [int], _default=1024_, number of completed results kept. If 0, only concurrent calls are coalesced.
+    """
+
+    def __init__(self, max_entries: int = 1024) -> None:
+        self.max_entries = max_entries
+        self.executed = 0
+        self.joined = 0
+        self.hits = 0
+        self._setup()
+
+    def _setup(self) -> None:
+        self._lock = Lock()
+        self._in_flight: dict[Hashable, Future] = {}
+        self._results: OrderedDict[Hashable, Any] = OrderedDict()
+        self._pid = os.getpid()
+
+    def _join(self, key: Hashable) -> tuple[bool, Future]:
+        # Return (True, new future) if the caller must do the work, (False, future to wait for) otherwise
+        if self._pid != os.getpid():
+            # Calls in flight when the process was forked never complete in the child, which starts empty
+            self._setup()
+        with self._lock:
+            if key in self._results:
+                self._results.move_to_end(key)
+                self.hits += 1
+                future = Future()
+                future.set_result(self._results[key])
+                return False, future
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.joined += 1
+                return False, future
+            future = self._in_flight[key] = Future()
+            self.executed += 1
+            return True, future
+
+    def _done(
+        self,
+        key: Hashable,
+        future: Future,
+        keep: Callable[[Any], bool],
+        result: Any = None,
+        exception: BaseException = None,
+    ) -> None:
+        with self._lock:
+            self._in_flight.pop(key, None)
+            if exception is None and self.max_entries > 0 and keep(result):
+                self._results[key] = result
+                while len(self._results) > self.max_entries:
+                    self._results.popitem(last=False)
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def do(
+        self,
+        key: Hashable,
+        fn: Callable[[], Any],
+        keep: Callable[[Any], bool] = _always,
+    ) -> Any:
+        """
+        Return fn(), called only if no result for key is in flight or kept. If keep(result) is False, the result is shared with concurrent callers only.
+        """
+        owner, future = self._join(key)
+        if not owner:
+            return future.result()
+        try:
+            result = fn()
+        except BaseException as e:
+            self._done(key, future, keep, exception=e)
+            raise
+        self._done(key, future, keep, result=result)
+        return result
+
+    async def ado(
+        self,
+        key: Hashable,
+        afn: Callable[[], Awaitable[Any]],
+        keep: Callable[[Any], bool] = _always,
+    ) -> Any:
+        """
+        Awaitable version of SingleFlight.do, afn is a coroutine function. Calls for the same key are coalesced with SingleFlight.do calls too.
+        """
+        owner, future = self._join(key)
+        if not owner:
+            return await asyncio.wrap_future(future)
+        try:
+            result = await afn()
+        except BaseException as e:
+            self._done(key, future, keep, exception=e)
+            raise
+        self._done(key, future, keep, result=result)
+        return result
+
+    def clear(self) -> None:
+        """
+        Forget every kept result, calls in flight are not affected.
+        """
+        with self._lock:
+            self._results.clear()
+
+    def __len__(self) -> int:
+        return len(self._results)
+
+    @property
+    def stats(self) -> dict[str, int]:
+        """
+        Return the number of calls that did the work (executed), waited for a call in flight (joined) and were served from kept results (hits).
+        """
+        return dict(
+            executed=self.executed,
+            joined=self.joined,
+            hits=self.hits,
+            entries=len(self._results),
+        )
+
+    def __getstate__(self) -> dict[str, Any]:
+        # Results and calls in flight belong to this process, only the configuration is kept
+        return dict(max_entries=self.max_entries, executed=0, joined=0, hits=0)
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._setup()
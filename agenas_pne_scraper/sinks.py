@@ -0,0 +1,301 @@
+import os
+import pandas as pd
+import re
+import sqlite3
+from threading import Lock
+from typing import Any, Optional
+from uuid import uuid4
+
+from .utils import BaseClass
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow is optional, it's needed only by ParquetSink
+    pa = pq = None
+
+
+def dataset_name(downloader_cls: type[BaseClass]) -> str:
+    """
+    Return the name of the dataset results of downloader_cls are written to, e.g. "volume_indicators" for PNEVolumeIndicatorsDownloader and "wt_graphs" for PNEWaitingTimeGraphsDownloader.
+    """
+    name = re.sub(r'^PNE|Downloader$', '', downloader_cls.__name__)
+    name = name.replace('WaitingTime', 'Wt')
+    return re.sub(r'(?<!^)(?=[A-Z])', '_', name).lower()
+
+
+class ResultsSink:
+    """
+    Base class of the objects results can be streamed into while a crawl is running, one df (of a single hospital or graph) at a time.
+    """
+
+    def write(self, df: pd.DataFrame, downloader_cls: type[BaseClass]) -> None:
+        """
+        Write df, returned by a downloader_cls instance.
+        """
+        raise NotImplementedError(f'write method must be overridden!')
+
+    def close(self) -> None:
+        """
+        Flush pending data and release resources.
+        """
+        pass
+
+    def __enter__(self) -> 'ResultsSink':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+class ParquetSink(ResultsSink):
+    """
+    Stream results into Parquet datasets, one per downloader class (see dataset_name), hive-partitioned by indicator_type and year: <root>/<dataset>/indicator_type=<type>/year=<year>/part-<id>.parquet.
+    Rows are buffered per partition and written as a row group every row_group_size rows, so memory stays bounded whatever the crawl size. Column types follow COLUMNS_TYPES, columns are the downloader class' results_columns.
+    Keyword args:
+        - root [str], directory the datasets are written to.
+        - row_group_size [int], _default=50000_, number of rows of every row group.
+        - max_rows_per_file [int | None], _default=None_, if given, a new file is started once a file reaches this number of rows.
+        - compression [str], _default="zstd"_, Parquet compression codec.
+    """
+
+    partition_columns = ['indicator_type', 'year']
+
+    COLUMNS_TYPES = {
+        'hospital_code': 'string',
+        'indicator_type': 'string',
+        'description': 'string',
+        'year': 'int64',
+        'indicator_id': 'int64',
+        'population': 'int64',
+    }
+    # Every other column is float64
+
+    def __init__(
+        self,
+        root: str,
+        row_group_size: int = 50000,
+        max_rows_per_file: Optional[int] = None,
+        compression: str = 'zstd',
+    ) -> None:
+        if pa is None:
+            raise ImportError('ParquetSink requires pyarrow: pip install pyarrow')
+        self.root = root
+        self.row_group_size = row_group_size
+        self.max_rows_per_file = max_rows_per_file
+        self.compression = compression
+        self._lock = Lock()
+        # (dataset, indicator_type, year) -> pending dfs, number of pending rows, open writer and rows written to it
+        self._buffers: dict[tuple, list[pd.DataFrame]] = {}
+        self._n_buffered: dict[tuple, int] = {}
+        self._writers: dict[tuple, Any] = {}
+        self._n_written: dict[tuple, int] = {}
+        self._schemas: dict[str, Any] = {}
+
+    def _get_schema(self, downloader_cls: type[BaseClass]) -> 'pa.Schema':
+        name = dataset_name(downloader_cls)
+        if name not in self._schemas:
+            self._schemas[name] = pa.schema(
+                [
+                    (c, pa.type_for_alias(self.COLUMNS_TYPES.get(c, 'float64')))
+                    for c in downloader_cls.results_columns
+                    if c not in self.partition_columns
+                ]
+            )
+        return self._schemas[name]
+
+    def _partition_path(self, key: tuple) -> str:
+        name, indicator_type, year = key
+        return os.path.join(
+            self.root,
+            name,
+            f'indicator_type={indicator_type}',
+            f'year={year}',
+        )
+
+    def _flush(self, key: tuple, schema: 'pa.Schema') -> None:
+        df = pd.concat(self._buffers.pop(key), axis=0, ignore_index=True)
+        self._n_buffered.pop(key)
+        table = pa.Table.from_pandas(
+            df.reindex(columns=schema.names), schema=schema, preserve_index=False
+        )
+        writer = self._writers.get(key)
+        if writer is None:
+            path = self._partition_path(key)
+            os.makedirs(path, exist_ok=True)
+            writer = pq.ParquetWriter(
+                os.path.join(path, f'part-{uuid4().hex}.parquet'),
+                schema,
+                compression=self.compression,
+            )
+            self._writers[key] = writer
+            self._n_written[key] = 0
+        writer.write_table(table, row_group_size=self.row_group_size)
+        self._n_written[key] += len(df)
+        if (
+            self.max_rows_per_file is not None
+            and self._n_written[key] >= self.max_rows_per_file
+        ):
+            self._writers.pop(key).close()
+
+    def write(self, df: pd.DataFrame, downloader_cls: type[BaseClass]) -> None:
+        if df is None or not len(df):
+            return
+        name = dataset_name(downloader_cls)
+        schema = self._get_schema(downloader_cls)
+        with self._lock:
+            for (indicator_type, year), part in df.groupby(
+                self.partition_columns, dropna=False, sort=False
+            ):
+                year = 'null' if pd.isna(year) else int(year)
+                key = (name, indicator_type, year)
+                self._buffers.setdefault(key, []).append(part)
+                self._n_buffered[key] = self._n_buffered.get(key, 0) + len(part)
+                if self._n_buffered[key] >= self.row_group_size:
+                    self._flush(key, schema)
+
+    def close(self) -> None:
+        with self._lock:
+            for key in list(self._buffers):
+                self._flush(key, self._schemas[key[0]])
+            for writer in self._writers.values():
+                writer.close()
+            self._writers.clear()
+
+
+class ResultsStore(ResultsSink):
+    """
+    Store results in a SQLite file, one table per downloader class (see dataset_name) with its results_columns, so single hospitals or indicators can be queried without loading every result.
+    Rows are upserted on (hospital_code, indicator_id, description, year, indicator_type), description only for classes that have it (tables, where an indicator has a row per description and rows without an indicator link have a NULL indicator_id): writing the results of a hospital again (e.g. an incremental refresh of the last year) replaces its rows instead of duplicating them. The unique index of the key also serves lookups by hospital_code, a secondary index serves lookups by indicator_id.
+    Keyword args:
+        - path [str], SQLite file to use.
+    """
+
+    key_columns = [
+        'hospital_code',
+        'indicator_id',
+        'description',
+        'year',
+        'indicator_type',
+    ]
+    # NULLs never conflict, so nullable key columns are compared through IFNULL
+    key_nulls = {'indicator_id': '-1', 'description': "''"}
+
+    # SQLite types of COLUMNS_TYPES, every other column is REAL
+    SQL_TYPES = {'string': 'TEXT', 'int64': 'INTEGER', 'float64': 'REAL'}
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = Lock()
+        self._connection = None
+        self._pid = None
+        self._tables: set[str] = set()
+
+    def _get_connection(self) -> sqlite3.Connection:
+        if self._connection is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._connection = connection
+            self._pid = os.getpid()
+            self._tables = set()
+        return self._connection
+
+    def _key_columns(self, downloader_cls: type[BaseClass]) -> list[str]:
+        return [c for c in self.key_columns if c in downloader_cls.results_columns]
+
+    def _key_expression(self, downloader_cls: type[BaseClass]) -> str:
+        return ', '.join(
+            f'IFNULL({c}, {self.key_nulls[c]})' if c in self.key_nulls else c
+            for c in self._key_columns(downloader_cls)
+        )
+
+    def _create_table(
+        self, connection: sqlite3.Connection, downloader_cls: type[BaseClass]
+    ) -> str:
+        name = dataset_name(downloader_cls)
+        if name in self._tables:
+            return name
+        columns = ', '.join(
+            f'{c} {self.SQL_TYPES[ParquetSink.COLUMNS_TYPES.get(c, "float64")]}'
+            for c in downloader_cls.results_columns
+        )
+        connection.execute(f'CREATE TABLE IF NOT EXISTS {name} ({columns})')
+        # Index of stores written before description was part of the key
+        connection.execute(f'DROP INDEX IF EXISTS {name}_key')
+        connection.execute(
+            f'CREATE UNIQUE INDEX IF NOT EXISTS {name}_row_key ON {name} '
+            f'({self._key_expression(downloader_cls)})'
+        )
+        connection.execute(
+            f'CREATE INDEX IF NOT EXISTS {name}_indicator ON {name} '
+            '(indicator_id, year)'
+        )
+        connection.commit()
+        self._tables.add(name)
+        return name
+
+    def write(self, df: pd.DataFrame, downloader_cls: type[BaseClass]) -> None:
+        if df is None or not len(df):
+            return
+        columns = downloader_cls.results_columns
+        df = df.reindex(columns=columns).astype(object)
+        rows = df.where(df.notna(), None).itertuples(index=False, name=None)
+        key_columns = self._key_columns(downloader_cls)
+        updates = ', '.join(
+            f'{c} = excluded.{c}' for c in columns if c not in key_columns
+        )
+        with self._lock:
+            connection = self._get_connection()
+            name = self._create_table(connection, downloader_cls)
+            connection.executemany(
+                f'INSERT INTO {name} ({", ".join(columns)}) '
+                f'VALUES ({", ".join("?" * len(columns))}) '
+                f'ON CONFLICT ({self._key_expression(downloader_cls)}) '
+                f'DO UPDATE SET {updates}',
+                rows,
+            )
+            connection.commit()
+
+    def query(
+        self,
+        downloader_cls: type[BaseClass],
+        hospital_code: Optional[str] = None,
+        indicator_id: Optional[int] = None,
+        year: Optional[int] = None,
+        indicator_type: Optional[str] = None,
+    ) -> pd.DataFrame:
+        """
+        Return the stored results of downloader_cls, filtered on the given hospital_code, indicator_id, year and indicator_type, sorted by key.
+        """
+        filters = dict(
+            hospital_code=hospital_code,
+            indicator_id=indicator_id,
+            year=year,
+            indicator_type=indicator_type,
+        )
+        filters = {c: v for c, v in filters.items() if v is not None}
+        where = ' AND '.join(f'{c} = ?' for c in filters) or '1'
+        with self._lock:
+            connection = self._get_connection()
+            name = self._create_table(connection, downloader_cls)
+            df = pd.read_sql_query(
+                f'SELECT * FROM {name} WHERE {where} '
+                f'ORDER BY {", ".join(self._key_columns(downloader_cls))}',
+                connection,
+                params=[
+                    int(v) if isinstance(v, (int, float)) else v
+                    for v in filters.values()
+                ],
+            )
+        string_columns = [
+            c for c in df.columns if ParquetSink.COLUMNS_TYPES.get(c) == 'string'
+        ]
+        return df.astype({c: 'string' for c in string_columns})
+
+    def close(self) -> None:
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+            self._connection = None
+            self._tables = set()
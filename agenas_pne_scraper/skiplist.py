@@ -0,0 +1,140 @@
+from datetime import timedelta
+import os
+import sqlite3
+from threading import Lock
+from time import time
+from typing import Any, Iterable, Optional
+
+from .utils import get_cache_dir
+
+
+class SkipList:
+    """
+    Persistent negative cache of the (kind, hospital_code) combinations that never return PNE data, stored in a SQLite file. Most codes in the ministry registry (e.g. non-acute facilities) are not in PNE at all, so, once learned, crawl skips them instead of spending a request (and its retries) on each of them.
+    A combination is skipped if its table came back empty or if its requests failed max_errors times in a row. Entries older than reprobe_after are probed again, so newly listed facilities are caught; a combination that returns data is removed.
+    Keyword args:
+        - path [str | None], _default=None_, SQLite file to use. If None, skiplist.sqlite in the package cache dir (see utils.get_cache_dir) is used.
+        - reprobe_after [float | timedelta | None], _default=90 days_, time (in seconds if float) after which a skipped combination is tried again. If None, combinations are skipped forever.
+        - max_errors [int], _default=3_, number of consecutive failed crawls after which a combination is skipped.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        reprobe_after: float | timedelta | None = timedelta(days=90),
+        max_errors: int = 3,
+    ) -> None:
+        if path is None:
+            path = os.path.join(get_cache_dir(), 'skiplist.sqlite')
+        self.path = path
+        self.reprobe_after = (
+            reprobe_after.total_seconds()
+            if isinstance(reprobe_after, timedelta)
+            else reprobe_after
+        )
+        self.max_errors = max_errors
+        self._setup()
+
+    def _setup(self) -> None:
+        self._lock = Lock()
+        self._connection = None
+        self._pid = None
+
+    def _get_connection(self) -> sqlite3.Connection:
+        if self._connection is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS skips ('
+                'kind TEXT, hospital_code TEXT, empty INTEGER, errors INTEGER, '
+                'checked_at REAL, PRIMARY KEY (kind, hospital_code))'
+            )
+            connection.commit()
+            self._connection = connection
+            self._pid = os.getpid()
+        return self._connection
+
+    def skipped(self, kind: str) -> set[str]:
+        """
+        Return the hospital codes of kind that should be skipped now.
+        """
+        query = (
+            'SELECT hospital_code FROM skips WHERE kind = ? AND (empty OR errors >= ?)'
+        )
+        params = [kind, self.max_errors]
+        if self.reprobe_after is not None:
+            query += ' AND checked_at > ?'
+            params.append(time() - self.reprobe_after)
+        with self._lock:
+            rows = self._get_connection().execute(query, params).fetchall()
+        return set(hospital_code for hospital_code, in rows)
+
+    def filter(self, kind: str, hospital_codes: Iterable[str]) -> list[str]:
+        """
+        Return hospital_codes without the ones of kind that should be skipped now, in the same order.
+        """
+        skipped = self.skipped(kind)
+        return [code for code in hospital_codes if code not in skipped]
+
+    def update(self, kind: str, hospital_code: str, n_rows: int, ok: bool) -> None:
+        """
+        Record the outcome of a table download: n_rows is the number of rows of the returned df and ok is False if (some of) its requests kept failing.
+        """
+        with self._lock:
+            connection = self._get_connection()
+            if n_rows:
+                connection.execute(
+                    'DELETE FROM skips WHERE kind = ? AND hospital_code = ?',
+                    (kind, hospital_code),
+                )
+            elif ok:
+                connection.execute(
+                    'INSERT OR REPLACE INTO skips VALUES (?, ?, 1, 0, ?)',
+                    (kind, hospital_code, time()),
+                )
+            else:
+                # Errors count only if they happen in a row, an empty table resets them
+                connection.execute(
+                    'INSERT INTO skips VALUES (?, ?, 0, 1, ?) '
+                    'ON CONFLICT (kind, hospital_code) DO UPDATE SET '
+                    'empty = 0, errors = errors + 1, checked_at = excluded.checked_at',
+                    (kind, hospital_code, time()),
+                )
+            connection.commit()
+
+    def discard(
+        self, kind: Optional[str] = None, hospital_code: Optional[str] = None
+    ) -> None:
+        """
+        Forget the entries matching kind and hospital_code (every entry if both are None).
+        """
+        query = 'DELETE FROM skips WHERE 1'
+        params = []
+        if kind is not None:
+            query += ' AND kind = ?'
+            params.append(kind)
+        if hospital_code is not None:
+            query += ' AND hospital_code = ?'
+            params.append(hospital_code)
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute(query, params)
+            connection.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return (
+                self._get_connection()
+                .execute('SELECT COUNT(*) FROM skips')
+                .fetchone()[0]
+            )
+
+    def __getstate__(self) -> dict[str, Any]:
+        return dict(
+            path=self.path, reprobe_after=self.reprobe_after, max_errors=self.max_errors
+        )
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._setup()
@@ -0,0 +1,318 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from functools import partial
+import os
+import requests
+from requests.adapters import HTTPAdapter
+from threading import Lock, local
+from time import perf_counter
+from typing import Any, Optional
+
+from .archive import ResponseArchive
+from .cache import ResponseCache
+from .deadline import get_deadline, remaining
+from .exceptions import DeadlineExceeded, ErrorStatusCodeException
+from .governor import RateGovernor
+from .metrics import count_served, observe_send
+from .singleflight import SingleFlight
+from .utils import parse_retry_after
+
+_user_agent = None
+_user_agent_lock = Lock()
+
+
+def get_user_agent() -> str:
+    """
+    Return the chrome User-Agent used by sessions created without an explicit one. fake_useragent is imported and queried only on first call, then the User-Agent is cached for the whole process (and inherited by forked workers).
+    """
+    global _user_agent
+    if _user_agent is None:
+        with _user_agent_lock:
+            if _user_agent is None:
+                from fake_useragent import UserAgent
+
+                _user_agent = UserAgent()['chrome']
+    return _user_agent
+
+
+def _accept_encoding() -> str:
+    """
+    Return the Accept-Encoding header value supported by the installed urllib3 decoders: brotli is negotiated only if brotli or brotlicffi is importable.
+    """
+    for module in ('brotli', 'brotlicffi'):
+        try:
+            __import__(module)
+            return 'gzip, deflate, br'
+        except ImportError:
+            pass
+    return 'gzip, deflate'
+
+
+class PNESession:
+    """
+    Thread-safe HTTP transport that can be shared by every downloader. Connections are kept alive in urllib3 pools, so consecutive requests to pne.agenas.it do not pay a new TCP and TLS handshake. Every thread gets its own requests.Session, but all of them are mounted on the same HTTPAdapter and so share the same connection pools.
+    Keyword args:
+        - pool_connections [int], _default=10_, number of per-host connection pools to keep.
+        - pool_maxsize [int], _default=32_, maximum number of keep-alive connections kept for every host.
+        - pool_block [bool], _default=False_, if True no more than pool_maxsize connections per host are opened at once and further requests wait for a free connection.
+        - user_agent [str | None], _default=None_, User-Agent header sent with every request. If None, the chrome User-Agent of get_user_agent, chosen once per process, is used.
+        - compression [bool], _default=True_, negotiate gzip/deflate (and brotli, when available) compressed responses.
+        - async_workers [int], _default=256_, maximum number of requests that can be in flight at once through PNESession.aget.
+        - cache [ResponseCache | None], _default=None_, if given, successful responses are stored on disk and served from there on next requests.
+        - governor [RateGovernor | None], _default=None_, if given, every request that reaches the network waits for it, so request rate and concurrency adapt to what the server can sustain.
+        - archive [ResponseArchive | None], _default=None_, if given, every response received by downloaders (from the network or the cache, whatever its status code) is appended to it, so results can be parsed again offline (see crawling.reparse).
+        - single_flight [SingleFlight | bool], _default=True_, identical requests (same url and querystring) made while one is in flight, or repeated later, share a single round trip, and downloaders share the parsed df of identical downloads (see SingleFlight). If True, a SingleFlight with default settings is used; if False, every request reaches the network (or the cache).
+        - timeout [float | tuple[float, float] | None], _default=(10, 60)_, connect and read timeouts (in seconds) of every request, as in requests: the read timeout bounds every wait for bytes from the server, not the whole response. A request that times out fails like any other and is retried by downloaders. Inside a deadline_scope both are shortened to the time left. None waits forever.
+    """
+
+    def __init__(
+        self,
+        pool_connections: int = 10,
+        pool_maxsize: int = 32,
+        pool_block: bool = False,
+        user_agent: Optional[str] = None,
+        compression: bool = True,
+        async_workers: int = 256,
+        cache: Optional[ResponseCache] = None,
+        governor: Optional[RateGovernor] = None,
+        single_flight: SingleFlight | bool = True,
+        archive: Optional[ResponseArchive] = None,
+        timeout: float | tuple[float, float] | None = (10, 60),
+    ) -> None:
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.user_agent = user_agent if user_agent is not None else get_user_agent()
+        self.compression = compression
+        self.async_workers = async_workers
+        self.cache = cache
+        self.governor = governor
+        if single_flight is True:
+            single_flight = SingleFlight()
+        self.single_flight = None if single_flight is False else single_flight
+        self.archive = archive
+        self.timeout = timeout
+        self._setup()
+
+    def _setup(self) -> None:
+        self.headers = {
+            'User-Agent': self.user_agent,
+            'Accept-Encoding': _accept_encoding() if self.compression else 'identity',
+            'Connection': 'keep-alive',
+        }
+        self._adapter = HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize,
+            pool_block=self.pool_block,
+        )
+        self._local = local()
+        self._executor = None
+        self._executor_lock = Lock()
+        self._pid = os.getpid()
+
+    def _check_pid(self) -> None:
+        # Pooled connections, thread-local sessions and the executor of PNESession.aget must not be shared with forked processes (their threads don't exist there), so they are created again in every process
+        if self._pid != os.getpid():
+            self._setup()
+
+    def _get_session(self) -> requests.Session:
+        self._check_pid()
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount('https://', self._adapter)
+            session.mount('http://', self._adapter)
+            session.headers.update(self.headers)
+            self._local.session = session
+        return session
+
+    def _get_timeout(
+        self, timeout: float | tuple[float, float] | None
+    ) -> float | tuple[float, float] | None:
+        # Timeouts are shortened to what is left of the deadline of the current deadline_scope
+        left = remaining()
+        if left is None:
+            return timeout
+        if left <= 0:
+            raise DeadlineExceeded()
+        if timeout is None:
+            return left
+        if isinstance(timeout, tuple):
+            return tuple(left if t is None else min(t, left) for t in timeout)
+        return min(timeout, left)
+
+    def _send(
+        self, url: str, params: Optional[dict[str, Any]] = None, **kwargs
+    ) -> requests.Response:
+        timeout = kwargs.pop('timeout', self.timeout)
+        request_start = perf_counter()
+        start = (
+            self.governor.acquire(get_deadline()) if self.governor is not None else None
+        )
+        try:
+            # Computed once the governor let the request start, with the time left then
+            kwargs['timeout'] = self._get_timeout(timeout)
+        except DeadlineExceeded:
+            if self.governor is not None:
+                self.governor.cancel()
+            raise
+        try:
+            r = self._get_session().get(url, params=params, **kwargs)
+        except requests.RequestException as e:
+            if self.governor is not None:
+                self.governor.release(start, None)
+            observe_send(request_start, None)
+            raise ErrorStatusCodeException() from e
+        observe_send(request_start, r)
+        if self.governor is not None:
+            self.governor.release(
+                start, r.status_code, parse_retry_after(r.headers.get('Retry-After'))
+            )
+        return r
+
+    def get(
+        self, url: str, params: Optional[dict[str, Any]] = None, **kwargs
+    ) -> requests.Response:
+        """
+        Make a GET request through the shared connection pools (or serve it from self.cache, if set). ErrorStatusCodeException is raised if the request cannot be completed or if the response status code is not 200.
+        If self.single_flight is set, requests without extra kwargs are coalesced on url and querystring: responses are shared by every caller and must not be modified.
+        """
+        if self.single_flight is None or kwargs:
+            return self._get(url, params, **kwargs)
+        owner = False
+
+        def get() -> requests.Response:
+            nonlocal owner
+            owner = True
+            return self._get(url, params)
+
+        r = self.single_flight.do(
+            ('response', ResponseCache.make_key(url, params)), get
+        )
+        if not owner:
+            count_served('coalesced')
+        return r
+
+    def _get(
+        self, url: str, params: Optional[dict[str, Any]] = None, **kwargs
+    ) -> requests.Response:
+        if self.cache is not None:
+            sent = False
+
+            def send() -> requests.Response:
+                nonlocal sent
+                sent = True
+                return self._send(url, params, **kwargs)
+
+            r = self.cache.fetch(url, params, send)
+            if not sent:
+                count_served('cache')
+        else:
+            r = self._send(url, params, **kwargs)
+        if self.archive is not None:
+            self.archive.record(url, params, r)
+        if r.status_code != 200:
+            raise ErrorStatusCodeException(r)
+        return r
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        self._check_pid()
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.async_workers,
+                        thread_name_prefix='pne-session',
+                    )
+        return self._executor
+
+    async def aget(
+        self, url: str, params: Optional[dict[str, Any]] = None, **kwargs
+    ) -> requests.Response:
+        """
+        Awaitable version of PNESession.get. The blocking request runs in a thread pool owned by the session (sized by async_workers), so many requests can be in flight at once from a single event loop while still sharing the same connection pools.
+        """
+        loop = asyncio.get_running_loop()
+        # The request runs in the context of the awaiting task, e.g. within its deadline_scope
+        return await loop.run_in_executor(
+            self._get_executor(),
+            partial(copy_context().run, self.get, url, params, **kwargs),
+        )
+
+    def close(self) -> None:
+        """
+        Close every pooled connection and stop the threads used by PNESession.aget.
+        """
+        self._check_pid()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        self._adapter.close()
+
+    def __enter__(self) -> 'PNESession':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def __getstate__(self) -> dict[str, Any]:
+        # Connection pools and thread-local sessions can't be pickled (e.g. when sent to pandarallel workers), so only the configuration is kept.
+        return dict(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize,
+            pool_block=self.pool_block,
+            user_agent=self.user_agent,
+            compression=self.compression,
+            async_workers=self.async_workers,
+            cache=self.cache,
+            governor=self.governor,
+            single_flight=self.single_flight,
+            archive=self.archive,
+            timeout=self.timeout,
+        )
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._setup()
+
+
+_default_session = None
+_default_session_lock = Lock()
+# Whether _default_session was created by get_default_session rather than passed to set_default_session
+_default_session_created = False
+
+
+def _reset_default_session() -> None:
+    # A forked child gets a new default session, unless one was set explicitly (it's rebuilt on first use in the child, see PNESession._check_pid)
+    global _default_session, _default_session_lock, _default_session_created
+    _default_session_lock = Lock()
+    if _default_session_created:
+        _default_session = None
+        _default_session_created = False
+
+
+os.register_at_fork(after_in_child=_reset_default_session)
+
+
+def get_default_session() -> PNESession:
+    """
+    Return the process-wide PNESession used by downloaders when no session is passed explicitly. It is created on first use, with a RateGovernor.
+    """
+    global _default_session, _default_session_created
+    if _default_session is None:
+        with _default_session_lock:
+            if _default_session is None:
+                _default_session = PNESession(governor=RateGovernor())
+                _default_session_created = True
+    return _default_session
+
+
+def set_default_session(session: Optional[PNESession]) -> None:
+    """
+    Replace the process-wide PNESession. Passing None resets it, so a new one will be created on next use.
+    """
+    global _default_session, _default_session_created
+    with _default_session_lock:
+        _default_session = session
+        _default_session_created = False
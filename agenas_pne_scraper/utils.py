@@ -1,10 +1,29 @@
+import asyncio
 from bs4 import Tag
-from numpy import isin
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from email.utils import parsedate_to_datetime
+from inspect import iscoroutinefunction
+import numpy as np
+import os
 import pandas as pd
-from time import sleep
-from typing import Any, Callable
+from pandas.api.extensions import ExtensionDtype
+from pandas.api.types import (
+    CategoricalDtype,
+    is_bool_dtype,
+    is_float_dtype,
+    is_numeric_dtype,
+    is_string_dtype,
+)
+from random import uniform
+import re
+from threading import Lock
+from time import sleep, time
+from typing import Any, Awaitable, Callable, Optional
+from urllib.parse import unquote_plus
 
-from .exceptions import EmptyException
+from .deadline import check_deadline, remaining
+from .exceptions import DeadlineExceeded, EmptyException
 
 
 def display(*args, **kwargs) -> None:
@@ -14,17 +33,187 @@ def display(*args, **kwargs) -> None:
     return locals().get('display', print)(*args, **kwargs)
 
 
+def get_cache_dir() -> str:
+    """
+    Return the directory where persistent caches are stored: $AGENAS_PNE_CACHE_DIR if set, otherwise agenas_pne_scraper inside $XDG_CACHE_HOME (default ~/.cache).
+    """
+    cache_dir = os.environ.get('AGENAS_PNE_CACHE_DIR')
+    if cache_dir:
+        return cache_dir
+    xdg_cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache'
+    )
+    return os.path.join(xdg_cache_home, 'agenas_pne_scraper')
+
+
+_sibling_executor = None
+_sibling_executor_lock = Lock()
+
+
+def _reset_sibling_executor() -> None:
+    # A forked child inherits the executor but none of its threads, it must create its own
+    global _sibling_executor, _sibling_executor_lock
+    _sibling_executor = None
+    _sibling_executor_lock = Lock()
+
+
+os.register_at_fork(after_in_child=_reset_sibling_executor)
+
+
+def _get_sibling_executor() -> ThreadPoolExecutor:
+    global _sibling_executor
+    if _sibling_executor is None:
+        with _sibling_executor_lock:
+            if _sibling_executor is None:
+                _sibling_executor = ThreadPoolExecutor(
+                    max_workers=64, thread_name_prefix='pne-sibling'
+                )
+    return _sibling_executor
+
+
+def run_concurrently(*fns: Callable[[], Any]) -> list[Any]:
+    """
+    Call every function in fns concurrently and return their results in the same order. All functions but the last run in a shared thread pool, the last one runs in the calling thread. If any function raised, the first exception (in fns order) is raised once all of them are done.
+    Functions run in the pool must not call run_concurrently themselves.
+    """
+    # Functions run in the pool see the context of the caller, e.g. its deadline_scope
+    futures = [
+        _get_sibling_executor().submit(copy_context().run, fn) for fn in fns[:-1]
+    ]
+    outcomes = []
+    if fns:
+        try:
+            outcomes.append((True, fns[-1]()))
+        except Exception as e:
+            outcomes.append((False, e))
+    for future in reversed(futures):
+        try:
+            outcomes.insert(0, (True, future.result()))
+        except Exception as e:
+            outcomes.insert(0, (False, e))
+    for ok, outcome in outcomes:
+        if not ok:
+            raise outcome
+    return [outcome for _, outcome in outcomes]
+
+
+async def gather_or_raise(*aws: Any) -> list[Any]:
+    """
+    Await every awaitable in aws concurrently and return their results in the same order. If any raised, the first exception (in aws order) is raised once all of them are done.
+    """
+    results = await asyncio.gather(*aws, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+
+_indicator_id_pattern = re.compile(r'(?:^|&)ind=([^&]+)')
+
+
+def get_indicator_id(href: str) -> Optional[int]:
+    """
+    Return the value of the ind parameter in the querystring of href as int, or None if it's missing or not an integer.
+    """
+    match = _indicator_id_pattern.search(href.rpartition('?')[2])
+    if match is None:
+        return
+    try:
+        return int(unquote_plus(match.group(1)))
+    except ValueError:
+        pass
+
+
+# Counts, ids and years: compact_df converts them to the smallest nullable integer dtype when all their values are integers
+COMPACT_INTEGER_COLUMNS = ('year', 'indicator_id', 'population', 'cases', 'value')
+
+
+def _compact_integers(s: pd.Series) -> Optional[pd.Series]:
+    notna = s.dropna()
+    if not (notna == notna.round()).all():
+        return
+    lower, upper = (notna.min(), notna.max()) if len(notna) else (0, 0)
+    for dtype in ('int8', 'int16', 'int32', 'int64'):
+        info = np.iinfo(dtype)
+        if info.min <= lower and upper <= info.max:
+            return s.astype(dtype.capitalize())
+
+
+def _compact_floats(s: pd.Series) -> pd.Series:
+    s32 = s.astype(np.float32)
+    if (s.isna() | (s32.astype(np.float64) == s)).all():
+        return s32
+    return s
+
+
+def compact_df(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Return a copy of df with memory-efficient dtypes and the same values: string columns become category, COMPACT_INTEGER_COLUMNS become the smallest nullable integer dtype (Int8, Int16, ...) fitting their values and other float columns become float32 if every value is exactly representable, otherwise they are left float64.
+    """
+    df = df.copy()
+    for c in df.columns:
+        s = df[c]
+        if is_bool_dtype(s.dtype):
+            continue
+        if is_numeric_dtype(s.dtype):
+            if c in COMPACT_INTEGER_COLUMNS:
+                compacted = _compact_integers(s)
+                if compacted is not None:
+                    df[c] = compacted
+                    continue
+            if is_float_dtype(s.dtype) and not isinstance(s.dtype, ExtensionDtype):
+                df[c] = _compact_floats(s)
+        elif isinstance(s.dtype, CategoricalDtype):
+            df[c] = s.cat.remove_unused_categories()
+        elif is_string_dtype(s.dtype):
+            df[c] = s.astype('category')
+    return df
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Parse the value of a Retry-After header, either delay-seconds or an HTTP-date, and return the number of seconds to wait. None is returned if value is missing or invalid.
+    """
+    if not value:
+        return
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time())
+    except (TypeError, ValueError):
+        pass
+
+
+def _get_retry_after(e: Exception) -> Optional[float]:
+    r = getattr(e, 'r', None)
+    if r is None:
+        return
+    return parse_retry_after(r.headers.get('Retry-After'))
+
+
 def retry(
     exceptions: Exception | tuple[Exception] | None = None,
     max_tries: int = -1,
     delay_seconds: int = 0,
+    backoff: float = 1,
+    max_delay_seconds: Optional[float] = None,
+    jitter: bool = False,
+    on_retry: Optional[Callable[..., None]] = None,
 ) -> Callable:
     """
-    A decorator that lets you include the function in a try except wrapper and, if exception is catched, retry to execute until max_tries, if > 0, is reached. Optionally a delay is waited between tries.
+    A decorator that lets you include the function in a try except wrapper and, if exception is catched, retry to execute until max_tries, if > 0, is reached. Optionally a delay is waited between tries. Coroutine functions are supported too: in that case the delay is awaited with asyncio.sleep, so the event loop is not blocked.
+    If the catched exception carries a response (like ErrorStatusCodeException.r) with a Retry-After header, the delay is at least what the server asked for.
+    Tries are bounded by the deadline of the current deadline_scope, if any: DeadlineExceeded is raised instead of making a try after the deadline, or of waiting a delay that would end past it.
     Keyword args:
         - exceptions [Exception list[Exception]], _default=None_, Exception class or list of classes that can be catched by yhe retry decorator.
         - max_tries [int], _default=-1, defines the maximum number of tries before Exception is raised. If max_tries = 0, function is not called and EmptyException is raised.
         - delay_seconds [int], _default=0, defines the delay (in seconds) to be applied between the tries, if >= 0.
+        - backoff [float], _default=1_, factor the delay is multiplied by after every try, e.g. 2 for exponential backoff.
+        - max_delay_seconds [float | None], _default=None_, upper bound of the delay, if not None.
+        - jitter [bool], _default=False_, if True, the delay is drawn uniformly between 0 and the computed delay (full jitter), so that concurrent workers don't retry in lock-step.
+        - on_retry [Callable | None], _default=None_, called as on_retry(exception, *args, **kwargs), with the args of the decorated function, every time a try failed and another one will be made.
     """
     if isinstance(exceptions, tuple):
         assert all(map(lambda x: isinstance(x(), Exception), exceptions))
@@ -35,6 +224,20 @@ def retry(
             f"exceptions must be Exception class or tuple of Exception classes, not '{type(exceptions)}'"
         )
 
+    def get_delay(e: Exception, n_tries: int) -> float:
+        delay = delay_seconds * backoff ** (n_tries - 1)
+        if max_delay_seconds is not None:
+            delay = min(delay, max_delay_seconds)
+        if jitter:
+            delay = uniform(0, delay)
+        retry_after = _get_retry_after(e)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        left = remaining()
+        if left is not None and delay >= left:
+            raise DeadlineExceeded() from e
+        return delay
+
     def decorator(
         func: Callable,
     ) -> Callable:
@@ -42,20 +245,59 @@ def retry(
             n_tries = 0
             _exception = None
             while n_tries < max_tries or max_tries <= 0:
+                check_deadline()
                 try:
                     return func(*args, **kwargs)
+                except DeadlineExceeded:
+                    raise
                 except Exception as e:
                     if isinstance(e, exceptions) or exceptions is None:
                         _exception = e
                         n_tries += 1
-                        if delay_seconds >= 0:
-                            sleep(delay_seconds)
+                        # The delay is computed first: if it would end past the deadline, DeadlineExceeded is raised and no retry is counted
+                        delay = (
+                            get_delay(e, n_tries)
+                            if delay_seconds >= 0 and n_tries != max_tries
+                            else None
+                        )
+                        if n_tries != max_tries and on_retry is not None:
+                            on_retry(e, *args, **kwargs)
+                        if delay is not None:
+                            sleep(delay)
                     else:
                         raise e
             else:
                 raise _exception if _exception is not None else EmptyException
 
-        return wrapper
+        async def async_wrapper(*args, **kwargs) -> Any:
+            n_tries = 0
+            _exception = None
+            while n_tries < max_tries or max_tries <= 0:
+                check_deadline()
+                try:
+                    return await func(*args, **kwargs)
+                except DeadlineExceeded:
+                    raise
+                except Exception as e:
+                    if isinstance(e, exceptions) or exceptions is None:
+                        _exception = e
+                        n_tries += 1
+                        # The delay is computed first: if it would end past the deadline, DeadlineExceeded is raised and no retry is counted
+                        delay = (
+                            get_delay(e, n_tries)
+                            if delay_seconds >= 0 and n_tries != max_tries
+                            else None
+                        )
+                        if n_tries != max_tries and on_retry is not None:
+                            on_retry(e, *args, **kwargs)
+                        if delay is not None:
+                            await asyncio.sleep(delay)
+                    else:
+                        raise e
+            else:
+                raise _exception if _exception is not None else EmptyException
+
+        return async_wrapper if iscoroutinefunction(func) else wrapper
 
     return decorator
 
@@ -86,9 +328,18 @@ class BaseClass:
         """
         raise NotImplementedError(f'relative_url property method must be overridden!')
 
+    @property
+    def table_columns_spec(self) -> dict[str, str | None]:
+        """
+        Property function that returns a dict table column -> spec ("str", "int", "float", "indicator_id" or None if the column is not parsed), used to convert whole columns at once when coercion is "column". Keys must follow self.table_columns order.
+        """
+        raise NotImplementedError(
+            f'table_columns_spec property method must be overridden!'
+        )
+
     def transform_td(self, td: Tag, index: int) -> Any:
         """
-        Manipulate every td passed. Td is a bs4.Tag instance and comes also with its index position in tr so you can apply the right manipulation.
+        Manipulate every td passed. Td is a bs4.Tag instance (or a parsers.LxmlTag, which exposes the same text, attrs and find interface, when table_parser is "lxml") and comes also with its index position in tr so you can apply the right manipulation.
         """
         raise NotImplementedError(f'transform_td method must be overridden!')
 
@@ -97,3 +348,46 @@ class BaseClass:
         Override this function to manipulate downloaded df just before is returned.
         """
         raise NotImplementedError(f'process_results_df method must be overridden!')
+
+    @property
+    def deferred(self) -> bool:
+        """
+        Property function that returns True if the last download ran out of the time of its deadline_scope before completing: its df is empty and it should be made again later.
+        """
+        return any(isinstance(e, DeadlineExceeded) for e in self.errors)
+
+    def _shared_download(
+        self, key: tuple, download: Callable[[], pd.DataFrame]
+    ) -> pd.DataFrame:
+        """
+        Return download(), shared through self.session.single_flight with every concurrent or later download with the same key (see _result_key of downloaders): the df is parsed once, every caller gets its own copy and the errors of the download that made the requests. Dfs of failed downloads are shared only with concurrent callers.
+        """
+        single_flight = getattr(self.session, 'single_flight', None)
+        if single_flight is None:
+            return download()
+        df, errors = single_flight.do(
+            key, lambda: (download(), self.errors), keep=_without_errors
+        )
+        self.errors = list(errors)
+        return df.copy()
+
+    async def _ashared_download(
+        self, key: tuple, adownload: Callable[[], Awaitable[pd.DataFrame]]
+    ) -> pd.DataFrame:
+        """
+        Awaitable version of self._shared_download, adownload is a coroutine function.
+        """
+        single_flight = getattr(self.session, 'single_flight', None)
+        if single_flight is None:
+            return await adownload()
+
+        async def run() -> tuple[pd.DataFrame, list]:
+            return await adownload(), self.errors
+
+        df, errors = await single_flight.ado(key, run, keep=_without_errors)
+        self.errors = list(errors)
+        return df.copy()
+
+
+def _without_errors(result: tuple[pd.DataFrame, list]) -> bool:
+    return not result[1]
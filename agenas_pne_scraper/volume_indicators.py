@@ -1,9 +1,8 @@
 from bs4 import Tag
 import pandas as pd
-import re
 from typing import Any
-from urllib.parse import parse_qs
 
+from .utils import get_indicator_id
 from .PNEGraphsDownloader import PNEGraphsDownloader
 from .PNETableDownloader import PNETableDownloader
 
@@ -43,6 +42,13 @@ class PNEVolumeIndicatorsDownloader(PNETableDownloader):
         'indicator_id',
         'operator',
     ]
+
+    table_columns_spec = {
+        'description': 'str',
+        'value': 'int',
+        'indicator_id': 'indicator_id',
+        'operator': None,
+    }
     relative_url = 'strutture/stru_frequenza.php'
 
     def generate_querystring_dict(self) -> dict[str, str]:
@@ -59,11 +65,7 @@ class PNEVolumeIndicatorsDownloader(PNETableDownloader):
         elif index == 2:
             a = td.find('a')
             if a is not None and 'href' in a.attrs:
-                qs = parse_qs(re.sub('(.*)\?', '', a.attrs['href']))
-                try:
-                    return int(qs.get('ind', [''])[0])
-                except ValueError:
-                    pass
+                return get_indicator_id(a.attrs['href'])
 
     def process_results_df(self, df: pd.DataFrame) -> pd.DataFrame:
         df['indicator_type'] = 'volume'
@@ -1,10 +1,8 @@
 from bs4 import Tag
 import pandas as pd
-import re
 from typing import Any
-from urllib.parse import parse_qs
 
-from .utils import display
+from .utils import display, get_indicator_id
 from .PNEGraphsDownloader import PNEGraphsDownloader
 from .PNETableDownloader import PNETableDownloader
 
@@ -52,6 +50,16 @@ class PNEWaitingTimeIndicatorsDownloader(PNETableDownloader):
         'survivals',
     ]
 
+    table_columns_spec = {
+        'description': 'str',
+        'cases': 'int',
+        'intervention_pct': 'int',
+        'median': 'int',
+        'adj_median': 'int',
+        'indicator_id': 'indicator_id',
+        'survivals': None,
+    }
+
     relative_url = 'strutture/stru_tempi.php'
 
     def generate_querystring_dict(self) -> dict[str, str]:
@@ -68,11 +76,7 @@ class PNEWaitingTimeIndicatorsDownloader(PNETableDownloader):
         elif index == 5:
             a = td.find('a')
             if a is not None and 'href' in a.attrs:
-                qs = parse_qs(re.sub('(.*)\?', '', a.attrs['href']))
-                try:
-                    return int(qs.get('ind', [''])[0])
-                except ValueError:
-                    pass
+                return get_indicator_id(a.attrs['href'])
 
     def process_results_df(self, df: pd.DataFrame) -> pd.DataFrame:
         df['indicator_type'] = 'wt'
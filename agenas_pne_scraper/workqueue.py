@@ -0,0 +1,389 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import os
+import pandas as pd
+import pickle
+import socket
+import sqlite3
+from threading import Lock, current_thread
+from time import sleep, time
+from typing import Any, Iterable, NamedTuple, Optional
+
+from .crawling import (
+    KINDS,
+    _check_kinds,
+    _concat,
+    _download_graph,
+    _download_table,
+    graph_pairs,
+)
+from .sinks import ResultsSink
+from .transport import PNESession, get_default_session
+from .utils import get_cache_dir
+
+
+class WorkUnit(NamedTuple):
+    # "table" or "graph"
+    stage: str
+    # "volume", "outcome" or "wt"
+    kind: str
+    hospital_code: str
+    # None for tables
+    indicator_id: Optional[int]
+    # None for graphs, which don't depend on the year
+    year: Optional[int]
+
+
+class WorkQueue:
+    """
+    Work queue of crawl units stored in a SQLite file, so that several processes, or several machines sharing a filesystem with working locks, can crawl the same job without a broker. A unit is a table of (kind, hospital_code, year) or a graph of (kind, hospital_code, indicator_id); graph units are enqueued by the workers that complete their table.
+    Workers lease units (see WorkQueue.lease and run_worker): a leased unit is not given to other workers until its lease expires, so units of crashed workers are picked up again after lease_timeout. Failed units are retried until they've been leased max_attempts times. Completed units store their df, WorkQueue.merge concatenates them.
+    Keyword args:
+        - job_id [str], identifier of the crawl, e.g. "pne-2019-2021".
+        - path [str | None], _default=None_, SQLite file to use. If None, workqueue.sqlite in the package cache dir (see utils.get_cache_dir) is used, which is fine for processes of a single machine only.
+        - lease_timeout [float | timedelta], _default=10 minutes_, time (in seconds if float) after which the unit of a worker that didn't complete it is given to another worker.
+        - max_attempts [int], _default=5_, number of leases after which a unit that keeps failing is marked as failed.
+        - journal_mode [str], _default="DELETE"_, SQLite journal mode of the file. The default rollback journal relies on file locks only, so it works on a filesystem shared by several machines. "WAL" is faster under many concurrent workers, but it needs shared memory: use it only when every process runs on the same host.
+    """
+
+    def __init__(
+        self,
+        job_id: str,
+        path: Optional[str] = None,
+        lease_timeout: float | timedelta = timedelta(minutes=10),
+        max_attempts: int = 5,
+        journal_mode: str = 'DELETE',
+    ) -> None:
+        assert journal_mode.upper() in set(['DELETE', 'WAL'])
+        if path is None:
+            path = os.path.join(get_cache_dir(), 'workqueue.sqlite')
+        self.job_id = job_id
+        self.path = path
+        self.lease_timeout = (
+            lease_timeout.total_seconds()
+            if isinstance(lease_timeout, timedelta)
+            else lease_timeout
+        )
+        self.max_attempts = max_attempts
+        self.journal_mode = journal_mode.upper()
+        self._setup()
+
+    def _setup(self) -> None:
+        self._lock = Lock()
+        self._connection = None
+        self._pid = None
+
+    def _get_connection(self) -> sqlite3.Connection:
+        if self._connection is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            connection.execute(f'PRAGMA journal_mode={self.journal_mode}')
+            # year and indicator_id are '' when they don't apply, so that they can be part of the primary key
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS units ('
+                'job_id TEXT, stage TEXT, kind TEXT, hospital_code TEXT, '
+                "indicator_id TEXT DEFAULT '', year TEXT DEFAULT '', "
+                "state TEXT DEFAULT 'pending', worker TEXT, lease_expires REAL, "
+                'attempts INTEGER DEFAULT 0, error TEXT, frame BLOB, updated_at REAL, '
+                'PRIMARY KEY (job_id, stage, kind, hospital_code, indicator_id, year))'
+            )
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS units_state ON units (job_id, state)'
+            )
+            connection.commit()
+            self._connection = connection
+            self._pid = os.getpid()
+        return self._connection
+
+    @staticmethod
+    def _key(unit: WorkUnit) -> tuple[str, str, str, str, str]:
+        return (
+            unit.stage,
+            unit.kind,
+            unit.hospital_code,
+            '' if unit.indicator_id is None else str(int(unit.indicator_id)),
+            '' if unit.year is None else str(int(unit.year)),
+        )
+
+    @staticmethod
+    def _unit(
+        stage: str, kind: str, hospital_code: str, indicator_id: str, year: str
+    ) -> WorkUnit:
+        return WorkUnit(
+            stage,
+            kind,
+            hospital_code,
+            int(indicator_id) if indicator_id else None,
+            int(year) if year else None,
+        )
+
+    def enqueue(self, units: Iterable[WorkUnit]) -> int:
+        """
+        Add units to the queue, units that are already in it are ignored. Return the number of added units.
+        """
+        rows = [(self.job_id,) + self._key(unit) + (time(),) for unit in units]
+        with self._lock:
+            connection = self._get_connection()
+            n = connection.total_changes
+            connection.executemany(
+                'INSERT OR IGNORE INTO units (job_id, stage, kind, hospital_code, '
+                'indicator_id, year, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                rows,
+            )
+            connection.commit()
+            return connection.total_changes - n
+
+    def enqueue_tables(
+        self,
+        hospital_codes: Iterable[str],
+        years: Iterable[int],
+        kinds: Iterable[str] = ('volume', 'outcome', 'wt'),
+    ) -> int:
+        """
+        Add a table unit for every kind, hospital code and year. Return the number of added units.
+        """
+        kinds = _check_kinds(kinds)
+        hospital_codes = list(dict.fromkeys(hospital_codes))
+        return self.enqueue(
+            WorkUnit('table', kind, code, None, year)
+            for year in years
+            for kind in kinds
+            for code in hospital_codes
+        )
+
+    def lease(self, worker: str, n: int = 1) -> list[WorkUnit]:
+        """
+        Lease up to n units to worker: pending ones first, then the ones whose lease expired. Units whose lease expired max_attempts times are marked as failed.
+        """
+        now = time()
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                connection.execute(
+                    "UPDATE units SET state = 'failed', error = 'lease expired', "
+                    'updated_at = ? WHERE job_id = ? AND state = ? '
+                    'AND lease_expires < ? AND attempts >= ?',
+                    (now, self.job_id, 'leased', now, self.max_attempts),
+                )
+                rows = connection.execute(
+                    'SELECT stage, kind, hospital_code, indicator_id, year FROM units '
+                    "WHERE job_id = ? AND (state = 'pending' OR "
+                    "(state = 'leased' AND lease_expires < ?)) "
+                    # Tables first, so graph units are enqueued as soon as possible
+                    "ORDER BY stage = 'graph', rowid LIMIT ?",
+                    (self.job_id, now, n),
+                ).fetchall()
+                connection.executemany(
+                    "UPDATE units SET state = 'leased', worker = ?, lease_expires = ?, "
+                    'attempts = attempts + 1, updated_at = ? WHERE job_id = ? '
+                    'AND stage = ? AND kind = ? AND hospital_code = ? '
+                    'AND indicator_id = ? AND year = ?',
+                    [
+                        (worker, now + self.lease_timeout, now, self.job_id) + row
+                        for row in rows
+                    ],
+                )
+                connection.commit()
+            except BaseException:
+                connection.rollback()
+                raise
+        return [self._unit(*row) for row in rows]
+
+    def complete(self, unit: WorkUnit, df: pd.DataFrame) -> None:
+        """
+        Mark unit as done and store its df. A unit completed twice (e.g. by a worker whose lease expired) keeps the first df.
+        """
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute(
+                "UPDATE units SET state = 'done', frame = ?, error = NULL, "
+                'updated_at = ? WHERE job_id = ? AND stage = ? AND kind = ? '
+                "AND hospital_code = ? AND indicator_id = ? AND year = ? AND state != 'done'",
+                (
+                    pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL),
+                    time(),
+                    self.job_id,
+                )
+                + self._key(unit),
+            )
+            connection.commit()
+
+    def fail(self, unit: WorkUnit, error: str) -> None:
+        """
+        Release unit after a failure: it will be leased again, unless it was already leased max_attempts times, in which case it's marked as failed.
+        """
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute(
+                'UPDATE units SET state = CASE WHEN attempts >= ? '
+                "THEN 'failed' ELSE 'pending' END, error = ?, updated_at = ? "
+                'WHERE job_id = ? AND stage = ? AND kind = ? AND hospital_code = ? '
+                "AND indicator_id = ? AND year = ? AND state = 'leased'",
+                (self.max_attempts, error, time(), self.job_id) + self._key(unit),
+            )
+            connection.commit()
+
+    def retry_failed(self) -> int:
+        """
+        Make failed units pending again, with no attempts. Return their number.
+        """
+        with self._lock:
+            connection = self._get_connection()
+            n = connection.execute(
+                "UPDATE units SET state = 'pending', attempts = 0, updated_at = ? "
+                "WHERE job_id = ? AND state = 'failed'",
+                (time(), self.job_id),
+            ).rowcount
+            connection.commit()
+            return n
+
+    def counts(self) -> dict[str, int]:
+        """
+        Return the number of units in every state: pending, leased, done and failed.
+        """
+        with self._lock:
+            rows = (
+                self._get_connection()
+                .execute(
+                    'SELECT state, COUNT(*) FROM units WHERE job_id = ? GROUP BY state',
+                    (self.job_id,),
+                )
+                .fetchall()
+            )
+        counts = dict(pending=0, leased=0, done=0, failed=0)
+        counts.update(rows)
+        return counts
+
+    def is_finished(self) -> bool:
+        """
+        Return True if no unit is pending or leased.
+        """
+        counts = self.counts()
+        return not counts['pending'] and not counts['leased']
+
+    def _frames(self, stage: str, kind: str) -> list[pd.DataFrame]:
+        with self._lock:
+            rows = (
+                self._get_connection()
+                .execute(
+                    'SELECT frame FROM units WHERE job_id = ? AND stage = ? AND kind = ? '
+                    "AND state = 'done' ORDER BY year, rowid",
+                    (self.job_id, stage, kind),
+                )
+                .fetchall()
+            )
+        return [pickle.loads(frame) for frame, in rows]
+
+    def merge(
+        self,
+        kinds: Iterable[str] = ('volume', 'outcome', 'wt'),
+        sink: Optional[ResultsSink] = None,
+    ) -> dict[str, pd.DataFrame]:
+        """
+        Merge the dfs of completed units. Returns a dict like crawl: a df for every kind (tables of every year) and for every kind's graphs (e.g. "volume_graphs"), if any. If sink is given, dfs are written to it one unit at a time and the dict is empty.
+        """
+        results = {}
+        for kind in _check_kinds(kinds):
+            for stage, cls, key in (
+                ('table', KINDS[kind][0], kind),
+                ('graph', KINDS[kind][1], f'{kind}_graphs'),
+            ):
+                frames = self._frames(stage, kind)
+                if sink is not None:
+                    for df in frames:
+                        sink.write(df, cls)
+                elif frames or stage == 'table':
+                    results[key] = _concat(frames, cls)
+        return results
+
+    def reset(self) -> None:
+        """
+        Remove every unit of the job.
+        """
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute('DELETE FROM units WHERE job_id = ?', (self.job_id,))
+            connection.commit()
+
+    def __getstate__(self) -> dict[str, Any]:
+        state = self.__dict__.copy()
+        for k in ('_lock', '_connection', '_pid'):
+            state.pop(k)
+        return state
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._setup()
+
+
+def _run_unit(
+    queue: WorkQueue, unit: WorkUnit, session: PNESession, graphs: bool
+) -> bool:
+    # Download unit, complete it (enqueueing its graphs) or release it; return True if it succeeded
+    table_cls, graph_cls = KINDS[unit.kind]
+    try:
+        if unit.stage == 'table':
+            df, ok = _download_table(table_cls, unit.year, session, unit.hospital_code)
+        else:
+            df, ok = _download_graph(
+                graph_cls, session, unit.hospital_code, unit.indicator_id
+            )
+    except Exception as e:
+        queue.fail(unit, repr(e))
+        return False
+    if not ok:
+        queue.fail(unit, 'requests kept failing')
+        return False
+    if unit.stage == 'table' and graphs and len(df):
+        queue.enqueue(
+            WorkUnit('graph', unit.kind, code, int(indicator_id), None)
+            for code, indicator_id in graph_pairs(df).itertuples(index=False)
+        )
+    queue.complete(unit, df)
+    return True
+
+
+def run_worker(
+    queue: WorkQueue,
+    workers: int = 16,
+    graphs: bool = False,
+    session: Optional[PNESession] = None,
+    worker_id: Optional[str] = None,
+    poll_interval: float = 5,
+) -> dict[str, int]:
+    """
+    Lease and download units of queue with a pool of threads until no unit is pending or leased (by this or other workers), then return how many units this worker completed ("done") and released after a failure ("failed"). Run it on every process or machine taking part in the crawl.
+    Keyword args:
+        - queue [WorkQueue], queue to work on.
+        - workers [int], _default=16_, number of threads.
+        - graphs [bool], _default=False_, if True, a graph unit is enqueued for every (hospital_code, indicator_id) pair of completed tables.
+        - session [PNESession | None], _default=None_, session to use. If None, the default session is used.
+        - worker_id [str | None], _default=None_, name of the worker in the queue. If None, "<hostname>:<pid>" is used.
+        - poll_interval [float], _default=5_, seconds to wait before leasing again when every unit left is leased by other workers.
+    """
+    session = session if session is not None else get_default_session()
+    worker_id = worker_id or f'{socket.gethostname()}:{os.getpid()}'
+    stats = dict(done=0, failed=0)
+    stats_lock = Lock()
+
+    def work() -> None:
+        name = f'{worker_id}:{current_thread().name}'
+        while True:
+            units = queue.lease(name)
+            if not units:
+                if queue.is_finished():
+                    return
+                # Units left are leased by others: they may enqueue graphs or crash
+                sleep(poll_interval)
+                continue
+            ok = _run_unit(queue, units[0], session, graphs)
+            with stats_lock:
+                stats['done' if ok else 'failed'] += 1
+
+    with ThreadPoolExecutor(
+        max_workers=workers, thread_name_prefix='pne-worker'
+    ) as executor:
+        for future in [executor.submit(work) for _ in range(workers)]:
+            future.result()
+    return stats
@@ -0,0 +1,99 @@
+import argparse
+import pandas as pd
+import sys
+import warnings
+
+from agenas_pne_scraper.PNETableDownloader import PNETableDownloader
+
+from .bench import compare, run, to_df
+from .fixtures import record
+
+
+def main(argv: list[str] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks',
+        description='Offline benchmarks of agenas_pne_scraper against a local stand-in of pne.agenas.it.',
+    )
+    subparsers = parser.add_subparsers(dest='command')
+
+    run_parser = subparsers.add_parser('run', help='run the benchmarks (default)')
+    run_parser.add_argument('--parse-units', type=int, default=50)
+    run_parser.add_argument('--e2e-units', type=int, default=200)
+    run_parser.add_argument('--workers', type=int, default=16)
+    run_parser.add_argument('--no-governor', action='store_true')
+    run_parser.add_argument('--latency', type=float, default=0.05, help='seconds')
+    run_parser.add_argument('--jitter', type=float, default=0.02, help='seconds')
+    run_parser.add_argument('--error-rate', type=float, default=0)
+    run_parser.add_argument(
+        '--max-rate',
+        type=float,
+        default=None,
+        help='requests/s over which the server answers 429',
+    )
+    run_parser.add_argument('--table-parser', choices=['bs4', 'lxml'], default=None)
+    run_parser.add_argument('--coercion', choices=['cell', 'column'], default=None)
+    run_parser.add_argument('--no-hospitals', action='store_true')
+    run_parser.add_argument('--save', help='write results to this CSV file')
+    run_parser.add_argument(
+        '--baseline', help='compare with results saved by a previous --save'
+    )
+    run_parser.add_argument(
+        '--tolerance',
+        type=float,
+        default=0.1,
+        help='relative change counted as regression',
+    )
+
+    record_parser = subparsers.add_parser(
+        'record', help='record fixtures from the live site'
+    )
+    record_parser.add_argument('hospital_codes', nargs='+')
+
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] not in ('run', 'record', '-h', '--help'):
+        argv = ['run'] + argv
+    args = parser.parse_args(argv)
+    if args.command == 'record':
+        print(f'{record(args.hospital_codes)} pages recorded')
+        return 0
+
+    if args.table_parser is not None:
+        PNETableDownloader.table_parser = args.table_parser
+    if args.coercion is not None:
+        PNETableDownloader.coercion = args.coercion
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        df = to_df(
+            run(
+                parse_units=args.parse_units,
+                e2e_units=args.e2e_units,
+                workers=args.workers,
+                governor=not args.no_governor,
+                latency=args.latency,
+                jitter=args.jitter,
+                error_rate=args.error_rate,
+                max_rate=args.max_rate,
+                hospitals=not args.no_hospitals,
+            )
+        )
+    if args.save:
+        df.to_csv(args.save, index=False)
+    if args.baseline:
+        df = compare(df, pd.read_csv(args.baseline), tolerance=args.tolerance)
+    with pd.option_context(
+        'display.max_rows',
+        None,
+        'display.width',
+        200,
+        'display.float_format',
+        '{:.4g}'.format,
+    ):
+        print(df.drop(columns=['higher_is_better']).to_string(index=False))
+    if args.baseline and df.regression.any():
+        print(f'{df.regression.sum()} regression(s) over {args.tolerance:.0%}')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
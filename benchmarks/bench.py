@@ -0,0 +1,268 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+import requests
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Any, Iterator, NamedTuple, Optional
+
+from agenas_pne_scraper import (
+    PNEOutcomeGraphsDownloader,
+    PNEOutcomeIndicatorsDownloader,
+    PNESession,
+    PNEVolumeGraphsDownloader,
+    PNEVolumeIndicatorsDownloader,
+    PNEWaitingTimeGraphsDownloader,
+    PNEWaitingTimeIndicatorsDownloader,
+    RateGovernor,
+)
+from agenas_pne_scraper.hospitals import (
+    HospitalRegistry,
+    hospitals_df_columns,
+    load_hospital_sources_df,
+)
+from agenas_pne_scraper.PNEGraphsDownloader import PNEGraphsDownloader
+from agenas_pne_scraper.utils import BaseClass
+
+from .fixtures import get_page
+from .server import StandInServer
+
+TABLE_CLASSES = [
+    PNEVolumeIndicatorsDownloader,
+    PNEWaitingTimeIndicatorsDownloader,
+    PNEOutcomeIndicatorsDownloader,
+]
+GRAPH_CLASSES = [
+    PNEVolumeGraphsDownloader,
+    PNEWaitingTimeGraphsDownloader,
+    PNEOutcomeGraphsDownloader,
+]
+
+
+class Result(NamedTuple):
+    benchmark: str
+    name: str
+    metric: str
+    value: float
+    # Direction used to tell regressions from improvements
+    higher_is_better: bool
+
+
+def hospital_codes(n: int) -> list[str]:
+    return [f'{i:06d}01' for i in range(1, n + 1)]
+
+
+def graph_pairs(n: int) -> list[tuple[str, int]]:
+    # Indicator ids of the generated table pages start from 100
+    codes = hospital_codes(max(1, n // 10))
+    return [(codes[i % len(codes)], 100 + i // len(codes)) for i in range(n)]
+
+
+@contextmanager
+def base_url(url: str) -> Iterator[None]:
+    previous = BaseClass.BASE_URL
+    BaseClass.BASE_URL = url
+    try:
+        yield
+    finally:
+        BaseClass.BASE_URL = previous
+
+
+def _response(endpoint: str, params: dict[str, str]) -> requests.Response:
+    content, content_type = get_page(endpoint, params)
+    r = requests.Response()
+    r.status_code = 200
+    r.headers['Content-Type'] = content_type
+    r.encoding = requests.utils.get_encoding_from_headers(r.headers)
+    r._content = content
+    return r
+
+
+def _endpoint(relative_url: str) -> str:
+    return relative_url.rpartition('/')[2]
+
+
+def _parse_input(downloader: BaseClass) -> Any:
+    # What downloader._fetch would return, built from fixtures
+    def params(**kwargs) -> dict[str, str]:
+        querystring = downloader.generate_querystring_dict(**kwargs)
+        return {k: str(v) for k, v in querystring.items()}
+
+    if isinstance(downloader, PNEOutcomeIndicatorsDownloader):
+        return {
+            compare: _response(
+                _endpoint(downloader.relative_url), params(compare=compare)
+            )
+            for compare in ('reg', 'prec')
+        }
+    if isinstance(downloader, PNEOutcomeGraphsDownloader):
+        return (
+            _response(_endpoint(downloader.relative_url), params()),
+            _response(_endpoint(downloader.relative_url_ci), params()),
+        )
+    if isinstance(downloader, PNEGraphsDownloader):
+        return (_response(_endpoint(downloader.relative_url), params()),)
+    return _response(_endpoint(downloader.relative_url), params())
+
+
+def _make_downloader(
+    cls: type[BaseClass], unit: Any, session: Optional[PNESession] = None
+) -> BaseClass:
+    if issubclass(cls, PNEGraphsDownloader):
+        hospital_code, indicator_id = unit
+        return cls(
+            hospital_code=hospital_code, indicator_id=indicator_id, session=session
+        )
+    return cls(year=2021, hospital_code=unit, session=session)
+
+
+def _units(cls: type[BaseClass], n: int) -> list[Any]:
+    return graph_pairs(n) if issubclass(cls, PNEGraphsDownloader) else hospital_codes(n)
+
+
+def bench_parse(cls: type[BaseClass], n: int = 50, repeat: int = 3) -> list[Result]:
+    """
+    Parse-only throughput of cls: fixture responses of n units are built in advance and only self._parse is timed. The best of repeat runs is taken, to reduce noise.
+    """
+    session = PNESession()
+    downloaders = [_make_downloader(cls, unit, session) for unit in _units(cls, n)]
+    inputs = [_parse_input(downloader) for downloader in downloaders]
+    elapsed = float('inf')
+    for _ in range(repeat):
+        n_rows = 0
+        start = perf_counter()
+        for downloader, fetched in zip(downloaders, inputs):
+            n_rows += len(downloader._parse(fetched))
+        elapsed = min(elapsed, perf_counter() - start)
+    session.close()
+    return [
+        Result('parse', cls.__name__, 'units/s', n / elapsed, True),
+        Result('parse', cls.__name__, 'rows/s', n_rows / elapsed, True),
+    ]
+
+
+def bench_end_to_end(
+    cls: type[BaseClass],
+    server: StandInServer,
+    n: int = 200,
+    workers: int = 16,
+    governor: bool = True,
+) -> list[Result]:
+    """
+    End-to-end throughput and latency of cls: n units are downloaded from server by workers threads, every download (requests, retries and parsing) is timed.
+    """
+    session = PNESession(
+        pool_maxsize=workers,
+        governor=RateGovernor(max_in_flight=workers) if governor else None,
+    )
+    units = _units(cls, n)
+    latencies = []
+    n_errors = 0
+
+    def download(unit: Any) -> None:
+        nonlocal n_errors
+        downloader = _make_downloader(cls, unit, session)
+        start = perf_counter()
+        downloader.download()
+        latencies.append(perf_counter() - start)
+        n_errors += bool(downloader.errors)
+
+    requests_before = server.requests
+    with base_url(server.base_url):
+        start = perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(download, units))
+        elapsed = perf_counter() - start
+    session.close()
+    n_requests = server.requests - requests_before
+    return [
+        Result('end_to_end', cls.__name__, 'requests/s', n_requests / elapsed, True),
+        Result('end_to_end', cls.__name__, 'units/s', n / elapsed, True),
+        Result(
+            'end_to_end', cls.__name__, 'p50_s', np.percentile(latencies, 50), False
+        ),
+        Result(
+            'end_to_end', cls.__name__, 'p99_s', np.percentile(latencies, 99), False
+        ),
+        Result('end_to_end', cls.__name__, 'failed_units', n_errors, False),
+    ]
+
+
+def bench_hospitals(n: int = 30000, lookups: int = 100000) -> list[Result]:
+    """
+    Cold load of a HospitalRegistry of n hospitals from its binary cache and hospital_id lookups.
+    """
+    df = pd.DataFrame({c: [f'{c}{i}' for i in range(n)] for c in hospitals_df_columns})
+    df['codice_struttura'] = [f'{i:06d}' for i in range(n)]
+    df['subcodice_struttura_interna'] = None
+    df['struttura_interna'] = None
+    df['data_up_to'] = load_hospital_sources_df().data_up_to.iloc[0]
+    with TemporaryDirectory() as cache_dir:
+        registry = HospitalRegistry(cache_dir=cache_dir)
+        registry._write_binary_cache(
+            df, registry._cache_path(load_hospital_sources_df())
+        )
+        start = perf_counter()
+        registry.hospital_id_hospital_name_df
+        load = perf_counter() - start
+        ids = [f'{i % n:06d}01' for i in range(lookups)]
+        start = perf_counter()
+        for hospital_id in ids:
+            registry.hospital_name(hospital_id)
+        lookup = perf_counter() - start
+    return [
+        Result('hospitals', 'HospitalRegistry', 'cold_load_s', load, False),
+        Result('hospitals', 'HospitalRegistry', 'lookups/s', lookups / lookup, True),
+    ]
+
+
+def run(
+    parse_units: int = 50,
+    e2e_units: int = 200,
+    workers: int = 16,
+    governor: bool = True,
+    latency: float = 0.05,
+    jitter: float = 0.02,
+    error_rate: float = 0,
+    max_rate: Optional[float] = None,
+    hospitals: bool = True,
+) -> list[Result]:
+    """
+    Run every benchmark and return the results.
+    """
+    results = []
+    for cls in TABLE_CLASSES + GRAPH_CLASSES:
+        results += bench_parse(cls, n=parse_units)
+    with StandInServer(
+        latency=latency, jitter=jitter, error_rate=error_rate, max_rate=max_rate
+    ) as server:
+        for cls in TABLE_CLASSES + GRAPH_CLASSES:
+            results += bench_end_to_end(
+                cls, server, n=e2e_units, workers=workers, governor=governor
+            )
+    if hospitals:
+        results += bench_hospitals()
+    return results
+
+
+def to_df(results: list[Result]) -> pd.DataFrame:
+    return pd.DataFrame(results, columns=Result._fields)
+
+
+def compare(
+    results: pd.DataFrame, baseline: pd.DataFrame, tolerance: float = 0.1
+) -> pd.DataFrame:
+    """
+    Compare results with baseline (both as returned by to_df) and return the merged df with change (relative to baseline, positive is better) and regression (change worse than -tolerance) columns.
+    """
+    df = results.merge(
+        baseline[['benchmark', 'name', 'metric', 'value']],
+        on=['benchmark', 'name', 'metric'],
+        how='left',
+        suffixes=('', '_baseline'),
+    )
+    change = df.value / df.value_baseline - 1
+    df['change'] = change.where(df.higher_is_better, -change)
+    df['regression'] = df.change < -tolerance
+    return df
@@ -0,0 +1,165 @@
+import json
+import os
+from random import Random
+from typing import Optional
+from urllib.parse import urlencode
+
+# Directory of recorded pages, see record
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+TABLE_ENDPOINTS = ['stru_frequenza.php', 'stru_tempi.php', 'stru_indicatori.php']
+GRAPH_ENDPOINTS = [
+    'grafico1Str5_HC_json.php',
+    'grafico1Str3_HC_json.php',
+    'grafico1Str1_HC_json.php',
+    'grafico1Str1_IC_HC_json.php',
+]
+
+
+def fixture_name(endpoint: str, params: dict[str, str]) -> str:
+    """
+    Return the file name a page is recorded to, e.g. "stru_indicatori.php?cod_struttura=030901&conf=reg".
+    """
+    return f'{endpoint}?{urlencode(sorted(params.items()))}'
+
+
+def load_recorded(endpoint: str, params: dict[str, str]) -> Optional[bytes]:
+    """
+    Return the recorded page of endpoint and params, or None if it was not recorded.
+    """
+    path = os.path.join(FIXTURES_DIR, fixture_name(endpoint, params))
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+
+def _description(rnd: Random, i: int) -> str:
+    words = ['intervento', 'tumore', 'maligno', 'frattura', 'collo', 'femore']
+    words += ['mortalita', 'ricoveri', 'giorni', 'reparti', 'volume', 'attivita']
+    return f'Indicatore {i}: ' + ' '.join(rnd.choice(words) for _ in range(12))
+
+
+def _link(hospital_code: str, indicator_id: int) -> str:
+    return f'<a href="../grafici/grafico.php?cod_struttura={hospital_code}&amp;ind={indicator_id}">grafico</a>'
+
+
+def generate_table(endpoint: str, params: dict[str, str], n_rows: int = 60) -> bytes:
+    """
+    Generate a deterministic table page of endpoint with the same structure as the PNE ones: a header row and n_rows rows, some with missing values ("-", "n.d.") and rows without graph link.
+    """
+    hospital_code = params.get('cod_struttura', '')
+    rnd = Random(fixture_name(endpoint, params))
+    rows = ['<tr><th>Indicatore</th><th>Valore</th></tr>']
+    for i in range(n_rows):
+        indicator_id = 100 + i
+        link = _link(hospital_code, indicator_id) if i % 17 else ''
+        description = _description(rnd, i)
+        if endpoint == 'stru_frequenza.php':
+            value = '-' if i % 11 == 0 else str(rnd.randint(0, 2000))
+            tds = [description, value, link, '&nbsp;']
+        elif endpoint == 'stru_tempi.php':
+            median = 'n.d.' if i % 13 == 0 else str(rnd.randint(0, 60))
+            tds = [
+                description,
+                str(rnd.randint(0, 900)),
+                str(rnd.randint(0, 100)),
+                str(rnd.randint(0, 60)),
+                median,
+                link,
+                '&nbsp;',
+            ]
+        else:
+            p_value = '-' if i % 7 == 0 else f'{rnd.random():.3f}'
+            tds = [
+                description,
+                str(rnd.randint(1, 900)),
+                f'{rnd.random() * 100:.2f}',
+                f'{rnd.random() * 100:.2f}',
+                f'{rnd.random() * 2:.2f}',
+                p_value,
+                link,
+                '&nbsp;',
+            ]
+        rows.append('<tr>' + ''.join(f'<td> {td} </td>' for td in tds) + '</tr>')
+    body = '<html><head><title>PNE</title></head><body><table>'
+    body += ''.join(rows) + '</table></body></html>'
+    return body.encode('iso-8859-1')
+
+
+def generate_graph(endpoint: str, params: dict[str, str], n_years: int = 8) -> bytes:
+    """
+    Generate a deterministic JSON graph of endpoint with n_years points: Highcharts-like series for value graphs, [upper, lower] pairs for confidence interval graphs.
+    """
+    rnd = Random(fixture_name(endpoint, params))
+    years = list(range(2022 - n_years, 2022))
+    if 'IC' in endpoint:
+        data = [[round(1 + rnd.random(), 2), round(rnd.random(), 2)] for _ in years]
+    else:
+        values = [rnd.randint(0, 500) if rnd.random() > 0.1 else None for _ in years]
+        data = [{'name': 'Anno', 'data': years}, {'name': 'Dati', 'data': values}]
+    return json.dumps(data).encode()
+
+
+def get_page(endpoint: str, params: dict[str, str]) -> Optional[tuple[bytes, str]]:
+    """
+    Return (content, content type) of endpoint and params: the recorded page if there is one, a generated one otherwise. None is returned for unknown endpoints.
+    """
+    if endpoint in TABLE_ENDPOINTS:
+        content = load_recorded(endpoint, params) or generate_table(endpoint, params)
+        return content, 'text/html; charset=iso-8859-1'
+    if endpoint in GRAPH_ENDPOINTS:
+        content = load_recorded(endpoint, params) or generate_graph(endpoint, params)
+        return content, 'application/json'
+
+
+def record(
+    hospital_codes: list[str], base_url: str = 'https://pne.agenas.it/sintesi/'
+) -> int:
+    """
+    Download the table pages of hospital_codes, and the graphs they link to, from the live site into FIXTURES_DIR, so that the stand-in server serves real pages. Return the number of recorded pages.
+    """
+    from agenas_pne_scraper import PNESession
+    from agenas_pne_scraper.utils import get_indicator_id
+    from bs4 import BeautifulSoup
+
+    os.makedirs(FIXTURES_DIR, exist_ok=True)
+    n = 0
+    with PNESession() as session:
+
+        def save(endpoint: str, params: dict[str, str]) -> bytes:
+            nonlocal n
+            content = session.get(base_url + 'strutture/' + endpoint, params).content
+            with open(
+                os.path.join(FIXTURES_DIR, fixture_name(endpoint, params)), 'wb'
+            ) as f:
+                f.write(content)
+            n += 1
+            return content
+
+        for hospital_code in hospital_codes:
+            for endpoint, graph_endpoints, confs in (
+                ('stru_frequenza.php', ['grafico1Str5_HC_json.php'], [None]),
+                ('stru_tempi.php', ['grafico1Str3_HC_json.php'], [None]),
+                (
+                    'stru_indicatori.php',
+                    ['grafico1Str1_HC_json.php', 'grafico1Str1_IC_HC_json.php'],
+                    ['reg', 'prec'],
+                ),
+            ):
+                indicator_ids = set()
+                for conf in confs:
+                    params = dict(cod_struttura=hospital_code)
+                    if conf is not None:
+                        params['conf'] = conf
+                    bs = BeautifulSoup(save(endpoint, params), 'lxml')
+                    for a in bs.find_all('a', href=True):
+                        indicator_id = get_indicator_id(a.attrs['href'])
+                        if indicator_id is not None:
+                            indicator_ids.add(indicator_id)
+                for indicator_id in sorted(indicator_ids):
+                    for graph_endpoint in graph_endpoints:
+                        save(
+                            graph_endpoint,
+                            dict(cod_struttura=hospital_code, ind=str(indicator_id)),
+                        )
+    return n
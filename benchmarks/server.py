@@ -0,0 +1,119 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from random import Random
+from threading import Lock, Thread
+from time import monotonic, sleep
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+
+from .fixtures import get_page
+
+
+class StandInServer:
+    """
+    Local HTTP stand-in of pne.agenas.it serving the pages of fixtures.get_page, with configurable latency, errors and throttling. Use base_url in place of BaseClass.BASE_URL.
+    Keyword args:
+        - latency [float], _default=0.05_, seconds every response is delayed by.
+        - jitter [float], _default=0.02_, maximum random delay (in seconds) added to latency.
+        - error_rate [float], _default=0_, fraction of requests answered with a 500.
+        - max_rate [float | None], _default=None_, if given, requests over this number per second are answered with a 429 and Retry-After: 1.
+        - port [int], _default=0_, port to listen on, 0 picks a free one.
+        - seed [int], _default=0_, seed of the random errors and jitter.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.05,
+        jitter: float = 0.02,
+        error_rate: float = 0,
+        max_rate: Optional[float] = None,
+        port: int = 0,
+        seed: int = 0,
+    ) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.max_rate = max_rate
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+        self._random = Random(seed)
+        self._lock = Lock()
+        self._window_start = monotonic()
+        self._window_requests = 0
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', port), self._make_handler())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        return f'http://127.0.0.1:{self._httpd.server_address[1]}/sintesi/'
+
+    def _decide(self) -> tuple[float, Optional[int]]:
+        # Return the delay and the error status code (None if the page must be served) of a request
+        with self._lock:
+            self.requests += 1
+            now = monotonic()
+            if now - self._window_start >= 1:
+                self._window_start = now
+                self._window_requests = 0
+            self._window_requests += 1
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            if self.max_rate is not None and self._window_requests > self.max_rate:
+                self.throttled += 1
+                return delay, 429
+            if self._random.random() < self.error_rate:
+                self.errors += 1
+                return delay, 500
+            return delay, None
+
+    def _make_handler(self) -> type[BaseHTTPRequestHandler]:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args) -> None:
+                pass
+
+            def _send(
+                self, status_code: int, content: bytes = b'', headers: dict = {}
+            ) -> None:
+                self.send_response(status_code)
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def do_GET(self) -> None:
+                url = urlparse(self.path)
+                params = {k: v[0] for k, v in parse_qs(url.query).items()}
+                page = get_page(url.path.rpartition('/')[2], params)
+                delay, status_code = server._decide()
+                sleep(delay)
+                if page is None:
+                    self._send(404)
+                elif status_code == 429:
+                    self._send(429, headers={'Retry-After': '1'})
+                elif status_code is not None:
+                    self._send(status_code)
+                else:
+                    content, content_type = page
+                    self._send(200, content, {'Content-Type': content_type})
+
+        return Handler
+
+    def start(self) -> 'StandInServer':
+        self._thread = Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self) -> 'StandInServer':
+        return self.start()
+
+    def __exit__(self, *args) -> None:
+        self.stop()